@@ -0,0 +1,155 @@
+##############################################################################
+#                                autotune.py                                 #
+##############################################################################
+
+import argparse
+import json
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from batchcontroller import BatchController
+from controller import PROFILE_PATH
+
+# Axis names and the column of each axis in a recorded trace
+AXES = ("RA", "DEC")
+
+##############################################################################
+def load_trace(path):
+    """Load a recorded guide session as (errors, rates), where errors is a
+    (T, 2) array of RA/Dec controller inputs and rates is the (T, 2) array
+    of commanded RA/Dec rates (or None if they weren't recorded).
+
+    Accepts .npy files or whitespace/comma separated text files with the
+    columns: raErr decErr [raRate decRate]."""
+
+    if path.endswith(".npy"):
+        data = np.load(path)
+    else:
+        data = np.loadtxt(path, delimiter="," if path.endswith(".csv") else None, ndmin=2)
+
+    if data.ndim != 2 or data.shape[1] not in (2, 4):
+        raise ValueError(f"trace {path} must have 2 or 4 columns, not {data.shape}")
+
+    errors = data[:, :2]
+    rates = data[:, 2:] if data.shape[1] == 4 else None
+    return errors, rates
+
+##############################################################################
+def _evaluate_chunk(args):
+    """Process pool worker: mean cost (RMS plus weighted effort) and mean
+    RMS of a chunk of gain combinations over every trace of one axis."""
+
+    propGains, intGains, intThreshold, traces, effortWeight, plantGain = args
+    batch = BatchController(propGains, intGains, intThresholds=intThreshold)
+
+    cost, rms = np.zeros(len(batch)), np.zeros(len(batch))
+    for errors, rates in traces:
+        results = batch.simulate(errors, rates, plantGain)
+        cost += results["rms"] + effortWeight * results["effort"]
+        rms += results["rms"]
+
+    return cost / len(traces), rms / len(traces)
+
+##############################################################################
+def tune_axis(traces, pool, propRange=(0, 2000), intRange=(0, 500), gridSize=40,
+              rounds=4, intThreshold=0.3, effortWeight=0, plantGain=1.0, chunks=8):
+    """Search the (propGain, intGain) plane of one axis for the gains with
+    the lowest guiding RMS. The returned costRMS is the RMS of the controller
+    input (calibrated rate units, not pixels) over the traces.
+
+    Each round evaluates a gridSize x gridSize grid split into chunks across
+    the process pool, then zooms the grid in around the best point. The
+    ranges are for a plant gain of 1 and are scaled down for larger ones."""
+
+    (pLow, pHigh), (iLow, iHigh) = np.divide(propRange, plantGain), np.divide(intRange, plantGain)
+    best, bestCost, bestCostRMS = (0, 0), np.inf, np.inf
+
+    for r in range(rounds):
+        propAxis = np.linspace(pLow, pHigh, gridSize)
+        intAxis = np.linspace(iLow, iHigh, gridSize)
+        propGains, intGains = (axis.ravel() for axis in np.meshgrid(propAxis, intAxis, indexing="ij"))
+
+        # evaluate the grid in parallel, one chunk per task
+        jobs = [(p, i, intThreshold, traces, effortWeight, plantGain) for p, i in
+                zip(np.array_split(propGains, chunks), np.array_split(intGains, chunks))]
+        (cost, rms) = (np.concatenate(values) for values in zip(*pool.map(_evaluate_chunk, jobs)))
+        cost[~np.isfinite(cost)] = np.inf   # unstable gains
+
+        idx = np.argmin(cost)
+        if cost[idx] < bestCost:
+            best, bestCost = (float(propGains[idx]), float(intGains[idx])), float(cost[idx])
+            bestCostRMS = float(rms[idx])
+
+        # zoom in around the best point by two grid cells in each direction
+        pStep, iStep = propAxis[1] - propAxis[0], intAxis[1] - intAxis[0]
+        pLow, pHigh = max(0, best[0] - 2 * pStep), best[0] + 2 * pStep
+        iLow, iHigh = max(0, best[1] - 2 * iStep), best[1] + 2 * iStep
+        print(f"\t<round {r}: propGain {best[0]:.4g}, intGain {best[1]:.4g}, "
+              f"input rms {bestCostRMS:.4g}, cost {bestCost:.4g}>")
+
+    return {"propGain": best[0], "intGain": best[1], "costRMS": bestCostRMS, "cost": bestCost}
+
+##############################################################################
+def tune(traces, workers=None, intThreshold=0.3, plantGains=(1.0, 1.0), **kwargs):
+    """Tune both axes over a list of (errors, rates) traces. Returns the
+    profile dictionary understood by Controller.load_profile."""
+
+    profile = {"integralThreshold": intThreshold}
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for col, axis in enumerate(AXES):
+            print(f"<tuning {axis}>")
+            axisTraces = [(errors[:, col], None if rates is None else rates[:, col])
+                          for errors, rates in traces]
+            profile[axis] = tune_axis(axisTraces, pool, intThreshold=intThreshold,
+                                      plantGain=float(plantGains[col]), **kwargs)
+
+    return profile
+
+##############################################################################
+def write_profile(profile, path=PROFILE_PATH):
+    """Write a tuned profile to disk for the Controller to load at startup,
+    keeping any other settings (e.g. "pec") of an existing profile."""
+
+    if os.path.exists(path):
+        with open(path) as f:
+            profile = {**json.load(f), **profile}
+
+    tmpPath = path + ".tmp"
+    with open(tmpPath, "w") as f:
+        json.dump(profile, f, indent=4)
+    os.replace(tmpPath, path)
+    print(f"<wrote controller profile: {path}>")
+
+
+##############################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Tune the PI controller gains offline.")
+    parser.add_argument("traces", nargs="*", help="recorded guide sessions (.npy, .csv or .txt)")
+    parser.add_argument("--simulate", type=float, default=0, metavar="SECONDS",
+                        help="tune on an unguided run of the mount simulator instead")
+    parser.add_argument("-o", "--output", default=PROFILE_PATH, help="profile to write")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="number of processes")
+    parser.add_argument("--threshold", type=float, default=0.3, help="integral threshold")
+    parser.add_argument("--effort", type=float, default=0, help="weight of actuator effort in the cost")
+    args = parser.parse_args()
+
+    plantGains = (1.0, 1.0)
+    traces = [load_trace(path) for path in args.traces]
+
+    # calibrate against the simulated mount and record its error trace
+    if args.simulate:
+        from simulator import GuideSimulation
+        sim = GuideSimulation(render=False)
+        if not (sim.acquire() and sim.calibrate()):
+            exit("<ERROR: simulator calibration failed>")
+        traces.append((sim.record_trace(args.simulate), None))
+        plantGains = sim.plant_gains()
+
+    if not traces:
+        parser.error("no traces given")
+
+    profile = tune(traces, workers=args.workers, intThreshold=args.threshold,
+                   effortWeight=args.effort, plantGains=plantGains)
+    write_profile(profile, args.output)
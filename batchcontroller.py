@@ -0,0 +1,141 @@
+##############################################################################
+#                             batchcontroller.py                             #
+##############################################################################
+
+import numpy as np
+
+##############################################################################
+class BatchController:
+    """A vectorized version of the PI(D) law in controller.py. Every gain and
+    threshold is an array along a parameter axis, so a single call evaluates
+    thousands of controller configurations at once. Used to replay recorded
+    error traces when sweeping the gains of one motor axis."""
+
+    ####################################################################
+    def __init__(self, propGains, intGains, derivGains=0, intThresholds=0.3, scale=1000, maxRate=1.0):
+        """Create a batch of controllers, one per entry of the broadcast
+        gain and threshold arrays."""
+
+        (self.propGains, self.intGains, self.derivGains, self.intThresholds) = \
+            (np.array(arr, dtype=float) for arr in np.broadcast_arrays(
+                np.atleast_1d(propGains), np.atleast_1d(intGains),
+                np.atleast_1d(derivGains), np.atleast_1d(intThresholds)))
+
+        self.scale = scale
+        self.maxRate = maxRate
+        self.size = self.propGains.size
+        self.reset()
+
+    ####################################################################
+    def __len__(self):
+        return self.size
+
+    ####################################################################
+    @classmethod
+    def grid(cls, propGains, intGains, derivGains=(0,), intThresholds=(0.3,), scale=1000, maxRate=1.0):
+        """Create a batch covering every combination of the given gain and
+        threshold values (the cartesian product, flattened)."""
+
+        axes = np.meshgrid(propGains, intGains, derivGains, intThresholds, indexing="ij")
+        return cls(*(axis.ravel() for axis in axes), scale=scale, maxRate=maxRate)
+
+    ####################################################################
+    def reset(self):
+        """Clear the accumulated and previous error of every controller."""
+        self.errSum = np.zeros(self.size)
+        self.prevErr = np.zeros(self.size)
+
+    ####################################################################
+    def calculate(self, err):
+        """Output the motor rate of every controller for the current error,
+        which is either a scalar or one error per controller. Mirrors
+        Controller.calculate for one frame interval without latency,
+        including the anti-windup and rounding."""
+
+        err = np.broadcast_to(np.asarray(err, dtype=float), (self.size,))
+
+        propTerm = self.propGains * err
+        derivTerm = self.derivGains * (err - self.prevErr)
+        self.prevErr = err.copy()
+
+        # clamp the integral so its scaled contribution stays below threshold
+        sumLimit = np.divide(self.intThresholds * self.scale, self.intGains,
+                             out=np.full(self.size, np.inf), where=self.intGains > 0)
+        newSum = np.clip(self.errSum + err, -sumLimit, sumLimit)
+        rate = (propTerm + derivTerm + self.intGains * newSum) / self.scale
+
+        # while saturated, don't integrate error that pushes further into saturation
+        hold = (np.abs(rate) > self.maxRate) & (err * rate > 0)
+        newSum[hold] = self.errSum[hold]
+        rate = (propTerm + derivTerm + self.intGains * newSum) / self.scale
+        self.errSum = newSum
+
+        return np.round(np.clip(rate, -self.maxRate, self.maxRate), 3)
+
+    ####################################################################
+    def simulate(self, errors, rates=None, plantGain=1.0):
+        """Replay a recorded error trace of one axis in closed loop through
+        every controller in the batch.
+
+        The disturbance acting on the mount is reconstructed from the trace
+        (and from the rates that were commanded while it was recorded, if
+        given). Each controller then corrects that disturbance, where a rate
+        of 1 for one update changes the error by plantGain. Returns a dict
+        of arrays along the parameter axis:
+            + rms    - root mean square error
+            + peak   - peak absolute error
+            + effort - mean absolute motor rate
+        """
+
+        errors = np.asarray(errors, dtype=float)
+        nSteps = errors.size
+
+        # open loop disturbance between consecutive samples
+        disturbance = np.diff(errors, append=errors[-1])
+        if rates is not None:
+            disturbance[:-1] += plantGain * np.asarray(rates, dtype=float)[:nSteps - 1]
+
+        self.reset()
+        err = np.full(self.size, errors[0])
+        sqSum = np.zeros(self.size)
+        peak = np.zeros(self.size)
+        effort = np.zeros(self.size)
+
+        # unstable gain combinations are allowed to blow up to inf/nan
+        with np.errstate(over="ignore", invalid="ignore"):
+            for step in range(nSteps):
+                sqSum += err * err
+                np.maximum(peak, np.abs(err), out=peak)
+
+                rate = self.calculate(err)
+                effort += np.abs(rate)
+
+                err = err + disturbance[step] - plantGain * rate
+
+        return {"rms": np.sqrt(sqSum / nSteps),
+                "peak": peak,
+                "effort": effort / nSteps}
+
+    ####################################################################
+    def params(self, index):
+        """Return the gains and threshold of a single controller in the batch."""
+        return {"propGain": float(self.propGains[index]),
+                "intGain": float(self.intGains[index]),
+                "derivGain": float(self.derivGains[index]),
+                "intThreshold": float(self.intThresholds[index])}
+
+
+##############################################################################
+if __name__ == "__main__":
+
+    # sweep a synthetic trace of drift plus periodic error
+    import time
+    t = np.arange(3600)
+    trace = 0.01 * t + 5 * np.sin(2 * np.pi * t / 480) + np.random.normal(0, 0.5, t.size)
+
+    batch = BatchController.grid(np.linspace(0, 1000, 100), np.linspace(0, 200, 100))
+    start = time.perf_counter()
+    results = batch.simulate(trace)
+    best = np.argmin(results["rms"])
+    print(f"<{len(batch)} combinations in {time.perf_counter() - start:.2f} s>")
+    print(f"<best: {batch.params(best)}, rms {results['rms'][best]:.3f}>")
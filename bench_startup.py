@@ -0,0 +1,80 @@
+##############################################################################
+#                              bench_startup.py                              #
+##############################################################################
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Modules main.py imports before the window can show, in import order
+STARTUP_MODULES = ("tkinter", "gui")
+
+# Modules that must not be imported at startup (loaded on first use)
+LAZY_MODULES = ("scipy", "matplotlib", "http.server", "serial")
+
+##############################################################################
+def cold_import(modules=STARTUP_MODULES):
+    """Import modules in a fresh interpreter. Return the wall time of the
+    imports in seconds, the slowest modules as (seconds, name), and the
+    lazily loaded modules that got imported anyway."""
+
+    code = f"import sys, time\n" \
+           f"start = time.perf_counter()\n" \
+           f"import {', '.join(modules)}\n" \
+           f"print(time.perf_counter() - start)\n" \
+           f"print(' '.join(name for name in {LAZY_MODULES!r} if name in sys.modules))\n"
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+    (elapsed, eager) = result.stdout.splitlines()[-2:]
+
+    # -X importtime lines: "import time: self [us] | cumulative | name"
+    cumulative = []
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and fields[1].strip().isdigit():
+            cumulative.append((int(fields[1]) / 1e6, fields[2].rstrip()))
+    slowest = sorted(cumulative, reverse=True)[:10]
+
+    return float(elapsed), slowest, eager.split()
+
+##############################################################################
+def benchmark(runs=5, budget=0.5):
+    """Time runs cold imports of the startup modules. Return True if the
+    median is within budget seconds and no lazy module was imported."""
+
+    times, slowest, eager = [], [], []
+    for i in range(runs):
+        (elapsed, slowest, eager) = cold_import()
+        times.append(elapsed)
+
+    median = statistics.median(times)
+    print(f"\tcold start imports:\tmedian {median:.3f} s, min {min(times):.3f} s "
+          f"({runs} runs, budget {budget:.3f} s)")
+    print("\tslowest imports (cumulative):")
+    for (seconds, name) in slowest:
+        print(f"\t\t{seconds:.3f} s\t{name}")
+
+    ok = True
+    if eager:
+        print(f"<ERROR: imported at startup: {', '.join(eager)}>")
+        ok = False
+    if median > budget:
+        print(f"<ERROR: cold start over budget by {median - budget:.3f} s>")
+        ok = False
+    return ok
+
+
+##############################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the import time of starting main.py.")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts to time")
+    parser.add_argument("--budget", type=float, default=0.5, help="median seconds allowed")
+    args = parser.parse_args()
+
+    if not benchmark(args.runs, args.budget):
+        exit(1)
@@ -3,7 +3,6 @@
 ##############################################################################
 
 import numpy as np
-import matplotlib.pyplot as plt
 import math
 
 ##############################################################################
@@ -31,24 +30,57 @@ class Calibration:
         # convert from pixel error to motor error
         self.conversion = np.array(([0, 0], [0, 0]))
 
-        # number of samples for each motor
+        # fitted motor travel -> pixel displacement matrix and fit quality
+        self.pixelMatrix = np.zeros((2, 2))
+        self.inliers = None
+        self.residuals = None
+        self.residualRMS = 0.0
+        self.orthoError = 0.0
+        self.condition = 0.0
+
+        # number of samples to aim for on each motor, and the limits on it:
+        # a motor steps until the star has moved targetDistance pixels, or
+        # its fit has converged after at least minSamples
         self.nSamples = 10
+        self.minSamples = 5
+        self.maxSamples = 40
+        self.targetDistance = 25
+        self.convergeTol = 0.02
 
         # motor data points, where data points are (x_i, y_i, sigma_i)
-        # and sigma_i is the amplitude of the motor rate
-        self.RAmotor = np.zeros((self.nSamples, 3))
-        self.DECmotor = np.zeros((self.nSamples, 3))
-
-        # Calibration rates for each motor
+        # and sigma_i is the motor travel commanded after the frame
+        # (the rate times the time until the next frame)
+        self.RAmotor = np.zeros((self.maxSamples, 3))
+        self.DECmotor = np.zeros((self.maxSamples, 3))
+        self.RACount = 0
+        self.DECCount = 0
+
+        # Calibration rates for each motor, adapted so the star moves the
+        # target distance in about nSamples steps
         self.RACalRate = 0.3
         self.DECCalRate = 0.1
+        self.minCalRate = 0.01
+        self.maxCalRate = 1.0
+
+        # Closed-loop return to the origin along each fitted motor axis
+        self.returnGain = 0.7
+        self.returnTolerance = 2
+        self.maxReturnSteps = 20
+
+        # Fitted pixel displacement per unit of travel for each motor
+        self.RASlope = None
+        self.DECSlope = None
 
         # Current rate for each motor
         self.RARate = 0
         self.DECRate = 0
 
-        # Current sample number
+        # Current sample number, time of the latest sample, and whether
+        # the current OUT/IN state has finished
         self.index = 0
+        self.sampleTime = None
+        self.prevSlope = None
+        self.phaseDone = False
 
         # Where are we in the calibration
         self.state = self.IDLE
@@ -57,15 +89,30 @@ class Calibration:
     def __str__(self):
         return f"\nConversion Matrix: \n{self.conversion}"   \
                f"\nRA Motor Sample Points:\n{self.RAmotor}"   \
-               f"\nDEC Motor Sample Points:\n{self.DECmotor}"
+               f"\nDEC Motor Sample Points:\n{self.DECmotor}" \
+               f"\nResidual RMS: {self.residualRMS:.3f} px"    \
+               f"\nOrthogonality Error: {self.orthoError:.2f}°" \
+               f"\nCondition Number: {self.condition:.2f}"
 
     ####################################################################
-    def add_data_point(self, COM, sigma, motor):
-        """Add an (x, y) tuple to the specified motor's calibration data."""
-        if motor is 'RA':
-            self.RAmotor[self.index] = (COM[0], COM[1], sigma)
-        elif motor is 'DEC':
-            self.DECmotor[self.index] = (COM[0], COM[1], sigma)
+    def add_data_point(self, COM, sigma, motor, timestamp=None):
+        """Add an (x, y) tuple to the specified motor's calibration data.
+        sigma is the rate commanded after this frame, which becomes travel
+        once the next frame's timestamp shows how long it was applied."""
+
+        samples, count = (self.RAmotor, self.RACount) if motor == 'RA' \
+            else (self.DECmotor, self.DECCount)
+
+        # the previous rate was applied from its frame until this one
+        if count > 0 and timestamp is not None and self.sampleTime is not None:
+            samples[count - 1, 2] *= timestamp - self.sampleTime
+        self.sampleTime = timestamp
+
+        samples[count] = (COM[0], COM[1], sigma)
+        if motor == 'RA':
+            self.RACount += 1
+        else:
+            self.DECCount += 1
 
     ####################################################################
     def set_rates(self, RARate, DECRate):
@@ -77,36 +124,30 @@ class Calibration:
         """Map pixel rates to motor rates with conversion matrix"""
         return np.dot(self.conversion, COM)
 
+    ####################################################################
+    def axis_slope(self, samples):
+        """Fit the pixel displacement per unit of travel of one motor from
+        its (x, y, travel) samples, with a starting offset."""
+
+        travel = np.cumsum(samples[:, 2]) - samples[:, 2]
+        design = np.column_stack((travel, np.ones(len(samples))))
+        return np.linalg.lstsq(design, samples[:, :2], rcond=None)[0][0]
+
     ####################################################################
     def execute(self, UART, status):
         """Set the output rates based on the current state. Add a data point to the sample """
 
+        # move a motor out until the star has moved far enough
+        if self.state == self.RA_OUT or self.state == self.DEC_OUT:
+            self.step_out('RA' if self.state == self.RA_OUT else 'DEC', status)
+
+        # bring the star back to the origin along the fitted motor axis
+        elif self.state == self.RA_IN or self.state == self.DEC_IN:
+            self.step_in('RA' if self.state == self.RA_IN else 'DEC', status)
+
         # don't move in idle, buffer states, or done
-        if self.state is self.IDLE\
-            or self.state is self.BUF_0\
-            or self.state is self.BUF_1\
-            or self.state is self.BUF_2\
-            or self.state is self.BUF_3\
-            or self.state is self.DONE:
-                self.set_rates(0, 0)
-
-        # rotator calibration rate for RA motor
-        elif self.state is self.RA_OUT:
-            self.set_rates(self.RACalRate, 0)
-            self.add_data_point(status.COM, self.RARate, 'RA')
-
-        # negative rotator calibration rate for RA motor
-        elif self.state is self.RA_IN:
-            self.set_rates(-1 * self.RACalRate, 0)
-
-        # declination calibration rate for DEC motor
-        elif self.state is self.DEC_OUT:
-            self.set_rates(0, self.DECCalRate)
-            self.add_data_point(status.COM, self.DECRate, 'DEC')
-
-        # negative declination calibration rate for DEC motor
-        elif self.state is self.DEC_IN:
-            self.set_rates(0, -1 * self.DECCalRate)
+        else:
+            self.set_rates(0, 0)
 
         # transmit rates to microcontroller
         UART.transmit(self.RARate, self.DECRate)
@@ -114,106 +155,259 @@ class Calibration:
         # increment state index
         self.index = self.index + 1
 
+    ####################################################################
+    def step_out(self, motor, status):
+        """Record a sample of a motor moving out, adapt its rate, and
+        finish once the star moved targetDistance pixels or the fit of the
+        motor axis stopped changing."""
+
+        rate = self.RACalRate if motor == 'RA' else self.DECCalRate
+
+        # frames where the guide star was lost don't tell us anything
+        if status.mode != status.LOCKED:
+            self.hold(motor, status.timestamp)
+            return
+
+        # the rate of the sample is filled in below, once it has been adapted
+        self.add_data_point(status.COM, 0, motor, status.timestamp)
+
+        samples = self.RAmotor[:self.RACount] if motor == 'RA' else self.DECmotor[:self.DECCount]
+        count = len(samples)
+        distance = np.hypot(*(samples[-1, :2] - samples[0, :2])) if count else 0
+
+        if count >= 3:
+            slope = self.axis_slope(samples)
+            pxPerTravel = np.hypot(*slope)
+
+            # converged once the fitted axis stops changing between samples
+            converged = self.prevSlope is not None and count >= self.minSamples \
+                and np.hypot(*(slope - self.prevSlope)) <= self.convergeTol * pxPerTravel
+            self.prevSlope = slope
+
+            if distance >= self.targetDistance or converged or count >= self.maxSamples:
+                self.phaseDone = True
+
+            # choose the rate that covers the target distance in about nSamples
+            # steps, changing it by at most a factor of 2 per step
+            elif pxPerTravel > 0:
+                wanted = self.targetDistance / (pxPerTravel * self.nSamples)
+                rate = min(max(wanted, rate / 2, self.minCalRate), rate * 2, self.maxCalRate)
+
+        elif count >= self.maxSamples:
+            self.phaseDone = True
+
+        # the sample's travel is the rate actually sent to the motor
+        sent = 0 if self.phaseDone else rate
+        samples[-1, 2] = sent
+
+        if motor == 'RA':
+            self.RACalRate = rate
+            self.set_rates(sent, 0)
+        else:
+            self.DECCalRate = rate
+            self.set_rates(0, sent)
+
+    ####################################################################
+    def hold(self, motor, timestamp):
+        """Stop the motors while the guide star is lost. The travel of the
+        latest sample ends at this frame, so the stop isn't counted in it."""
+
+        samples, count = (self.RAmotor, self.RACount) if motor == 'RA' \
+            else (self.DECmotor, self.DECCount)
+        if count > 0 and timestamp is not None and self.sampleTime is not None:
+            samples[count - 1, 2] *= timestamp - self.sampleTime
+            self.sampleTime = None
+        self.set_rates(0, 0)
+
+    ####################################################################
+    def step_in(self, motor, status):
+        """Move a motor back towards the origin in proportion to how far
+        the star still is along that motor's axis."""
+
+        # where the star is isn't known while it's lost
+        if status.mode != status.LOCKED:
+            self.set_rates(0, 0)
+            return
+
+        slope = self.RASlope if motor == 'RA' else self.DECSlope
+        along = np.dot(status.COM, slope) / np.dot(slope, slope)     # in travel
+        distance = abs(along) * np.hypot(*slope)                    # in pixels
+
+        if distance < self.returnTolerance or self.index >= self.maxReturnSteps:
+            rate = 0
+            self.phaseDone = True
+        else:
+            rate = max(-self.maxCalRate, min(self.maxCalRate, -self.returnGain * along))
+
+        self.set_rates(rate, 0) if motor == 'RA' else self.set_rates(0, rate)
+
+    ####################################################################
+    def finish_axis(self, motor):
+        """Trim the unused sample rows of a motor and keep its fitted axis."""
+
+        if motor == 'RA':
+            self.RAmotor = self.RAmotor[:self.RACount]
+            self.RASlope = self.axis_slope(self.RAmotor)
+        else:
+            self.DECmotor = self.DECmotor[:self.DECCount]
+            self.DECSlope = self.axis_slope(self.DECmotor)
+
+    ####################################################################
+    def reset(self):
+        """Start the calibration sequence over: back to IDLE, without any
+        samples. The conversion matrix is kept until a new one is fitted."""
+
+        self.RAmotor = np.zeros((self.maxSamples, 3))
+        self.DECmotor = np.zeros((self.maxSamples, 3))
+        self.RACount = 0
+        self.DECCount = 0
+        self.RASlope = None
+        self.DECSlope = None
+        self.set_rates(0, 0)
+        self.enter(self.IDLE)
+
+    ####################################################################
+    def enter(self, state, name=None):
+        """Move to a new state with a fresh index."""
+        self.state = state
+        self.index = 0
+        self.phaseDone = False
+        self.prevSlope = None
+        self.sampleTime = None
+        if name is not None:
+            print(f"\t<{name}>")
+
     ####################################################################
     def next_state(self):
         """Next state logic that keeps track of where we are in the calibration."""
 
         # called upon first call to calibrate()
-        if self.state is self.IDLE:
-            self.state = self.BUF_0
-            self.index = 0
-            print("\t<IDLE>")
-
-        # wait for 3 updates
-        elif self.state is self.BUF_0 and self.index is self.SHORT_WAIT:
-            self.state = self.RA_OUT
-            self.index = 0
-            print("\t<RA_OUT>")
-
-        # take nSamples for RA motor
-        elif self.state is self.RA_OUT and self.index is self.nSamples:
-            self.state = self.BUF_1
-            self.index = 0
-            print("\t<IDLE>")
-
-        # wait for 3 updates
-        elif self.state is self.BUF_1 and self.index is self.SHORT_WAIT:
-            self.state = self.RA_IN
-            self.index = -1 * self.nSamples
-            print("\t<RA_IN>")
-
-        # move back to origin for nSamples updates
-        elif self.state is self.RA_IN and self.index is 0:
-            self.state = self.BUF_2
-            self.index = 0 # unneeded
-
-        # wait for 5 updates (***User must center guide star on origin during this period)
-        elif self.state is self.BUF_2 and self.index is self.LONG_WAIT:
-            self.state = self.DEC_OUT
-            self.index = 0
-            print("\t<DEC_OUT>")
-
-        # take nSamples samples for DEC Motor
-        elif self.state is self.DEC_OUT and self.index is self.nSamples:
-            self.state = self.BUF_3
-            self.index = 0
-
-        # wait for 3 updates
-        elif self.state is self.BUF_3 and self.index is self.SHORT_WAIT:
-            self.state = self.DEC_IN
-            self.index = -1 * self.nSamples
-            print("\t<DEC_IN>")
-
-        # move back to origin for 10 updates
-        elif self.state is self.DEC_IN and self.index is 0:
-            self.state = self.DONE
-            self.index = 0
-            print("\t<DONE>")
+        if self.state == self.IDLE:
+            self.enter(self.BUF_0, "IDLE")
 
-    ####################################################################
-    def least_squares(self):
+        # wait before moving
+        elif self.state == self.BUF_0 and self.index >= self.SHORT_WAIT:
+            self.enter(self.RA_OUT, "RA_OUT")
 
-        # Get test data from calibration instance
-        RASamples = self.RAmotor.shape[0]
-        DECSamples = self.DECmotor.shape[0]
+        # step the RA motor out until it has moved far enough or converged
+        elif self.state == self.RA_OUT and self.phaseDone:
+            self.finish_axis('RA')
+            self.enter(self.BUF_1)
 
-        # Warn user if number of samples doesn't match
-        if RASamples is not DECSamples:
-            print("<WARNING: # RASamples doesn't equal DECSamples")
+        # wait before moving back
+        elif self.state == self.BUF_1 and self.index >= self.SHORT_WAIT:
+            self.enter(self.RA_IN, "RA_IN")
 
-        aNum = np.zeros(RASamples)
-        bNum = np.zeros(RASamples)
-        sigArr = np.zeros(RASamples)
+        # move back to origin
+        elif self.state == self.RA_IN and self.phaseDone:
+            self.enter(self.BUF_2)
 
-        print(self.RAmotor)
-        print(self.DECmotor)
+        # wait before moving the DEC motor
+        elif self.state == self.BUF_2 and self.index >= self.LONG_WAIT:
+            self.enter(self.DEC_OUT, "DEC_OUT")
 
-        # Compute least squares to get a, b, c, and d constants
-        for i in range(RASamples):
-            aNum[i] = self.RAmotor[i][0] * self.RAmotor[i][2]
-            bNum[i] = self.RAmotor[i][1] * self.RAmotor[i][2]
-            sigArr[i] = self.RAmotor[i][2] ** 2
-        a, b = sum(aNum) / sum(sigArr), sum(bNum) / sum(sigArr)
+        # step the DEC motor out until it has moved far enough or converged
+        elif self.state == self.DEC_OUT and self.phaseDone:
+            self.finish_axis('DEC')
+            self.enter(self.BUF_3)
 
-        for i in range(DECSamples):
-            aNum[i] = self.DECmotor[i][0] * self.DECmotor[i][2]
-            bNum[i] = self.DECmotor[i][1] * self.DECmotor[i][2]
-            sigArr[i] = self.DECmotor[i][2] ** 2
-        c, d = sum(aNum) / sum(sigArr), sum(bNum) / sum(sigArr)
+        # wait before moving back
+        elif self.state == self.BUF_3 and self.index >= self.SHORT_WAIT:
+            self.enter(self.DEC_IN, "DEC_IN")
 
-        # create a numpy array
-        array = np.array(([a, b], [c, d]))
+        # move back to origin
+        elif self.state == self.DEC_IN and self.phaseDone:
+            self.enter(self.DONE, "DONE")
 
-        # Find conversion matrix with SVD
-        u, s, vh = np.linalg.svd(array, full_matrices=True)
-        self.conversion = np.dot(u * s, vh)
+    ####################################################################
+    def least_squares(self, clip=3.0, maxIter=5, minSigma=0.5, weights=None):
+        """Fit the full 2x2 model mapping motor travel to pixel displacement,
+        and invert it to get the conversion matrix.
+
+        The sample rows are (x_i, y_i, sigma_i), where sigma_i is the motor
+        travel commanded after the frame, so the travel at sample i is the
+        sum of the travel before it. Both motors are fitted in one weighted least
+        squares call, with a separate starting offset for each motor's
+        samples:
+            [x_i, y_i] = M [RA travel_i, DEC travel_i] + offset
+
+        Samples whose residual is more than clip robust standard deviations
+        (never below minSigma pixels) are rejected and the fit repeated,
+        until the inliers stop changing. Return True on success."""
+
+        # design matrix columns: RA travel, DEC travel, RA offset, DEC offset
+        nRA, nDEC = len(self.RAmotor), len(self.DECmotor)
+        design = np.zeros((nRA + nDEC, 4))
+        design[:nRA, 0] = np.cumsum(self.RAmotor[:, 2]) - self.RAmotor[:, 2]
+        design[nRA:, 1] = np.cumsum(self.DECmotor[:, 2]) - self.DECmotor[:, 2]
+        design[:nRA, 2] = 1
+        design[nRA:, 3] = 1
+        pixels = np.vstack((self.RAmotor[:, :2], self.DECmotor[:, :2]))
+        isRA = np.arange(nRA + nDEC) < nRA
+
+        weights = np.ones(nRA + nDEC) if weights is None else np.asarray(weights, dtype=float)
+        inliers = weights > 0
+
+        for i in range(maxIter):
+            # weighted fit of both pixel coordinates at once
+            rootW = np.sqrt(weights * inliers)[:, np.newaxis]
+            coeffs = np.linalg.lstsq(design * rootW, pixels * rootW, rcond=None)[0]
+            residuals = np.linalg.norm(pixels - design @ coeffs, axis=1)
+
+            # robust spread of the inlier residuals (MAD), then clip
+            sigma = max(1.4826 * np.median(residuals[inliers]), minSigma)
+            newInliers = (residuals < clip * sigma) & (weights > 0)
+
+            # keep enough samples on each motor to define its axis
+            if np.sum(newInliers & isRA) < 3 or np.sum(newInliers & ~isRA) < 3:
+                break
+            if np.array_equal(newInliers, inliers):
+                break
+            inliers = newInliers
+
+        self.inliers = inliers
+        self.residuals = residuals
+        self.residualRMS = float(np.sqrt(np.mean(residuals[inliers] ** 2)))
+        self.condition = float(np.linalg.cond(coeffs[:2]))
+
+        # deviation of the angle between the two motor axes from 90 degrees
+        (ra, dec) = coeffs[:2]
+        cosAngle = ra @ dec / (np.linalg.norm(ra) * np.linalg.norm(dec) or 1)
+        self.orthoError = float(abs(90 - math.degrees(math.acos(np.clip(cosAngle, -1, 1)))))
+
+        return self.set_matrix(coeffs[:2].T)
 
-        # negate y-axis for consistency
-        self.conversion = self.conversion * np.array(([-1, -1], [-1, -1]))
+    ####################################################################
+    def set_matrix(self, pixelMatrix):
+        """Set the motor travel -> pixel displacement matrix, and the
+        conversion matrix mapping a pixel error to the travel that cancels
+        it. Return False if the matrix can't be inverted."""
+
+        self.pixelMatrix = np.asarray(pixelMatrix, dtype=float)
+        try:
+            self.conversion = -np.linalg.inv(self.pixelMatrix)
+        except np.linalg.LinAlgError:
+            print("<WARNING: calibration is singular, did the star move?>")
+            self.conversion = np.zeros((2, 2))
+            return False
+        return True
+
+    ####################################################################
+    def load(self, pixelMatrix):
+        """Use a pixel matrix from elsewhere (e.g. the calibration cache)
+        as a finished calibration. Return False if it can't be inverted."""
+
+        if not self.set_matrix(pixelMatrix):
+            return False
+        self.enter(self.DONE)
+        return True
 
 ####################################################################
 def plot_calibration(ThetaData, PhiData, declination, tests):
 
+    # only the simulation plots, so matplotlib is imported here
+    import matplotlib.pyplot as plt
+
     # plot Calibration Data
     fig, (ax0, ax1) = plt.subplots(ncols=2, figsize=(20, 10))
     ax0.plot(PhiData[:, 0], PhiData[:, 1], 'rx')
@@ -0,0 +1,111 @@
+##############################################################################
+#                            calibrationcache.py                             #
+##############################################################################
+
+import json
+import math
+import os
+import time
+import numpy as np
+
+# Pier sides of a german equatorial mount
+EAST = "east"
+WEST = "west"
+
+##############################################################################
+class CalibrationCache:
+    """Calibrations saved to disk with the pointing they were taken at
+    (declination, pier side, and camera rotation), so a later session or
+    a slew to a new target can reuse one instead of recalibrating.
+
+    The DEC axis of the travel -> pixel matrix doesn't depend on where the
+    mount points, but the RA axis moves the star by cos(declination) as far
+    per unit of travel, so a reused calibration has its RA axis rescaled to
+    the new declination."""
+
+    ####################################################################
+    def __init__(self, path="calibration_cache.json", maxDecDistance=30, maxRotDistance=5,
+                 maxDeclination=85):
+        """Load the cache file if it exists.
+
+        Calibrations are only reused on the same pier side, within
+        maxRotDistance degrees of camera rotation and maxDecDistance degrees
+        of declination, and never near the pole (beyond maxDeclination)
+        where the cos(declination) rescaling breaks down."""
+
+        self.path = path
+        self.maxDecDistance = maxDecDistance
+        self.maxRotDistance = maxRotDistance
+        self.maxDeclination = maxDeclination
+        self.entries = []
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    ####################################################################
+    def __len__(self):
+        return len(self.entries)
+
+    ####################################################################
+    def save(self, calibration, declination, pierSide, rotation):
+        """Store a finished calibration, replacing any taken at (nearly)
+        the same pointing, and write the cache to disk."""
+
+        self.entries = [entry for entry in self.entries if not (
+            entry["pierSide"] == pierSide
+            and abs(entry["declination"] - declination) < 1
+            and rotation_distance(entry["rotation"], rotation) < 1)]
+
+        self.entries.append({"declination": declination,
+                             "pierSide": pierSide,
+                             "rotation": rotation,
+                             "pixelMatrix": np.asarray(calibration.pixelMatrix).tolist(),
+                             "residualRMS": calibration.residualRMS,
+                             "time": time.time()})
+
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(tmpPath, self.path)
+
+    ####################################################################
+    def lookup(self, declination, pierSide, rotation):
+        """Return the travel -> pixel matrix of the nearest stored
+        calibration, rescaled to declination, or None if none is close
+        enough."""
+
+        if abs(declination) > self.maxDeclination:
+            return None
+
+        candidates = [entry for entry in self.entries
+                      if entry["pierSide"] == pierSide
+                      and abs(entry["declination"]) <= self.maxDeclination
+                      and abs(entry["declination"] - declination) <= self.maxDecDistance
+                      and rotation_distance(entry["rotation"], rotation) <= self.maxRotDistance]
+        if not candidates:
+            return None
+
+        # nearest in declination, then the most recent
+        nearest = min(candidates, key=lambda entry: (abs(entry["declination"] - declination),
+                                                     -entry["time"]))
+
+        pixelMatrix = np.array(nearest["pixelMatrix"])
+        pixelMatrix[:, 0] *= math.cos(math.radians(declination)) \
+            / math.cos(math.radians(nearest["declination"]))
+        return pixelMatrix
+
+    ####################################################################
+    def apply(self, calibration, declination, pierSide, rotation):
+        """Load the nearest stored calibration into a Calibration. Return
+        True if one was found."""
+
+        pixelMatrix = self.lookup(declination, pierSide, rotation)
+        if pixelMatrix is None:
+            return False
+        return calibration.load(pixelMatrix)
+
+##############################################################################
+def rotation_distance(a, b):
+    """Smallest angle in degrees between two camera rotations."""
+    return abs((a - b + 180) % 360 - 180)
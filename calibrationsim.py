@@ -0,0 +1,186 @@
+##############################################################################
+#                              calibrationsim.py                             #
+##############################################################################
+
+import argparse
+import itertools
+import os
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from calibration import Calibration
+from simulator import MountModel
+
+# Statistics aggregated for every scenario of a sweep
+STATS = ("gainError", "gainErrorP95", "angleError", "scaleError", "residualRMS", "failures")
+
+##############################################################################
+def make_samples(pixelMatrix, nSamples, noise, rng, targetDistance, maxTravel):
+    """Calibration samples of both motors as the sequencer would record
+    them: each motor steps out so the star moves about targetDistance
+    pixels in nSamples steps (at most maxTravel per step), with gaussian
+    centroid noise of noise pixels. Returns the RA and DEC sample arrays."""
+
+    motors = []
+    start = np.zeros(2)
+    for axis in range(2):
+        column = pixelMatrix[:, axis]
+        step = min(targetDistance / (np.linalg.norm(column) * nSamples), maxTravel)
+
+        travel = step * np.arange(nSamples)
+        positions = start + np.outer(travel, column) + rng.normal(0, noise, (nSamples, 2))
+        motors.append(np.column_stack((positions, np.full(nSamples, step))))
+
+        # the return leg doesn't quite make it back to the origin
+        start = rng.normal(0, 2, 2)
+    return motors
+
+##############################################################################
+def run_scenario(args):
+    """Process pool worker: calibrate trials times at one declination,
+    rotation, noise level, and sample count, and return the error of each
+    trial as a dict of arrays."""
+
+    declination, rotation, noise, nSamples, trials, seed = args
+    rng = np.random.default_rng(seed)
+    truth = MountModel(declination=declination, rotation=rotation, seed=seed).pixel_matrix()
+
+    errors = {key: np.full(trials, np.nan) for key in ("gainError", "angleError",
+                                                       "scaleError", "residualRMS")}
+    failures = 0
+    for trial in range(trials):
+        cal = Calibration()
+        cal.RAmotor, cal.DECmotor = make_samples(truth, nSamples, noise, rng,
+                                                 cal.targetDistance, cal.maxCalRate)
+        if not cal.least_squares():
+            failures += 1
+            continue
+
+        # loop gain error: the identity for a perfect calibration
+        errors["gainError"][trial] = np.linalg.norm(-cal.conversion @ truth - np.eye(2))
+
+        # worst axis direction and length error of the fitted matrix
+        fitAngles = np.arctan2(cal.pixelMatrix[1], cal.pixelMatrix[0])
+        trueAngles = np.arctan2(truth[1], truth[0])
+        errors["angleError"][trial] = np.degrees(np.max(np.abs(
+            (fitAngles - trueAngles + np.pi) % (2 * np.pi) - np.pi)))
+        errors["scaleError"][trial] = np.max(np.abs(
+            np.linalg.norm(cal.pixelMatrix, axis=0) / np.linalg.norm(truth, axis=0) - 1))
+        errors["residualRMS"][trial] = cal.residualRMS
+
+    errors["failures"] = failures
+    return errors
+
+##############################################################################
+def sweep(declinations, rotations, noises, sampleCounts, trials=100, workers=None, seed=0):
+    """Run every combination of the parameter lists across a process pool.
+
+    Returns a dict with the parameter lists and, for each of STATS, an
+    array of shape (declinations, rotations, noises, sampleCounts): mean
+    loop gain error (and its 95th percentile), mean axis angle error in
+    degrees, mean axis scale error, mean residual RMS, and the fraction of
+    failed calibrations."""
+
+    grid = list(itertools.product(declinations, rotations, noises, sampleCounts))
+    jobs = [(*params, trials, seed + i) for (i, params) in enumerate(grid)]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        scenarios = list(pool.map(run_scenario, jobs, chunksize=max(1, len(jobs) // 64)))
+
+    shape = (len(declinations), len(rotations), len(noises), len(sampleCounts))
+    results = {"declinations": np.asarray(declinations, dtype=float),
+               "rotations": np.asarray(rotations, dtype=float),
+               "noises": np.asarray(noises, dtype=float),
+               "sampleCounts": np.asarray(sampleCounts),
+               "trials": trials}
+
+    for stat in STATS:
+        results[stat] = np.zeros(len(grid))
+    for i, errors in enumerate(scenarios):
+        solved = errors["gainError"][np.isfinite(errors["gainError"])]
+        results["gainError"][i] = np.mean(solved) if len(solved) else np.nan
+        results["gainErrorP95"][i] = np.percentile(solved, 95) if len(solved) else np.nan
+        for stat in ("angleError", "scaleError", "residualRMS"):
+            results[stat][i] = np.nanmean(errors[stat]) if len(solved) else np.nan
+        results["failures"][i] = errors["failures"] / trials
+
+    for stat in STATS:
+        results[stat] = results[stat].reshape(shape)
+    return results
+
+##############################################################################
+def plot_summary(results, directory="."):
+    """Write summary plots of a sweep as PNG files. Return their paths."""
+
+    decs, rots = results["declinations"], results["rotations"]
+    noises, counts = results["noises"], results["sampleCounts"]
+    paths = []
+
+    # loop gain error against declination for each noise level
+    fig, ax = plt.subplots(figsize=(8, 6))
+    for k, noise in enumerate(noises):
+        ax.plot(decs, results["gainError"][:, :, k, -1].mean(axis=1), 'o-', label=f"{noise:g} px")
+    ax.set_title(f"Calibration Loop Gain Error ({counts[-1]} samples per motor)")
+    ax.set_xlabel("Declination (°)")
+    ax.set_ylabel("Mean Loop Gain Error")
+    ax.legend(title="Centroid Noise")
+    ax.grid()
+    paths.append(os.path.join(directory, "calibration_gain_error.png"))
+    fig.savefig(paths[-1])
+    plt.close(fig)
+
+    # loop gain error against sample count for each noise level
+    fig, ax = plt.subplots(figsize=(8, 6))
+    for k, noise in enumerate(noises):
+        ax.plot(counts, results["gainError"][:, :, k, :].mean(axis=(0, 1)), 'o-', label=f"{noise:g} px")
+        ax.plot(counts, results["gainErrorP95"][:, :, k, :].mean(axis=(0, 1)), 'x:',
+                color=ax.lines[-1].get_color())
+    ax.set_title("Calibration Loop Gain Error (mean -, 95th percentile :)")
+    ax.set_xlabel("Samples per Motor")
+    ax.set_ylabel("Loop Gain Error")
+    ax.legend(title="Centroid Noise")
+    ax.grid()
+    paths.append(os.path.join(directory, "calibration_sample_count.png"))
+    fig.savefig(paths[-1])
+    plt.close(fig)
+
+    # axis angle error over declination and rotation at the worst noise
+    fig, ax = plt.subplots(figsize=(8, 6))
+    image = ax.imshow(results["angleError"][:, :, -1, -1], origin="lower", aspect="auto",
+                      extent=(rots[0], rots[-1], decs[0], decs[-1]))
+    fig.colorbar(image, ax=ax, label="Mean Axis Angle Error (°)")
+    ax.set_title(f"Calibration Angle Error ({noises[-1]:g} px noise, {counts[-1]} samples)")
+    ax.set_xlabel("Camera Rotation (°)")
+    ax.set_ylabel("Declination (°)")
+    paths.append(os.path.join(directory, "calibration_angle_error.png"))
+    fig.savefig(paths[-1])
+    plt.close(fig)
+
+    return paths
+
+
+##############################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Monte Carlo simulation of the calibration solver.")
+    parser.add_argument("--dec", type=float, nargs="+", default=[0, 30, 60, 75, 85], help="declinations")
+    parser.add_argument("--rot", type=float, nargs="+", default=[0, 45, 90, 135, 180], help="camera rotations")
+    parser.add_argument("--noise", type=float, nargs="+", default=[0.1, 0.5, 1.0], help="centroid noise in pixels")
+    parser.add_argument("--samples", type=int, nargs="+", default=[5, 10, 20], help="samples per motor")
+    parser.add_argument("--trials", type=int, default=100, help="calibrations per scenario")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="number of processes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default="calibration_sim", help="directory for plots and results")
+    args = parser.parse_args()
+
+    results = sweep(args.dec, args.rot, args.noise, args.samples, args.trials, args.workers, args.seed)
+
+    os.makedirs(args.output, exist_ok=True)
+    np.savez(os.path.join(args.output, "results.npz"), **results)
+    for path in plot_summary(results, args.output):
+        print(f"\t<wrote {path}>")
+
+    print(f"\tWorst mean loop gain error:\t{np.nanmax(results['gainError']):.3f}")
+    print(f"\tFailed calibrations:\t\t{np.mean(results['failures']):.1%}")
@@ -9,11 +9,12 @@ import time
 class Camera:
 
     ####################################################################
-    def __init__(self, captureRate=1000):
-        """Open the USB Camera, exit on error."""
+    def __init__(self, captureRate=1000, index=0):
+        """Open the USB Camera (the first one unless index is given), exit
+        on error."""
 
         try:
-            self.cam = cv2.VideoCapture(0, cv2.CAP_DSHOW)
+            self.cam = cv2.VideoCapture(index, cv2.CAP_DSHOW)
         except:
             exit("\t<ERROR: check USB Camera connection>")
 
@@ -25,11 +26,12 @@ class Camera:
         print("<camera ready>")
 
     ####################################################################
-    def capture(self):
-        """Grab a single frame from the camera, return the cv2 image."""
+    def capture(self, image=None):
+        """Grab a single frame from the camera, return the cv2 image. Given
+        an image of the frame's shape, the frame is decoded into it."""
 
         # Capture frame-by-frame
-        ret, img = self.cam.read()
+        ret, img = self.cam.read(image)
 
         # print during frame errors
         if not ret:
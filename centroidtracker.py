@@ -5,7 +5,6 @@
 # Adapted from https://www.pyimagesearch.com/2018/07/23/simple-object-tracking-with-opencv/
 # From Adrian Rosebrock
 
-from scipy.spatial import distance as dist
 from collections import OrderedDict
 from status import Status
 import numpy as np
@@ -24,7 +23,8 @@ class CentroidTracker:
     (orgX, orgY) = (270, 265)
 
     ####################################################################
-    def __init__(self, maxDisappeared=1):
+    def __init__(self, maxDisappeared=1, maxDistance=50, promoteFrames=2, promoteDistance=8,
+                 cellSize=4, staticFrames=5, staticDistance=8, staticGap=1):
         # initialize the next unique object ID along with two ordered
         # dictionaries used to keep track of mapping a given object
         # ID to its centroid and number of consecutive frames it has
@@ -35,11 +35,51 @@ class CentroidTracker:
         self.status = Status()
         self.trackID = -1
 
+        # offset (in the dX, dY convention) of the lock position from the
+        # origin, moved by dithering
+        self.lockOffset = (0, 0)
+
         # store the number of maximum consecutive frames a given
         # object is allowed to be marked as "disappeared" until we
         # need to deregister the object from tracking
         self.maxDisappeared = maxDisappeared
 
+        # farthest (in pixels) an object may move between frames and still
+        # be matched, so a lost object doesn't take over a random detection
+        self.maxDistance = maxDistance
+
+        # new detections wait as pending tracks (positions and the number
+        # of frames they were seen in a row) until they persisted for
+        # promoteFrames frames (moving at most promoteDistance pixels per
+        # frame), so one-frame cosmic ray hits never become objects
+        self.promoteFrames = promoteFrames
+        self.promoteDistance = promoteDistance
+        self.pending = np.zeros((0, 2), dtype="int")
+        self.pendingAge = np.zeros(0, dtype="int")
+
+        # persistence map over a grid of cellSize pixel cells: for each
+        # cell the frame it last held a detection, how many frames in a row
+        # it did (allowing staticGap missed frames), and where the field
+        # was when that streak began. A cell that kept a detection for
+        # staticFrames frames while the field moved staticDistance pixels
+        # holds a hot pixel, not a star, and its detections are rejected.
+        self.cellSize = cellSize
+        self.staticFrames = staticFrames
+        self.staticDistance = staticDistance
+        self.staticGap = staticGap
+        self.lastHit = np.full((0, 0), -staticGap - 2, dtype="int")
+        self.streak = np.zeros((0, 0), dtype="int")
+        self.anchor = np.zeros((0, 0, 2))
+        self.frame = 0
+        self.rejected = 0                   # detections rejected as static so far
+
+        # where the field is, from where each object was registered (its
+        # position and the field offset then): the median of the objects'
+        # displacements since, so the estimate doesn't add up rounding
+        # noise frame after frame
+        self.fieldOffset = np.zeros(2)
+        self.bases = OrderedDict()
+
     ####################################################################
     def __str__(self):
         # center of mass relative to the image origin (orgX, orgY)
@@ -100,6 +140,12 @@ class CentroidTracker:
         self.status.mode = self.SEARCHING  # reset mode to SEARCHING if we can't find a star
         return img
 
+    ####################################################################
+    def lock_position(self):
+        """(x, y) image position the guide star is held at."""
+        return (CentroidTracker.orgX + self.lockOffset[0],
+                CentroidTracker.orgY - self.lockOffset[1])
+
     ####################################################################
     def register(self, centroid):
         """Register a centroid to be tracked"""
@@ -107,6 +153,7 @@ class CentroidTracker:
         # ID to store the centroid
         self.objects[self.nextObjectID] = centroid
         self.disappeared[self.nextObjectID] = 0
+        self.bases[self.nextObjectID] = (np.array(centroid, dtype=float), self.fieldOffset.copy())
         self.nextObjectID += 1
 
     ####################################################################
@@ -116,6 +163,7 @@ class CentroidTracker:
         # both of our respective dictionaries
         del self.objects[objectID]
         del self.disappeared[objectID]
+        del self.bases[objectID]
 
     ####################################################################
     def update(self, inputCentroids):
@@ -166,9 +214,9 @@ class CentroidTracker:
         if self.status.mode is self.LOCKED:
             newCentroid = self.objects[ID]
 
-            # displacement = newCentroid - centerPoint
-            (dx, dy) = (newCentroid[0] - CentroidTracker.orgX,
-                        CentroidTracker.orgY - newCentroid[1])
+            # displacement = newCentroid - lock position
+            (lockX, lockY) = self.lock_position()
+            (dx, dy) = (newCentroid[0] - lockX, lockY - newCentroid[1])
 
             # update the trackStar to reflect its new center of mass
             self.status.COM = newCentroid
@@ -176,12 +224,116 @@ class CentroidTracker:
         else:
             exit("\t<ERR: No star being tracked, exiting (unreachable).>")
 
+    ####################################################################
+    def reject_static(self, inputCentroids):
+        """Return the input centroids that aren't in a cell of the
+        persistence map holding a static detection."""
+
+        if len(inputCentroids) == 0 or self.streak.size == 0:
+            return inputCentroids
+
+        # grid cell (row, column) of each detection; cells beyond the map
+        # were never hit, so they can't be static
+        cells = inputCentroids[:, ::-1] // self.cellSize
+        inside = ((cells >= 0) & (cells < self.streak.shape)).all(axis=1)
+        (rows, cols) = cells[inside].T
+
+        # a streak still going on in the last frame, begun far from where
+        # the field is now
+        going = self.frame - self.lastHit[rows, cols] <= self.staticGap
+        moved = np.linalg.norm(self.fieldOffset - self.anchor[rows, cols], axis=1)
+        static = np.zeros(len(inputCentroids), dtype=bool)
+        static[inside] = going & (self.streak[rows, cols] >= self.staticFrames) \
+                         & (moved >= self.staticDistance)
+
+        # the guide star is never taken for a hot pixel
+        if self.trackID in self.objects:
+            near = np.linalg.norm(inputCentroids - self.objects[self.trackID], axis=1)
+            static &= near > self.promoteDistance
+        self.rejected += int(static.sum())
+        return inputCentroids[~static]
+
+    ####################################################################
+    def update_map(self, inputCentroids):
+        """Add the centroids detected in a frame to the persistence map,
+        once the field motion in that frame is known."""
+
+        self.frame += 1
+        if len(inputCentroids) == 0:
+            return
+
+        # grid cell (row, column) of each detection, growing the map to fit
+        cells = inputCentroids[:, ::-1] // self.cellSize
+        shape = np.maximum(cells.max(axis=0) + 1, self.streak.shape)
+        if (shape > self.streak.shape).any():
+            pad = ((0, shape[0] - self.streak.shape[0]), (0, shape[1] - self.streak.shape[1]))
+            self.lastHit = np.pad(self.lastHit, pad, constant_values=-self.staticGap - 2)
+            self.streak = np.pad(self.streak, pad)
+            self.anchor = np.pad(self.anchor, pad + ((0, 0),))
+        (rows, cols) = np.divmod(np.unique(cells[:, 0] * shape[1] + cells[:, 1]), shape[1])
+
+        # continue the streak of cells hit recently, restart the others
+        going = self.frame - self.lastHit[rows, cols] <= self.staticGap + 1
+        self.streak[rows, cols] = np.where(going, self.streak[rows, cols] + 1, 1)
+        self.anchor[rows, cols] = np.where(going[:, np.newaxis], self.anchor[rows, cols],
+                                           self.fieldOffset)
+        self.lastHit[rows, cols] = self.frame
+
+    ####################################################################
+    def promote(self, candidates):
+        """Match unassigned detections to the pending tracks, register the
+        pending tracks seen for promoteFrames frames in a row, and start
+        new pending tracks for the rest. Pending tracks not seen this frame
+        are dropped."""
+
+        candidates = np.asarray(candidates, dtype="int").reshape(-1, 2)
+        if self.promoteFrames <= 1:
+            for centroid in candidates:
+                self.register(centroid)
+            return
+
+        # nearest candidate of each pending track, within the distance a
+        # star moves between frames, the closest pairs first
+        age = np.ones(len(candidates), dtype="int")
+        if len(self.pending) and len(candidates):
+            D = np.hypot(self.pending[:, 0, np.newaxis] - candidates[np.newaxis, :, 0],
+                         self.pending[:, 1, np.newaxis] - candidates[np.newaxis, :, 1])
+            rows = D.min(axis=1).argsort()
+            cols = D.argmin(axis=1)[rows]
+            (cols, first) = np.unique(cols, return_index=True)
+            rows = rows[first]
+            near = D[rows, cols] <= self.promoteDistance
+            age[cols[near]] = self.pendingAge[rows[near]] + 1
+
+        ready = age >= self.promoteFrames
+        for centroid in candidates[ready]:
+            self.register(centroid)
+        self.pending = candidates[~ready]
+        self.pendingAge = age[~ready]
+
     ####################################################################
     def update_centroids(self, inputCentroids):
         """Match old centroids to a list of new centroids, update objects
         and disappeared objects accordingly"""
+
+        # drop detections of hot pixels, and map this frame's detections
+        # once the field motion is known
+        detections = np.asarray(inputCentroids, dtype="int").reshape(-1, 2)
+        self.match(self.reject_static(detections))
+        self.update_map(detections)
+
+        # return the set of trackable objects
+        return self.objects
+
+    ####################################################################
+    def match(self, inputCentroids):
+        """Match the objects to the input centroids, mark the objects
+        without a match as disappeared, and promote new ones."""
+
         # check to see if the list of input centroids is empty
         if len(inputCentroids) == 0:
+            self.promote(inputCentroids)
+
             # loop over any existing tracked stars and mark them as disappeared
             for objectID in list(self.disappeared.keys()):
                 self.disappeared[objectID] += 1
@@ -197,10 +349,9 @@ class CentroidTracker:
             return self.objects
 
         # if we are currently not tracking any objects take the input
-        # centroids and register each of them
+        # centroids as candidates to register
         if len(self.objects) == 0:
-            for i in range(0, len(inputCentroids)):
-                self.register(inputCentroids[i])
+            self.promote(inputCentroids)
 
         # otherwise, we are currently tracking objects so we need to
         # try to match the input centroids to existing object
@@ -214,6 +365,8 @@ class CentroidTracker:
             # centroids and input centroids, respectively -- our
             # goal will be to match an input centroid to an existing
             # object centroid
+            # (scipy is imported on first use, it's slow to import)
+            from scipy.spatial import distance as dist
             D = dist.cdist(np.array(objectCentroids), inputCentroids)
 
             # in order to perform this matching we must (1) find the
@@ -233,6 +386,7 @@ class CentroidTracker:
             # of the rows and column indexes we have already examined
             usedRows = set()
             usedCols = set()
+            offsets = []
 
             # loop over the combination of the (row, column) index
             # tuples
@@ -243,10 +397,16 @@ class CentroidTracker:
                 if row in usedRows or col in usedCols:
                     continue
 
+                # too far to be the same star
+                if D[row, col] > self.maxDistance:
+                    continue
+
                 # otherwise, grab the object ID for the current row,
                 # set its new centroid, and reset the disappeared
                 # counter
                 objectID = objectIDs[row]
+                (basePosition, baseOffset) = self.bases[objectID]
+                offsets.append(baseOffset + inputCentroids[col] - basePosition)
                 self.objects[objectID] = inputCentroids[col]
                 self.disappeared[objectID] = 0
 
@@ -260,30 +420,28 @@ class CentroidTracker:
             unusedRows = set(range(0, D.shape[0])).difference(usedRows)
             unusedCols = set(range(0, D.shape[1])).difference(usedCols)
 
-            # in the event that the number of object centroids is
-            # equal or greater than the number of input centroids
-            # we need to check and see if some of these objects have
-            # potentially disappeared
-            if D.shape[0] >= D.shape[1]:
-                # loop over the unused row indexes
-                for row in unusedRows:
-                    # grab the object ID for the corresponding row
-                    # index and increment the disappeared counter
-                    objectID = objectIDs[row]
-                    self.disappeared[objectID] += 1
-
-                    # check to see if the number of consecutive
-                    # frames the object has been marked "disappeared"
-                    # for warrants deregistering the object
-                    if self.disappeared[objectID] > self.maxDisappeared:
-                        self.deregister(objectID)
-
-            # otherwise, if the number of input centroids is greater
-            # than the number of existing object centroids we need to
-            # register each new input centroid as a trackable object
-            else:
-                for col in unusedCols:
-                    self.register(inputCentroids[col])
+            # the field is where the (median) matched object says it is
+            if offsets:
+                self.fieldOffset = np.median(offsets, axis=0)
+
+            # objects left without a match have potentially
+            # disappeared (with cosmic ray hits and the distance gate this
+            # can happen however many input centroids there are)
+            for row in unusedRows:
+                # grab the object ID for the corresponding row
+                # index and increment the disappeared counter
+                objectID = objectIDs[row]
+                self.disappeared[objectID] += 1
+
+                # check to see if the number of consecutive
+                # frames the object has been marked "disappeared"
+                # for warrants deregistering the object
+                if self.disappeared[objectID] > self.maxDisappeared:
+                    self.deregister(objectID)
+
+            # input centroids left without a match are new trackable
+            # objects (once they persisted)
+            self.promote(inputCentroids[sorted(unusedCols)])
 
         # return the set of trackable objects
         return self.objects
@@ -2,6 +2,14 @@
 #                              controller.py                                 #
 ##############################################################################
 
+import json
+import os
+import time
+from pec import PeriodicErrorCorrector
+
+# Tuned gains written by autotune.py, loaded at startup if present
+PROFILE_PATH = "controller_profile.json"
+
 ##############################################################################
 class Controller:
     """A Proportional Integral Controller that provides motor instructions
@@ -9,8 +17,9 @@ class Controller:
     part to the controller, but this isn't currently implemented."""
 
     ####################################################################
-    def __init__(self):
-        """Create basic PI Controller."""
+    def __init__(self, profile=PROFILE_PATH):
+        """Create basic PI Controller, overriding the default gains with
+        a tuned profile if one exists."""
 
         # Controller constants --> still need tuning with actual mount
         # Motor X
@@ -19,6 +28,8 @@ class Controller:
         self.RADerivGain = 1
         self.RAErrSum = 0
         self.RAErr = 0
+        self.RASlope = 0
+        self.RAMaxRate = 1.0
 
         # Motor Y
         self.DECPropGain = 0.001
@@ -26,41 +37,130 @@ class Controller:
         self.DECDerivGain = 1
         self.DECErrSum = 0
         self.DECErr = 0
+        self.DECSlope = 0
+        self.DECMaxRate = 1.0
 
         self.scale = 1000
         self.integralThreshold = 0.3
 
+        # Frame timing: the first interval is assumed to be nominalDt, and
+        # intervals are capped at maxDt so a camera stall can't dump a large
+        # error into the integral. slopeSmoothing is the weight of the newest
+        # error slope when predicting the error at actuation time.
+        self.nominalDt = 1.0
+        self.maxDt = 5.0
+        self.slopeSmoothing = 0.5
+        self.prevTime = None
+
+        # optional periodic error correction fed forward into the RA rate
+        self.pec = None
+
+        # constant RA/DEC rates added under the PI terms, e.g. cancelling
+        # the drift estimated by drift.DriftEstimator
+        self.feedForward = (0.0, 0.0)
+
+        # clock used when calculate() isn't given a frame timestamp
+        self.clock = time.monotonic
+
+        if profile is not None and os.path.exists(profile):
+            self.load_profile(profile)
+
     ####################################################################
-    def calculate(self, dX, dY):
-        """Output a motor rate correction based on an input displacement.
-        If the integral term gets too big due to error accumulation, clamp
-        it to a specified value."""
+    def load_profile(self, path):
+        """Load per-axis gains from a JSON profile written by autotune.py."""
+
+        with open(path) as f:
+            profile = json.load(f)
+
+        ra, dec = profile.get("RA", {}), profile.get("DEC", {})
+        self.RAPropGain = ra.get("propGain", self.RAPropGain)
+        self.RAIntGain = ra.get("intGain", self.RAIntGain)
+        self.DECPropGain = dec.get("propGain", self.DECPropGain)
+        self.DECIntGain = dec.get("intGain", self.DECIntGain)
+        self.integralThreshold = profile.get("integralThreshold", self.integralThreshold)
 
-        # Set cumulitive sums from input error
-        self.RAErrSum += dX
-        self.DECErrSum += dY
+        if "pec" in profile:
+            self.pec = PeriodicErrorCorrector(**profile["pec"])
+
+        print(f"<loaded controller profile: {path}>")
+
+    ####################################################################
+    def calculate(self, dX, dY, timestamp=None, latency=0.0, locked=True):
+        """Output a motor rate correction based on an input displacement
+        measured in a frame captured at timestamp (seconds). Frames where
+        the guide star wasn't locked aren't learned from by the PEC.
+
+        The integral term integrates the error over the real time between
+        frames, and the proportional term acts on the error predicted
+        latency seconds after capture, when the rates actually reach the
+        mount. Each axis has its own anti-windup: the integral is clamped
+        so its scaled contribution is at most integralThreshold, and it
+        stops integrating while the axis output is saturated."""
+
+        if timestamp is None:
+            timestamp = self.clock()
+
+        # real time since the previous frame
+        if self.prevTime is None:
+            dt = self.nominalDt
+        else:
+            dt = min(max(timestamp - self.prevTime, 0), self.maxDt)
+        self.prevTime = timestamp
+
+        RARate, self.RAErrSum, self.RASlope = self.axis_rate(
+            dX, self.RAErr, self.RAErrSum, self.RASlope,
+            self.RAPropGain, self.RAIntGain, self.RAMaxRate, dt, latency)
+
+        DECRate, self.DECErrSum, self.DECSlope = self.axis_rate(
+            dY, self.DECErr, self.DECErrSum, self.DECSlope,
+            self.DECPropGain, self.DECIntGain, self.DECMaxRate, dt, latency)
 
         # set current error terms
         self.RAErr = dX
         self.DECErr = dY
 
-        # set RA motor derivative and integral components
-        RADerTerm = self.RAPropGain * dX
-        RAIntTerm = self.RAIntGain * self.RAErrSum
+        # add the feed-forward rates, the PI terms only handle what's left
+        RARate = round(max(-self.RAMaxRate, min(self.RAMaxRate, RARate + self.feedForward[0])), 3)
+        DECRate = round(max(-self.DECMaxRate, min(self.DECMaxRate, DECRate + self.feedForward[1])), 3)
 
-        # set DEC motor derivative and integral components
-        DECDerTerm = self.DECPropGain * dY
-        DECIntTerm = self.DECIntGain * self.DECErrSum
+        # add the predicted periodic error rate at actuation time, within the
+        # mount's limit, and tell the corrector the total rate sent so it can
+        # reconstruct the uncorrected gear error
+        if self.pec is not None:
+            if locked:
+                self.pec.add_sample(timestamp, dX)
+            else:
+                self.pec.advance(timestamp)
+            RARate += self.pec.feed_forward(timestamp + latency)
+            RARate = round(max(-self.RAMaxRate, min(self.RAMaxRate, RARate)), 3)
+            self.pec.set_rate(RARate)
 
-        # if either integral term goes above threshold due to error accumulation, clamp to 0.3
-        if RAIntTerm / self.scale > self.intThresh:
-            RAIntTerm = 0.3
+        return RARate, DECRate
 
-        if DECIntTerm / self.scale > self.intThresh:
-            DECIntTerm = 0.3
+    ####################################################################
+    def axis_rate(self, err, prevErr, errSum, slope, propGain, intGain, maxRate, dt, latency):
+        """PI law for a single axis. Return the rate along with the updated
+        integral and error slope of the axis."""
 
-        # calculate the acutal rates by the rounded and scaled sum of each term
-        RARate = round((RADerTerm + RAIntTerm) / self.scale, 3)
-        DECRate = round((DECDerTerm + DECIntTerm) / self.scale, 3)
+        # smoothed rate of change of the error, used to predict it at actuation
+        if dt > 0:
+            slope += self.slopeSmoothing * ((err - prevErr) / dt - slope)
+        predicted = err + slope * latency
 
-        return RARate, DECRate
+        # integrate over real time, clamping the integral itself (not just the
+        # term) so it can't keep winding up behind the clamp
+        newSum = errSum + err * dt
+        if intGain > 0:
+            sumLimit = self.integralThreshold * self.scale / intGain
+            newSum = max(-sumLimit, min(sumLimit, newSum))
+
+        rate = (propGain * predicted + intGain * newSum) / self.scale
+
+        # while saturated, don't integrate error that pushes further into saturation
+        if abs(rate) > maxRate:
+            if err * rate > 0:
+                newSum = errSum
+                rate = (propGain * predicted + intGain * newSum) / self.scale
+            rate = max(-maxRate, min(maxRate, rate))
+
+        return round(rate, 3), newSum, slope
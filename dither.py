@@ -0,0 +1,146 @@
+##############################################################################
+#                                  dither.py                                 #
+##############################################################################
+
+import math
+import numpy as np
+
+# Dither patterns
+RANDOM = "random"   # uniform in a square of +-amplitude around the origin
+SPIRAL = "spiral"   # square spiral of amplitude steps around the origin
+
+# Dither states
+IDLE = 0        # guiding on the current lock position
+SETTLING = 1    # waiting for the star to settle after a dither
+
+##############################################################################
+class Ditherer:
+    """Dithers a GuidePipeline between imaging exposures: moves the lock
+    position of its tracker, so the controller drives the guide star to
+    the new position, and watches it settle.
+
+    The star is settled once its error has stayed below tolerance pixels
+    for settleTime seconds (frame timestamps), i.e. the largest error in
+    a rolling window of settleTime seconds is below tolerance. Then, or
+    when timeout seconds pass without settling, every listener is called
+    with an event dict:
+        + event    - "settled" or "timeout"
+        + offset   - lock offset from the origin (dX, dY)
+        + seconds  - time from the dither to the event
+        + frames   - guided frames from the dither to the event
+
+    A dither is bumpless: the previous error of the controller and of the
+    online calibration are shifted with the lock position, so the jump in
+    error isn't taken for star motion (no derivative kick, no bogus
+    calibration update)."""
+
+    ####################################################################
+    def __init__(self, pipeline, amplitude=3.0, pattern=RANDOM, tolerance=1.5,
+                 settleTime=5.0, timeout=60.0, spiralRings=3, seed=None):
+        self.pipeline = pipeline
+        self.amplitude = amplitude
+        self.pattern = pattern
+        self.tolerance = tolerance
+        self.settleTime = settleTime
+        self.timeout = timeout
+        self.spiralRings = spiralRings
+        self.rng = np.random.default_rng(seed)
+        self.listeners = []
+
+        self.state = IDLE
+        self.spiralIndex = 0
+        self.lastTime = None
+        self.lastEvent = None
+
+    ####################################################################
+    def next_offset(self):
+        """Lock offset of the next dither in the pattern."""
+
+        if self.pattern == SPIRAL:
+            # every point but the origin, round and round
+            self.spiralIndex = self.spiralIndex % ((2 * self.spiralRings + 1) ** 2 - 1) + 1
+            (x, y) = spiral_offset(self.spiralIndex)
+            return (x * self.amplitude, y * self.amplitude)
+        return tuple(self.rng.uniform(-self.amplitude, self.amplitude, 2))
+
+    ####################################################################
+    def dither(self, offset=None, timestamp=None):
+        """Move the lock position to offset (dX, dY) from the origin, or to
+        the next one of the pattern, and start watching for the star to
+        settle. Return the offset."""
+
+        pipeline = self.pipeline
+        tracker = pipeline.tracker
+        if offset is None:
+            offset = self.next_offset()
+        step = np.subtract(offset, tracker.lockOffset)
+        tracker.lockOffset = tuple(float(v) for v in offset)
+
+        # the error drops by the step without the star moving
+        controller = pipeline.controller
+        (raStep, decStep) = pipeline.calibration.calculate_rates(tuple(-step))
+        controller.RAErr += raStep
+        controller.DECErr += decStep
+        online = pipeline.online
+        if online is not None and online.prevCOM is not None:
+            online.prevCOM = online.prevCOM - step
+
+        self.state = SETTLING
+        self.start = timestamp if timestamp is not None else self.lastTime
+        self.settledSince = None
+        self.frames = 0
+        print(f"<dither to ({offset[0]:.2f}, {offset[1]:.2f})>")
+        return tracker.lockOffset
+
+    ####################################################################
+    def update(self, status, locked=True):
+        """Check a guided frame for the star having settled."""
+
+        timestamp = status.timestamp
+        self.lastTime = timestamp
+        if self.state != SETTLING or timestamp is None:
+            return
+        if self.start is None:
+            self.start = timestamp
+        self.frames += 1
+
+        # start of the run of frames within tolerance, if in one
+        if locked and math.hypot(*status.COM) <= self.tolerance:
+            if self.settledSince is None:
+                self.settledSince = timestamp
+        else:
+            self.settledSince = None
+
+        if self.settledSince is not None and timestamp - self.settledSince >= self.settleTime:
+            self.emit("settled", timestamp)
+        elif timestamp - self.start >= self.timeout:
+            self.emit("timeout", timestamp)
+
+    ####################################################################
+    def emit(self, kind, timestamp):
+        self.state = IDLE
+        self.lastEvent = {"event": kind, "offset": self.pipeline.tracker.lockOffset,
+                          "seconds": timestamp - self.start, "frames": self.frames}
+        print(f"<dither {kind} after {self.lastEvent['seconds']:.1f} s>")
+        for listener in self.listeners:
+            listener(self.lastEvent)
+
+    ####################################################################
+    def settling(self):
+        return self.state == SETTLING
+
+
+##############################################################################
+def spiral_offset(index):
+    """(x, y) of point index of a square spiral of unit steps, starting at
+    the origin and going right, then counterclockwise."""
+
+    (x, y, dx, dy, leg, i) = (0, 0, 1, 0, 1, 0)
+    while True:
+        for turn in range(2):
+            for step in range(leg):
+                if i == index:
+                    return x, y
+                (x, y, i) = (x + dx, y + dy, i + 1)
+            (dx, dy) = (-dy, dx)
+        leg += 1
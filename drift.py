@@ -0,0 +1,189 @@
+##############################################################################
+#                                  drift.py                                  #
+##############################################################################
+
+import numpy as np
+
+##############################################################################
+class DriftEstimator:
+    """Estimates the steady drift of the guide star (polar misalignment,
+    tracking rate error) while guiding, and turns it into a constant
+    feed-forward rate for the Controller, so its integral term doesn't
+    have to hold the mount against the drift.
+
+    While guiding, the error stays near zero however large the drift, so
+    the drift is fitted to the open-loop position of the star instead: its
+    position (relative to the origin, so dithers don't count) minus the
+    pixel motion of all the travel commanded since the estimate began,
+    summed up frame by frame through the pixel matrix of the calibration.
+
+    The open-loop positions of the last capacity locked frames are kept in
+    a ring, with running linear regression sums that are updated in O(1)
+    per frame (and rebuilt from the ring once per capacity frames, like
+    StatusHistory). Once the ring spans minSpan seconds, the fitted drift
+    (pixels per second) is mapped through Calibration.conversion into the
+    RA/DEC rate that cancels it, smoothed, and clamped to maxRate.
+
+    Only the rates of guided frames are seen, so a gap of more than maxGap
+    seconds between them (guiding stopped, a calibration) can't be
+    accounted for: the fit starts over from the next frame, keeping the
+    feed-forward rates it had."""
+
+    ####################################################################
+    def __init__(self, calibration, capacity=600, minSamples=30, minSpan=60.0,
+                 smoothing=0.05, maxRate=0.3, maxGap=5.0):
+        self.calibration = calibration
+        self.capacity = capacity
+        self.minSamples = minSamples
+        self.minSpan = minSpan
+        self.smoothing = smoothing
+        self.maxRate = maxRate
+        self.maxGap = maxGap
+        self.reset()
+
+    ####################################################################
+    def reset(self):
+        """Forget the drift and the feed-forward rate."""
+
+        self.restart()
+        self.trackID = None
+        self.slope = np.zeros(2)            # fitted drift in pixels per second
+        self.feedForward = np.zeros(2)      # RA/DEC rate cancelling the drift
+
+    ####################################################################
+    def restart(self):
+        """Start the fit over with an empty ring, keeping the drift and the
+        feed-forward rate."""
+
+        self.times = np.zeros(self.capacity)
+        self.positions = np.zeros((self.capacity, 2))
+        self.count = 0
+        self.head = 0
+        self.pushes = 0
+        self.reset_sums()
+
+        self.correction = np.zeros(2)       # pixels moved by the commanded travel
+        self.rates = np.zeros(2)            # rates commanded after the last frame
+        self.prevTime = None
+
+    ####################################################################
+    def reset_sums(self, t0=None):
+        self.t0 = t0
+        self.St = 0.0
+        self.Stt = 0.0
+        self.Sx = np.zeros(2)
+        self.Stx = np.zeros(2)
+
+    ####################################################################
+    def set_rates(self, RARate, DECRate):
+        """Rates transmitted after the current frame."""
+        self.rates = np.array((RARate, DECRate), dtype=float)
+
+    ####################################################################
+    def update(self, position, timestamp, locked=True, trackID=None):
+        """Add the guide star position (dX, dY from the origin) of a frame
+        captured at timestamp, and refit. Return the feed-forward rates."""
+
+        calibration = self.calibration
+        if calibration.state != calibration.DONE or timestamp is None:
+            if self.count:
+                self.reset()
+            return tuple(self.feedForward)
+
+        # a different guide star starts over
+        if locked and self.trackID is not None and trackID != self.trackID:
+            self.reset()
+        if locked:
+            self.trackID = trackID
+
+        # the travel commanded during a long gap is unknown
+        if self.prevTime is not None and timestamp - self.prevTime > self.maxGap:
+            self.restart()
+
+        # pixel motion of the travel commanded since the previous frame
+        if self.prevTime is not None:
+            travel = self.rates * (timestamp - self.prevTime)
+            self.correction += calibration.pixelMatrix @ travel
+        self.prevTime = timestamp
+        if not locked:
+            return tuple(self.feedForward)
+
+        self.push(timestamp, np.asarray(position, dtype=float) - self.correction)
+        self.fit()
+        return tuple(self.feedForward)
+
+    ####################################################################
+    def push(self, t, x):
+        """Add an open-loop position to the ring and the regression sums."""
+
+        if self.count == self.capacity:
+            self.remove(self.times[self.head], self.positions[self.head])
+        else:
+            self.count += 1
+        self.times[self.head] = t
+        self.positions[self.head] = x
+        self.head = (self.head + 1) % self.capacity
+        self.insert(t, x)
+
+        # rebuild now and then from the ring
+        self.pushes += 1
+        if self.pushes >= self.capacity:
+            self.rebuild()
+
+    ####################################################################
+    def insert(self, t, x):
+        if self.t0 is None:
+            self.t0 = t
+        t -= self.t0
+        self.St += t
+        self.Stt += t * t
+        self.Sx += x
+        self.Stx += t * x
+
+    ####################################################################
+    def remove(self, t, x):
+        t -= self.t0
+        self.St -= t
+        self.Stt -= t * t
+        self.Sx -= x
+        self.Stx -= t * x
+
+    ####################################################################
+    def rebuild(self):
+        """Recompute the regression sums from the ring."""
+
+        order = np.roll(np.arange(self.capacity), -self.head)[self.capacity - self.count:]
+        self.reset_sums(self.times[order[0]])
+        for i in order:
+            self.insert(self.times[i], self.positions[i])
+        self.pushes = 0
+
+    ####################################################################
+    def span(self):
+        """Seconds between the oldest and newest position in the ring."""
+        if self.count < 2:
+            return 0.0
+        oldest = self.times[self.head if self.count == self.capacity else 0]
+        return self.times[self.head - 1] - oldest
+
+    ####################################################################
+    def fit(self):
+        """Refit the drift, and move the feed-forward rates towards the
+        rates cancelling it."""
+
+        n = self.count
+        denominator = n * self.Stt - self.St ** 2
+        if n < self.minSamples or self.span() < self.minSpan or denominator <= 0:
+            return
+
+        self.slope = (n * self.Stx - self.St * self.Sx) / denominator
+
+        # the drift is pixels per second, so its travel is a rate
+        target = self.calibration.calculate_rates(self.slope)
+        target = np.clip(target, -self.maxRate, self.maxRate)
+        self.feedForward += self.smoothing * (target - self.feedForward)
+
+    ####################################################################
+    def drift(self):
+        """Fitted drift in pixels per minute (dX, dY)."""
+        return tuple(60 * self.slope)
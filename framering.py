@@ -0,0 +1,302 @@
+##############################################################################
+#                                framering.py                                #
+##############################################################################
+
+import argparse
+import multiprocessing
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+# Bytes before the first slot: a sequence number and a timestamp per slot
+# are kept in front of the frames, each slot starts on a cache line
+ALIGN = 64
+
+##############################################################################
+class FrameRing:
+    """Ring of frame slots in shared memory, handing frames from one capture
+    process to one processing process without pickling or copying them.
+
+    The producer fills slots in order and the consumer empties them in the
+    same order; two semaphores count the free and filled slots, so neither
+    side needs a lock and each slot is owned by exactly one side at a time.
+    Every committed frame gets the next sequence number, which lets the
+    consumer count frames the producer dropped while the ring was full.
+
+    Create the ring in the parent and pass it to the child process as an
+    argument (the semaphores can only be shared that way)."""
+
+    ####################################################################
+    def __init__(self, shape=(480, 640, 3), dtype=np.uint8, slots=4, context=None):
+        """Create a ring of slots frames of the given shape and dtype."""
+
+        context = context if context is not None else multiprocessing.get_context()
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+
+        self.frameBytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.slotBytes = -(-self.frameBytes // ALIGN) * ALIGN
+        self.headerBytes = -(-slots * 16 // ALIGN) * ALIGN
+
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=self.headerBytes + slots * self.slotBytes)
+        self.owner = True
+        self.free = context.Semaphore(slots)
+        self.filled = context.Semaphore(0)
+        self.attach()
+
+        self.sequence[:] = -1
+
+    ####################################################################
+    def attach(self):
+        """NumPy views of the header and slots over the shared memory."""
+
+        buffer = self.shm.buf
+        self.sequence = np.ndarray((self.slots,), np.int64, buffer, 0)
+        self.timestamps = np.ndarray((self.slots,), np.float64, buffer, 8 * self.slots)
+        self.frames = [np.ndarray(self.shape, self.dtype, buffer,
+                                  self.headerBytes + i * self.slotBytes)
+                       for i in range(self.slots)]
+
+        # position in the ring of each side, local to its process
+        self.writeIndex = 0
+        self.readIndex = 0
+        self.nextSeq = 0
+        self.lastSeq = -1
+        self.dropped = 0        # producer: frames skipped while the ring was full
+        self.missed = 0         # consumer: sequence numbers never seen
+
+    ####################################################################
+    def __getstate__(self):
+        state = {key: value for (key, value) in self.__dict__.items()
+                 if key not in ("shm", "sequence", "timestamps", "frames")}
+        state["name"] = self.shm.name
+        return state
+
+    ####################################################################
+    def __setstate__(self, state):
+        name = state.pop("name")
+        self.__dict__.update(state)
+        self.owner = False
+        # the block stays registered with the resource tracker shared by
+        # the process tree, so only the creator's close() unlinks it
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.attach()
+
+    ####################################################################
+    def acquire_write(self, timeout=None):
+        """Producer: take the next free slot and return a writable NumPy
+        view of it, or None if none frees up within timeout."""
+
+        if not self.free.acquire(timeout=timeout):
+            # the dropped frame still takes a sequence number, so the
+            # consumer sees the gap
+            self.dropped += 1
+            self.nextSeq += 1
+            return None
+        return self.frames[self.writeIndex]
+
+    ####################################################################
+    def commit(self, timestamp=None):
+        """Producer: publish the slot taken by acquire_write()."""
+
+        index = self.writeIndex
+        self.timestamps[index] = time.time() if timestamp is None else timestamp
+        self.sequence[index] = self.nextSeq
+        self.nextSeq += 1
+        self.writeIndex = (index + 1) % self.slots
+        self.filled.release()
+
+    ####################################################################
+    def acquire_read(self, timeout=None):
+        """Consumer: take the oldest filled slot. Return (frame, seq,
+        timestamp), with frame a NumPy view into shared memory that stays
+        valid until release(), or None on timeout."""
+
+        if not self.filled.acquire(timeout=timeout):
+            return None
+
+        return self.read_slot()
+
+    ####################################################################
+    def read_slot(self):
+        """Consumer: (frame, seq, timestamp) of the slot at readIndex,
+        counting the sequence numbers skipped since the last one read."""
+
+        index = self.readIndex
+        seq = int(self.sequence[index])
+        self.missed += max(seq - self.lastSeq - 1, 0)
+        self.lastSeq = seq
+        return self.frames[index], seq, float(self.timestamps[index])
+
+    ####################################################################
+    def release(self):
+        """Consumer: hand the slot of the last acquire_read() back."""
+        self.readIndex = (self.readIndex + 1) % self.slots
+        self.free.release()
+
+    ####################################################################
+    def acquire_latest(self, timeout=None):
+        """Consumer: like acquire_read(), but skip (and release) every
+        filled slot except the newest, so guiding always sees the latest
+        frame."""
+
+        frame = self.acquire_read(timeout)
+        while frame is not None and self.filled.acquire(block=False):
+            self.release()
+            frame = self.read_slot()
+        return frame
+
+    ####################################################################
+    def close(self):
+        """Detach, and free the shared memory if this process created it."""
+        self.sequence = self.timestamps = self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+##############################################################################
+class RingCamera:
+    """Processing side stand-in for camera.Camera: capture() returns the
+    latest frame of a FrameRing as a view into shared memory, valid until
+    the next capture()."""
+
+    ####################################################################
+    def __init__(self, ring, timeout=5.0):
+        self.ring = ring
+        self.timeout = timeout
+        self.holding = False
+        self.seq = -1
+        self.timestamp = None
+
+    ####################################################################
+    def capture(self):
+        if self.holding:
+            self.ring.release()
+            self.holding = False
+
+        frame = self.ring.acquire_latest(self.timeout)
+        if frame is None:
+            print("\t<ERR: Frame not received>")
+            return None
+
+        self.holding = True
+        (img, self.seq, self.timestamp) = frame
+        return img
+
+
+##############################################################################
+def capture_loop(ring, stop, index=0, captureRate=1000):
+    """Capture process: read USB camera frames straight into ring slots.
+    While the ring is full frames are grabbed without decoding, so the
+    camera's own buffer doesn't fall behind.
+
+    The camera is asked for frames of the ring's size. If it delivers
+    another size anyway, cv2 decodes into a new array instead of the slot,
+    so the loop stops with an error rather than commit empty slots."""
+
+    import cv2
+    from camera import Camera
+
+    camera = Camera(captureRate=0, index=index)
+    camera.cam.set(cv2.CAP_PROP_FRAME_WIDTH, ring.shape[1])
+    camera.cam.set(cv2.CAP_PROP_FRAME_HEIGHT, ring.shape[0])
+    interval = captureRate / 1000
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            slot = ring.acquire_write(timeout=0)
+            if slot is None:
+                camera.cam.grab()
+            else:
+                img = camera.capture(image=slot)
+                if img is slot:
+                    ring.commit()
+                else:
+                    ring.free.release()     # nothing written, give the slot back
+                    if img is not None:
+                        exit(f"\t<ERROR: camera frames are {img.shape}, "
+                             f"the frame ring's are {ring.shape}>")
+            time.sleep(max(interval - (time.perf_counter() - start), 0))
+    finally:
+        camera.cam.release()
+
+##############################################################################
+def start_capture(ring, index=0, captureRate=1000, context=None):
+    """Start capture_loop() in a process. Return (process, stop event)."""
+
+    context = context if context is not None else multiprocessing.get_context("spawn")
+    stop = context.Event()
+    process = context.Process(target=capture_loop, args=(ring, stop, index, captureRate),
+                              name="capture", daemon=True)
+    process.start()
+    return process, stop
+
+##############################################################################
+def sim_frames(shape, count=8, seed=None):
+    """Simulator frames to replay in the benchmark."""
+    from simulator import MountModel, SimCamera
+    camera = SimCamera(MountModel(seed=seed), shape=shape, seed=seed)
+    return [camera.capture() for i in range(count)]
+
+##############################################################################
+def _ring_producer(ring, count, shape):
+    """Benchmark producer: copy frames into ring slots, as the camera
+    decodes into them."""
+    frames = sim_frames(shape, seed=1)
+    for i in range(count):
+        np.copyto(ring.acquire_write(), frames[i % len(frames)])
+        ring.commit()
+
+##############################################################################
+def _queue_producer(queue, count, shape):
+    """Benchmark producer: pickle frames through a queue, for comparison."""
+    frames = sim_frames(shape, seed=1)
+    for i in range(count):
+        queue.put(frames[i % len(frames)])
+
+
+##############################################################################
+if __name__ == "__main__":
+
+    from imageprocessing import find_centroids
+
+    parser = argparse.ArgumentParser(description="Benchmark the shared memory frame ring.")
+    parser.add_argument("--count", type=int, default=300, help="frames to hand over")
+    parser.add_argument("--size", type=int, default=1024, help="frame width and height")
+    parser.add_argument("--slots", type=int, default=4)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    shape = (args.size, args.size)
+
+    # frames through the ring, detected on the views
+    ring = FrameRing(shape + (3,), slots=args.slots, context=context)
+    producer = context.Process(target=_ring_producer, args=(ring, args.count, shape))
+    producer.start()
+    ring.acquire_read()
+    ring.release()
+    start = time.perf_counter()
+    for i in range(args.count - 1):
+        (img, seq, timestamp) = ring.acquire_read()
+        find_centroids(img, 5)
+        ring.release()
+    ringTime = time.perf_counter() - start
+    producer.join()
+    print(f"\tshared memory ring:\t{(args.count - 1) / ringTime:.1f} frames/s, "
+          f"{ring.missed} missed")
+    ring.close()
+
+    # the same frames pickled through a queue
+    frames = context.Queue(maxsize=args.slots)
+    producer = context.Process(target=_queue_producer, args=(frames, args.count, shape))
+    producer.start()
+    frames.get()
+    start = time.perf_counter()
+    for i in range(args.count - 1):
+        find_centroids(frames.get(), 5)
+    queueTime = time.perf_counter() - start
+    producer.join()
+    print(f"\tpickled queue:\t\t{(args.count - 1) / queueTime:.1f} frames/s")
@@ -4,9 +4,9 @@
 
 from tkinter import *
 from imageprocessing import *
-from centroidtracker import CentroidTracker
-from calibration import Calibration
-from controller import Controller
+from pipeline import GuidePipeline
+from calibrationcache import CalibrationCache
+from profiler import FrameProfiler
 from status import Status
 
 # Tkinter GUI application
@@ -14,19 +14,22 @@ from status import Status
 class MainApp:
 
     ####################################################################
-    def __init__(self, master, camera, uart):
+    def __init__(self, master, camera=None, uart=None):
         """Create a main application with the root thread, camera, and
-        UART instances."""
+        UART instances. The devices can be attached later with
+        attach_devices(), e.g. once they finish opening."""
 
         # Member Data
         #######################################################
-        self.tracker = CentroidTracker()
-        self.controller = Controller()
+        self.pipeline = GuidePipeline(uart)
+        self.tracker = self.pipeline.tracker
+        self.controller = self.pipeline.controller
         self.test = "alnilam"
         self.status = Status()
         self.threshold = 5
         self.camera = camera
         self.UART = uart
+        self.devicesReady = uart is not None
 
         # GUI Status Data
         #######################################################
@@ -37,12 +40,24 @@ class MainApp:
 
         # Calibration Data
         #######################################################
-        self.calibration = Calibration()
+        self.calibration = self.pipeline.calibration
+        self.calibrationCache = CalibrationCache()
+        self.pointing = None    # (declination, pier side, camera rotation)
+
+        # Profiling, toggled with F9 for the next profileFrames frames
+        #######################################################
+        self.profiler = FrameProfiler(self.pipeline, app=self)
+        self.profileFrames = 100
+
+        # session.SessionRecorder recording the pipeline, if any
+        self.session = None
 
         # Primary GUI Objects
         #######################################################
         # master root frame
         self.master = master
+        self.master.bind("<F9>", self.profile_key_cb)
+        self.master.bind("<F8>", self.dither_key_cb)
 
         # self.img - cv2 binary image without any markup
         # self.gui_img - PIL colored image with markup
@@ -62,7 +77,7 @@ class MainApp:
 
         # GUI object containing status data
         self.text = Label(self.frame, textvariable=self.status_txt)
-        self.text.config(height=10, width=32, justify="left", bg="grey25", fg="white")
+        self.text.config(height=16, width=32, justify="left", bg="grey25", fg="white")
         self.text.pack()
 
         # Secondary GUI Objects (widgets)
@@ -119,27 +134,33 @@ class MainApp:
             4) exposing and running
         """
 
+        # record the state of the buttons with the session
+        if self.session is not None:
+            self.session.state(exposing=self.exposing, calibrating=self.calibrating,
+                               calibrated=self.calibrated, running=self.running)
+
         # Take camera captures and find guide star if exposing
         if self.exposing:
             self.expose()
 
-            # Calibrate motors
-            if self.calibrating:
-                self.calibrate()
+            # a repeat of the last frame holds nothing new to act on
+            if not self.pipeline.unchanged:
+
+                # Calibrate motors
+                if self.calibrating:
+                    self.calibrate()
 
-            # Or Implement guiding algorithm with transmission of motor rates
-            elif self.running:
-                self.run()
+                # Or Implement guiding algorithm with transmission of motor rates
+                elif self.running:
+                    self.run()
 
-            # Reset img_num if it reaches 10 --> temporary
-            if self.tracker.status.img_num is 10:
-                self.tracker.status.clear()
-                # self.tracker.clear()
+            # add the frame to the guide log, if one is being recorded
+            self.pipeline.record()
 
             # Update panel image, threshold slider, and status text after exposure and run
             self.panel.config(image=self.gui_img)
             self.threshold = self.slider.get()
-            self.status_txt.set(self.tracker.status)
+            self.status_txt.set(f"{self.tracker.status}{self.pipeline.history}")
 
         # Don't do anything if not exposing
         elif not self.exposing:
@@ -167,32 +188,20 @@ class MainApp:
         Camera, and autoselect the guide star closest to the center."""
 
         # Either A) load image from test directory
-        self.img = load_image(self.test, self.tracker.status.img_num)
+        # (the test directories hold 10 images, cycled through)
+        self.img = load_image(self.test, self.tracker.status.img_num % 10)
         # or B) capture frame from USB Camera
         # initial_img = self.camera.capture()
 
-        # locate the centroids as a list of (x, y) tuples and get binary thresholded image
-        centroids, colored_img  = find_centroids(self.img, lower_thresh=self.threshold)
-
-        # update the Tracker object for the next list of input centroids
-        dX, dY = self.tracker.update(centroids)
-
-        # if the mode is SEARCHING, autoselect a guide star
-        if self.tracker.status.mode is self.tracker.SEARCHING:
-            # get a guide star and return image with smallest bounding rectangle
-            autosel_img = self.tracker.autoselect(colored_img)
-        else:
-            # autoselection not activated, autoselected image is the filtered image
-            autosel_img = colored_img
+        # find the stars, track the guide star, and autoselect one if searching
+        self.pipeline.threshold = self.threshold
+        colored_img = self.pipeline.expose(self.img)
 
         # show camera circle, orthogonal axes, and tracking box
-        marked_img = markup_img(autosel_img, self.tracker)
+        marked_img = markup_img(colored_img, self.tracker)
         pil_img = Image.fromarray(marked_img)
         self.gui_img = ImageTk.PhotoImage(pil_img)
 
-        # Update status object incremented image number, mode, and displacement
-        self.tracker.status.set(self.tracker.status.img_num + 1, self.tracker.status.mode, (dX, dY))
-
     ####################################################################
     def run(self):
         """Run the autoguiding program.
@@ -202,20 +211,8 @@ class MainApp:
         motor rates to the MCU. Note: this is only accessible after a
         successful calibration."""
 
-        # Fetch distance from origin
-        dX, dY = self.tracker.status.COM
-
-        # Plug into conversion matrix
-        calRARate, calDECRate = self.calibration.calculate_rates((dX, dY))
-
-        # Get rates from PI Controller
-        raRate, decRate = self.controller.calculate(calRARate, calDECRate)
-
-        # Transmit calculated motor rates over UART
-        self.UART.transmit(raRate, decRate)
-
-        # Update status object motor rates
-        self.tracker.status.set_rates(raRate, decRate)
+        # conversion matrix -> PI Controller -> UART, updating the status rates
+        self.pipeline.run()
 
     ####################################################################
     def calibrate(self):
@@ -228,23 +225,45 @@ class MainApp:
          rotator angle will correspond to different angles relative to the
          camera frame."""
 
-        # tell motors what to do and record data samples if necessary
-        self.calibration.execute(self.UART, self.tracker.status)
-
-        # next state logic based on calibration state
-        self.calibration.next_state()
-
-        # update status object for current calibration rates
-        self.tracker.status.set_rates(self.calibration.RARate, self.calibration.DECRate)
-
-        # After calibration finishes...
-        if self.calibration.state is self.calibration.DONE:
-            self.calibration.least_squares()    # run least squares to get conversion matrix
+        # step the calibration, which runs least squares to get the
+        # conversion matrix once it finishes...
+        if self.pipeline.calibrate():
             self.calibrating = False            # stop calibrating
             self.calibrated = True              # calibration has finished
             self.stop_button_cb()               # stop all processes
             print(self.calibration)             # print result
 
+            # remember the calibration for this pointing
+            if self.pointing is not None:
+                self.calibrationCache.save(self.calibration, *self.pointing)
+
+    ####################################################################
+    def attach_devices(self, camera, uart):
+        """Use the camera and UART once they are open."""
+
+        self.camera = camera
+        self.UART = uart
+        if self.session is not None:
+            self.session.attach_uart(uart)
+        else:
+            self.pipeline.UART = uart
+        self.devicesReady = True
+        print("<devices ready>")
+
+    ####################################################################
+    def set_pointing(self, declination, pierSide, rotation):
+        """Tell the app where the mount points, e.g. at startup or after a
+        slew. Reuse the nearest stored calibration (rescaled to the new
+        declination) if there is one, otherwise a calibration is needed."""
+
+        self.pointing = (declination, pierSide, rotation)
+        self.calibrated = self.calibrationCache.apply(self.calibration, *self.pointing)
+
+        if self.calibrated:
+            print(f"<CD: reusing stored calibration at {declination}\u00B0 declination>")
+        else:
+            print("<!CD: no stored calibration near this pointing>")
+
     # GUI Operational state codes
     ####################################################################
     # CI - calibrating
@@ -255,7 +274,9 @@ class MainApp:
 
     ####################################################################
     def expose_button_cb(self):
-        if self.exposing:
+        if not self.devicesReady:
+            print("<!devices ready; no action>")
+        elif self.exposing:
             print("<E: no action>")
         elif not self.exposing:
             print("<start exposing>")
@@ -322,6 +343,18 @@ class MainApp:
         elif not self.calibrated:
             print("<!CD; no action>")
 
+    ####################################################################
+    def profile_key_cb(self, event=None):
+        self.profiler.toggle(self.profileFrames)
+
+    ####################################################################
+    def dither_key_cb(self, event=None):
+        # Only dither while guiding
+        if self.running:
+            self.pipeline.dither.dither()
+        else:
+            print("<!R; no action>")
+
     ####################################################################
     def cal_button_cb(self):
         # only calibrate if we haven't already done so
@@ -347,6 +380,59 @@ class MainApp:
             print("<CD: do nothing>")
 
 
+##############################################################################
+class SupervisorApp:
+    """Thin observer of a supervisor.Supervisor: a row per rig with its
+    status, read from the shared status array, and buttons that send the
+    rig commands. The guiding itself runs in the rig processes."""
+
+    ####################################################################
+    def __init__(self, master, supervisor, refresh=500):
+        import supervisor as sv
+
+        self.master = master
+        self.supervisor = supervisor
+        self.refresh = refresh
+        self.texts = []
+
+        for index in range(len(supervisor)):
+            row = Frame(master, bg="grey25")
+            row.pack(side=TOP, fill=X)
+
+            text = StringVar()
+            label = Label(row, textvariable=text)
+            label.config(height=5, width=48, justify="left", bg="grey25", fg="white")
+            label.pack(side=LEFT)
+            self.texts.append(text)
+
+            for (name, command) in (("Expose", sv.EXPOSE), ("Calibrate", sv.CALIBRATE),
+                                    ("Run", sv.RUN), ("Stop", sv.STOP)):
+                Button(row, text=name, width=9,
+                       command=lambda i=index, c=command: supervisor.command(i, c)).pack(side=LEFT)
+
+    ####################################################################
+    def update(self):
+        """Refresh every rig's status text."""
+
+        modes = ("SEARCHING", "LOCKED", "LOST")
+        for (index, text) in enumerate(self.texts):
+            status = self.supervisor.status(index)
+            state = "EXITED" if status["exited"] else \
+                "RUNNING" if status["running"] else \
+                "CALIBRATING" if status["calibrating"] else \
+                "EXPOSING" if status["exposing"] else "IDLE"
+
+            text.set(f"Rig {index}: {state}, {'' if status['calibrated'] else 'not '}calibrated"
+                     f"\n\tImage {int(status['img_num'])}\tMode: {modes[int(status['mode'])]}"
+                     f"\n\tStar COM: ({status['dX']:.0f}, {status['dY']:.0f})"
+                     f"\tStars: {int(status['detections'])}"
+                     f"\tSkipped: {int(status['skipped'])}"
+                     f"\n\tRates: {status['raRate']:.3f}, {status['decRate']:.3f}"
+                     f"\tRMS: {status['rmsTotal']:.2f} px")
+
+        self.master.after(self.refresh, self.update)
+
+
 ##############################################################################
 class CreateToolTip(object):
     """
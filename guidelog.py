@@ -0,0 +1,172 @@
+##############################################################################
+#                                 guidelog.py                                #
+##############################################################################
+
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+# One record per frame. Stage timings are in seconds of wall clock time.
+RECORD = np.dtype([("timestamp", "f8"),        # capture time of the frame
+                   ("img_num", "i4"),
+                   ("mode", "i1"),             # tracker mode (SEARCHING, LOCKED, LOST)
+                   ("calState", "i1"),         # Calibration state
+                   ("detections", "i2"),       # number of centroids found
+                   ("x", "f4"),                # guide star centroid in the frame
+                   ("y", "f4"),
+                   ("dX", "f4"),               # displacement from the origin
+                   ("dY", "f4"),
+                   ("raErr", "f4"),            # controller inputs (converted error)
+                   ("decErr", "f4"),
+                   ("raRate", "f4"),           # commanded rates
+                   ("decRate", "f4"),
+                   ("findTime", "f4"),         # find_centroids
+                   ("trackTime", "f4"),        # tracker update and autoselect
+                   ("controlTime", "f4"),      # conversion and controller
+                   ("transmitTime", "f4")])    # UART.transmit
+
+HEADER = "header.json"
+
+##############################################################################
+class GuideLog:
+    """Per-frame guide log that stays off the guiding loop's back.
+
+    Records are written into a preallocated structured NumPy chunk. Full
+    chunks (or partial ones after flushInterval seconds) are handed to a
+    background thread, which appends every column to its own raw binary
+    file in the log directory and rewrites a small JSON header with the
+    dtype and row count. Chunks are recycled through a pool, so appending a
+    record never allocates.
+
+    load_guide_log() reads a log back as NumPy arrays without parsing."""
+
+    ####################################################################
+    def __init__(self, directory, chunkSize=1024, poolSize=4, flushInterval=10.0):
+        """Create (or append to) a log in directory."""
+
+        self.directory = directory
+        self.chunkSize = chunkSize
+        self.poolSize = poolSize
+        self.flushInterval = flushInterval
+        os.makedirs(directory, exist_ok=True)
+
+        # rows already on disk, if appending to an earlier log
+        self.rows = 0
+        headerPath = os.path.join(directory, HEADER)
+        if os.path.exists(headerPath):
+            with open(headerPath) as f:
+                header = json.load(f)
+            if np.dtype([tuple(field) for field in header["dtype"]]) != RECORD:
+                raise ValueError(f"guide log {directory} has a different record layout")
+            self.rows = header["rows"]
+
+            # drop anything written after the header, e.g. by a crash
+            for name in RECORD.names:
+                path = os.path.join(directory, name + ".bin")
+                if os.path.exists(path):
+                    os.truncate(path, min(os.path.getsize(path), self.rows * RECORD[name].itemsize))
+
+        self.pool = queue.Queue()
+        for i in range(poolSize):
+            self.pool.put(np.zeros(chunkSize, dtype=RECORD))
+        self.chunk = self.pool.get()
+        self.index = 0
+        self.lastFlush = time.monotonic()
+
+        self.recorded = 0
+        self.dropped = 0        # chunks allocated because the writer fell behind
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self.write_loop, name="guide-log", daemon=True)
+        self.thread.start()
+
+    ####################################################################
+    def append(self, record):
+        """Add a record, given as a tuple in RECORD field order."""
+
+        self.chunk[self.index] = record
+        self.index += 1
+        self.recorded += 1
+
+        if self.index == self.chunkSize or time.monotonic() - self.lastFlush > self.flushInterval:
+            self.flush()
+
+    ####################################################################
+    def flush(self):
+        """Hand the records so far to the writer thread."""
+
+        if self.index == 0:
+            return
+        self.pending.put((self.chunk, self.index))
+        self.lastFlush = time.monotonic()
+        self.index = 0
+
+        try:
+            self.chunk = self.pool.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            self.chunk = np.zeros(self.chunkSize, dtype=RECORD)
+
+    ####################################################################
+    def write_loop(self):
+        """Writer thread: append each chunk column by column."""
+
+        files = {name: open(os.path.join(self.directory, name + ".bin"), "ab")
+                 for name in RECORD.names}
+        try:
+            while True:
+                item = self.pending.get()
+                if item is None:
+                    break
+                (chunk, count) = item
+
+                for name in RECORD.names:
+                    chunk[name][:count].tofile(files[name])
+                    files[name].flush()
+                self.rows += count
+                self.write_header()
+
+                # keep chunks allocated while the writer fell behind out of the pool
+                if self.pool.qsize() < self.poolSize:
+                    self.pool.put(chunk)
+        finally:
+            for f in files.values():
+                f.close()
+
+    ####################################################################
+    def write_header(self):
+        """Rewrite the header atomically, after the columns it describes."""
+
+        header = {"dtype": RECORD.descr, "rows": self.rows, "updated": time.time()}
+        tmpPath = os.path.join(self.directory, HEADER + ".tmp")
+        with open(tmpPath, "w") as f:
+            json.dump(header, f, indent=4)
+        os.replace(tmpPath, os.path.join(self.directory, HEADER))
+
+    ####################################################################
+    def close(self):
+        """Write the remaining records and stop the writer thread."""
+        self.flush()
+        self.pending.put(None)
+        self.thread.join()
+
+
+##############################################################################
+def load_guide_log(directory, mmap=False):
+    """Load a guide log as a dict of column arrays (memory mapped with
+    mmap). Only the rows recorded in the header are read, so a log that is
+    still being written can be loaded."""
+
+    with open(os.path.join(directory, HEADER)) as f:
+        header = json.load(f)
+
+    columns = {}
+    for (name, fmt) in header["dtype"]:
+        path = os.path.join(directory, name + ".bin")
+        if mmap and header["rows"]:
+            columns[name] = np.memmap(path, dtype=fmt, mode="r", shape=(header["rows"],))
+        else:
+            columns[name] = np.fromfile(path, dtype=fmt, count=header["rows"])
+    return columns
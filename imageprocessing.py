@@ -2,6 +2,7 @@
 #                               imageprocesing.py                            #
 ##############################################################################
 
+import zlib
 import numpy as np
 import cv2
 from PIL import Image, ImageTk
@@ -61,10 +62,11 @@ def find_centroids(img, lower_thresh):
     img = filter_img(img, lower_thresh)
 
     # locate all stars with more than 4 pixels in a filtered image
-    img, contours, hierarchy = cv2.findContours(
+    # (OpenCV 3 also returns the image, OpenCV 4 only contours and hierarchy)
+    contours, hierarchy = cv2.findContours(
         image=img,
         mode=cv2.RETR_EXTERNAL,
-        method=cv2.CHAIN_APPROX_SIMPLE)
+        method=cv2.CHAIN_APPROX_SIMPLE)[-2:]
     centroids = np.zeros((len(contours), 2), dtype="int")
 
     # Recolor image to allow coloration
@@ -84,6 +86,36 @@ def find_centroids(img, lower_thresh):
 
     return centroids, recolor_img
 
+##############################################################################
+def frame_fingerprint(img, step=4):
+    """Cheap fingerprint of a frame: its shape and the CRC32 of every step-th
+    pixel in each direction. A new frame from a real sensor always differs
+    somewhere in its noise, so an equal fingerprint means the same frame
+    was delivered again."""
+
+    sparse = np.ascontiguousarray(img[::step, ::step])
+    return img.shape, zlib.crc32(sparse)
+
+##############################################################################
+def star_snr(img, centroid, radius=4):
+    """Estimate the signal to noise ratio of a star at centroid in a BGR
+    image: its flux above the background in a box of the given radius,
+    over the background noise in that box. The background level and noise
+    come from the median and MAD of a sparse grid of pixels."""
+
+    gray = img[:, :, 1] if img.ndim == 3 else img
+    sparse = gray[::8, ::8].astype("float32")
+    background = np.median(sparse)
+    noise = max(1.4826 * np.median(np.abs(sparse - background)), 1.0)
+
+    (x, y) = (int(centroid[0]), int(centroid[1]))
+    box = gray[max(y - radius, 0):y + radius + 1, max(x - radius, 0):x + radius + 1]
+    if box.size == 0:
+        return float("nan")
+
+    flux = np.sum(box, dtype="float64") - background * box.size
+    return float(flux / (noise * np.sqrt(box.size)))
+
 ##############################################################################
 def markup_img(img, tracker):
     """Draw bounding circle and orthogonal axes on an image."""
@@ -100,6 +132,11 @@ def markup_img(img, tracker):
     axes = cv2.line(axes, (0, orgY), (orgX * 2, orgY), color=(110, 0, 0))
     marked_img = cv2.circle(axes, (orgX, orgY), radius=orgY, color=(110, 0, 0))
 
+    # lock position, when dithered away from the origin
+    if tuple(tracker.lockOffset) != (0, 0):
+        (lockX, lockY) = (int(round(v)) for v in tracker.lock_position())
+        cv2.drawMarker(marked_img, (lockX, lockY), (0, 150, 150), cv2.MARKER_CROSS, 12)
+
     return marked_img
 
 ##############################################################################
@@ -2,24 +2,89 @@
 #                                   main.py                                  #
 ##############################################################################
 
-import tkinter as tk
-from camera import Camera
-from uart import UART
-import gui
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+##############################################################################
+def open_camera():
+    from camera import Camera
+    return Camera()
+
+##############################################################################
+def open_uart():
+    from uart import UART
+    return UART()
+
+##############################################################################
+def attach_devices(root, App, camera, uart):
+    """Hand the devices to the app once both are open, polling from the Tk
+    loop. Quit if either failed to open."""
+
+    if not (camera.done() and uart.done()):
+        root.after(50, attach_devices, root, App, camera, uart)
+        return
+
+    for device in (camera, uart):
+        if device.exception() is not None:
+            root.destroy()
+            exit(getattr(device.exception(), "code", device.exception()))
+
+    App.attach_devices(camera.result(), uart.result())
 
 ##############################################################################
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Autoguiding Program")
+    parser.add_argument("--dec", type=float, default=None,
+                        help="declination of the target, reuses a stored calibration")
+    parser.add_argument("--pier", choices=("east", "west"), default="west", help="pier side")
+    parser.add_argument("--rot", type=float, default=0, help="camera rotation in degrees")
+    parser.add_argument("--log", default=None, metavar="DIR", help="record a guide log in DIR")
+    parser.add_argument("--record", default=None, metavar="DIR",
+                        help="record the session (frames, states, rates) in DIR for session.py")
+    parser.add_argument("--profile", type=int, default=None, metavar="FRAMES",
+                        help="profile the first FRAMES frames (F9 toggles profiling at runtime)")
+    parser.add_argument("--profile-mode", choices=("cprofile", "sample"), default="cprofile")
+    parser.add_argument("--metrics-port", type=int, default=None, metavar="PORT",
+                        help="serve Prometheus metrics on localhost:PORT")
+    args = parser.parse_args()
+
+    # open the two devices (camera warm up, UART handshake) in the background
+    # while the GUI is built, quit if either isn't connected
+    devices = ThreadPoolExecutor(max_workers=2, thread_name_prefix="device")
+    camera, uart = devices.submit(open_camera), devices.submit(open_uart)
+
+    import tkinter as tk
+    import gui
+
     # create Tk root widget
     root = tk.Tk()
     root.title('Autoguiding Program')
 
-    # open the two devices, quit if either isn't connected
-    cam = Camera()
-    uart = UART()
-
-    # start the main application
-    App = gui.MainApp(root, cam, uart)
+    # start the main application, the devices are attached when ready
+    App = gui.MainApp(root)
+    attach_devices(root, App, camera, uart)
+    if args.log is not None:
+        from guidelog import GuideLog
+        App.pipeline.log = GuideLog(args.log)
+    if args.metrics_port is not None:
+        from metrics import MetricsServer
+        metrics = MetricsServer(App.pipeline, args.metrics_port)
+        print(f"<serving metrics on http://127.0.0.1:{metrics.port}/metrics>")
+    App.profiler.mode = args.profile_mode
+    if args.profile is not None:
+        App.profiler.start(args.profile)
+    if args.dec is not None:
+        App.set_pointing(args.dec, args.pier, args.rot)
+    if args.record is not None:
+        from session import SessionRecorder
+        App.session = SessionRecorder(args.record)
+        App.session.attach(App.pipeline)
     App.update()
 
     root.mainloop()
+
+    if App.pipeline.log is not None:
+        App.pipeline.log.close()
+    if App.session is not None:
+        App.session.close()
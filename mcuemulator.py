@@ -0,0 +1,183 @@
+##############################################################################
+#                               mcuemulator.py                               #
+##############################################################################
+
+import argparse
+import os
+import select
+import threading
+import time
+import tty
+import numpy as np
+import protocol
+
+##############################################################################
+class MCUEmulator:
+    """Stand-in for the mount MCU on a pseudo-terminal pair (Linux/macOS).
+
+    UART(port=emulator.port) talks to it like the real firmware: ASCII rate
+    commands are echoed back and parsed, the binary protocol can be
+    negotiated and its frames are acknowledged. Every command received is
+    recorded as (time, raRate, decRate). A processing delay per read and
+    the wire time of the baud rate can be emulated to benchmark command
+    throughput and round trip latency."""
+
+    ####################################################################
+    def __init__(self, delay=0.0, baud=9600, emulateBaud=True, acceptBinary=True):
+        """Open the pty pair and start answering on the master side."""
+
+        self.delay = delay
+        self.baud = baud
+        self.emulateBaud = emulateBaud
+        self.acceptBinary = acceptBinary
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.binary = False
+        self.text = ""
+        self.tokens = []
+        self.parser = protocol.FrameParser()
+
+        self.received = []      # (time, raRate, decRate) of every command
+        self.bytesReceived = 0
+
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, name="mcu-emulator", daemon=True)
+        self.thread.start()
+
+    ####################################################################
+    def wire_time(self, nBytes):
+        """Time to move nBytes over the emulated link (8N1, 10 bits a byte)."""
+        return nBytes * 10 / self.baud if self.emulateBaud else 0.0
+
+    ####################################################################
+    def loop(self):
+        """Read whatever the host sent, process it, and answer."""
+
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+
+            self.bytesReceived += len(data)
+            time.sleep(self.wire_time(len(data)) + self.delay)
+
+            reply = self.process(data)
+            if reply:
+                time.sleep(self.wire_time(len(reply)))
+                os.write(self.master, reply)
+
+    ####################################################################
+    def process(self, data):
+        """Handle received bytes and return the reply."""
+
+        if self.binary:
+            reply = b""
+            for frame in self.parser.feed(data):
+                seq, raRate, decRate = protocol.decode_rates(frame)
+                self.received.append((time.monotonic(), raRate, decRate))
+                reply += protocol.encode_ack(seq)
+            return reply
+
+        # binary negotiation request, answered instead of echoed
+        self.text += data.decode('ascii', errors='replace')
+        if self.acceptBinary and "BIN" in self.text and self.text.rstrip(" ").endswith("\n"):
+            fields = self.text[self.text.index("BIN"):].split()
+            if len(fields) > 1 and fields[1].isdigit():
+                self.baud = int(fields[1])
+            self.binary = True
+            self.text = ""
+            return (protocol.NEGOTIATE_OK + "\n").encode('ascii')
+
+        # legacy protocol: echo, and read whitespace separated rate pairs
+        # (anything that isn't a number, e.g. the handshake, is skipped)
+        tokens = self.text.split()
+        if tokens and not self.text[-1].isspace():
+            self.text = tokens.pop()
+        else:
+            self.text = ""
+
+        for token in tokens:
+            try:
+                self.tokens.append(float(token))
+            except ValueError:
+                continue
+            if len(self.tokens) == 2:
+                self.received.append((time.monotonic(), self.tokens[0], self.tokens[1]))
+                self.tokens = []
+
+        return data
+
+    ####################################################################
+    def close(self):
+        """Stop the emulator and close both ends of the pty."""
+        self.running = False
+        self.thread.join(timeout=1)
+        os.close(self.master)
+        os.close(self.slave)
+
+
+##############################################################################
+def benchmark(uart, emulator, count, interval=0.0):
+    """Send count rate commands (every interval seconds, or as fast as
+    possible) and return throughput and latency statistics."""
+
+    start = time.perf_counter()
+    callTime = 0.0
+    for i in range(count):
+        callStart = time.perf_counter()
+        uart.transmit(i / count, -i / count)
+        callTime += time.perf_counter() - callStart
+        if interval:
+            time.sleep(interval)
+
+    # wait until every command sent has arrived, or nothing arrived for 2 s
+    lastCount, lastChange = -1, time.perf_counter()
+    while len(emulator.received) < uart.sent or uart.queue_depth():
+        if len(emulator.received) != lastCount:
+            lastCount, lastChange = len(emulator.received), time.perf_counter()
+        elif time.perf_counter() - lastChange > 2:
+            break
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(uart.latencies) * 1000
+    return {"transmitCallUs": 1e6 * callTime / count,
+            "sent": uart.sent,
+            "coalesced": uart.coalesced,
+            "received": len(emulator.received),
+            "commandsPerSec": len(emulator.received) / elapsed,
+            "bytesPerCommand": emulator.bytesReceived / max(len(emulator.received), 1),
+            "latencyMedianMs": float(np.median(latencies)) if len(latencies) else None,
+            "latencyP95Ms": float(np.percentile(latencies, 95)) if len(latencies) else None}
+
+
+##############################################################################
+if __name__ == "__main__":
+
+    from uart import UART
+
+    parser = argparse.ArgumentParser(description="Benchmark the UART against an emulated MCU.")
+    parser.add_argument("--protocol", choices=(protocol.ASCII, protocol.BINARY), default=protocol.ASCII)
+    parser.add_argument("--baud", type=int, default=9600, help="initial baud rate")
+    parser.add_argument("--fast-baud", type=int, default=None, help="baud rate to negotiate")
+    parser.add_argument("--delay", type=float, default=0.0, help="MCU processing delay in seconds")
+    parser.add_argument("--count", type=int, default=200, help="commands to send")
+    parser.add_argument("--interval", type=float, default=0.02, help="seconds between commands")
+    args = parser.parse_args()
+
+    emulator = MCUEmulator(delay=args.delay, baud=args.baud)
+    uart = UART(emulator.port, args.baud, args.protocol, args.fast_baud)
+    time.sleep(0.5)     # let the handshake echo finish
+
+    for key, value in benchmark(uart, emulator, args.count, args.interval).items():
+        print(f"\t{key}:\t{value}")
+
+    uart.disconnect()
+    emulator.close()
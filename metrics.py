@@ -0,0 +1,150 @@
+##############################################################################
+#                                 metrics.py                                 #
+##############################################################################
+
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+##############################################################################
+class MetricsServer:
+    """Serves guiding and pipeline metrics of a GuidePipeline in the
+    Prometheus text format on http://host:port/metrics, from a daemon
+    thread.
+
+    Nothing is computed on the guiding loop: every value is read from the
+    pipeline, its StatusHistory, and the UART when a scrape arrives, so an
+    unscraped server costs nothing and a scrape costs about as much as
+    formatting a few dozen lines."""
+
+    ####################################################################
+    def __init__(self, pipeline, port=9108, host="127.0.0.1"):
+        """Start serving the metrics of pipeline. Use port 0 to pick a free
+        port (see self.port)."""
+
+        self.pipeline = pipeline
+        self.scrapes = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = server.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass    # no console output per scrape
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+
+    ####################################################################
+    def collect(self):
+        """Current metrics as (name, type, help, [(labels, value)])."""
+
+        pipeline = self.pipeline
+        status, history, uart = pipeline.status, pipeline.history, pipeline.UART
+        stages = pipeline.lastTimings
+
+        # the guiding thread changes the history meanwhile
+        with history.lock:
+            rms = (history.rms_ra(), history.rms_dec(), history.rms_total())
+            (frameRate, peak) = (history.frame_rate(), history.peak())
+            (drift, snr) = (history.drift(), history.snr())
+
+        metrics = [
+            ("guide_frames_total", "counter", "Frames processed",
+             [({}, pipeline.frames)]),
+            ("guide_frames_unlocked_total", "counter", "Frames without a locked guide star",
+             [({}, pipeline.unlockedFrames)]),
+            ("guide_frames_skipped_total", "counter", "Frames skipped as repeats of the previous one",
+             [({}, status.skipped)]),
+            ("guide_frame_rate", "gauge", "Frames per second over the status history",
+             [({}, frameRate)]),
+            ("guide_stage_seconds", "gauge", "Wall clock time of each stage in the last frame",
+             [({"stage": stage}, seconds) for stage, seconds in stages.items()]),
+            ("guide_stars", "gauge", "Centroids found in the last frame",
+             [({}, pipeline.detections)]),
+            ("guide_detections_rejected_total", "counter", "Detections rejected as hot pixels",
+             [({}, pipeline.tracker.rejected)]),
+            ("guide_locked", "gauge", "1 if the guide star is locked",
+             [({}, int(status.mode == status.LOCKED))]),
+            ("guide_calibration_state", "gauge", "Calibration state machine state",
+             [({}, pipeline.calibration.state)]),
+            ("guide_rms_pixels", "gauge", "RMS guiding error over the status history",
+             [({"axis": "ra"}, rms[0]), ({"axis": "dec"}, rms[1]), ({"axis": "total"}, rms[2])]),
+            ("guide_peak_pixels", "gauge", "Peak guiding error over the status history",
+             [({}, peak)]),
+            ("guide_drift_pixels_per_minute", "gauge", "Drift of the guiding error",
+             [({"axis": "ra"}, drift[0]), ({"axis": "dec"}, drift[1])]),
+            ("guide_star_snr", "gauge", "Mean signal to noise ratio of the guide star",
+             [({}, snr)]),
+            ("guide_rate", "gauge", "Controller output rate",
+             [({"axis": "ra"}, status.raRate), ({"axis": "dec"}, status.decRate)]),
+        ]
+
+        # serial link, when it's a real UART
+        if hasattr(uart, "queue_depth"):
+            try:
+                latencies = sorted(uart.latencies)
+            except RuntimeError:    # appended to by the reader thread meanwhile
+                latencies = []
+            metrics += [
+                ("uart_queue_depth", "gauge", "Rate commands waiting for the writer",
+                 [({}, uart.queue_depth())]),
+                ("uart_commands_total", "counter", "Rate commands by outcome",
+                 [({"outcome": "queued"}, uart.queued), ({"outcome": "sent"}, uart.sent),
+                  ({"outcome": "coalesced"}, uart.coalesced)]),
+                ("uart_errors_total", "counter", "Failed serial reads or writes",
+                 [({}, uart.errors)]),
+                ("uart_latency_seconds", "gauge", "Median round trip of the recent commands",
+                 [({}, latencies[len(latencies) // 2] if latencies else float("nan"))]),
+            ]
+
+        metrics.append(("metrics_scrapes_total", "counter", "Scrapes served",
+                        [({}, self.scrapes)]))
+        return metrics
+
+    ####################################################################
+    def render(self):
+        """Metrics in the Prometheus text exposition format."""
+
+        self.scrapes += 1
+        lines = []
+        for (name, kind, description, samples) in self.collect():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (labels, value) in samples:
+                label = ",".join(f'{key}="{text}"' for key, text in labels.items())
+                lines.append(f"{name}{{{label}}} {format_value(value)}" if label
+                             else f"{name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    ####################################################################
+    def close(self):
+        """Stop serving."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+##############################################################################
+def format_value(value):
+    """Sample value as Prometheus writes it."""
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
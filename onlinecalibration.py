@@ -0,0 +1,192 @@
+##############################################################################
+#                            onlinecalibration.py                            #
+##############################################################################
+
+import numpy as np
+
+##############################################################################
+class OnlineCalibration:
+    """Refines the travel -> pixel matrix of a Calibration while guiding,
+    so it keeps up with flexure, cable drag, and a changing declination
+    without stopping to recalibrate.
+
+    Between two frames the star moves by the commanded travel (rate * time
+    between the frames) mapped through the pixel matrix, plus a drift:
+        p_k - p_k-1 = M u_k + d dt_k
+    M and d are tracked by recursive least squares with a forgetting factor,
+    which costs the same small amount of work every frame. The regressor is
+    [u_RA, u_DEC, dt], the two pixel coordinates share the covariance P.
+
+    While guiding well the corrections are mostly reactions to seeing, which
+    says little about M, so the estimate mostly learns from the larger
+    corrections after a disturbance or a dither.
+
+    Guards against the estimate running away:
+        + frames whose commanded motion is too small to stand out from the
+          seeing don't update the estimate (and don't wind up P), nor do
+          frames where a motor reversed and could still be taking up backlash
+        + frames whose innovation is far outside what P and the measured
+          noise predict are rejected (a lost or jumping star)
+        + the trace of P is capped
+        + a new matrix is only applied to the Calibration while it is well
+          conditioned, and the estimate is reset to the base calibration
+          if it strays too far from it, or too many frames in a row are
+          rejected"""
+
+    ####################################################################
+    def __init__(self, calibration, forgetting=0.99, minExcitation=2.5, gate=4.0,
+                 initialCovariance=1.0, maxTrace=100.0, minUpdates=20,
+                 maxCondition=10.0, maxRelativeChange=0.3, maxRejections=10, backlash=(0.0, 0.0)):
+        """Refine calibration in place.
+
+        forgetting is the RLS forgetting factor (about 1 / (1 - forgetting)
+        updates of memory), minExcitation how many standard deviations of
+        the frame noise the commanded travel must move the star before a
+        frame updates the estimate, gate the number of standard deviations
+        of innovation accepted, and minUpdates
+        the updates needed before the estimate is applied. The applied
+        matrix must have a condition number below maxCondition and differ
+        from the base by less than maxRelativeChange (Frobenius norm).
+        backlash is the (RA, DEC) travel a motor needs after reversing
+        before its motion is trusted again."""
+
+        self.calibration = calibration
+        self.forgetting = forgetting
+        self.minExcitation = minExcitation
+        self.gate = gate
+        self.initialCovariance = initialCovariance
+        self.maxTrace = maxTrace
+        self.minUpdates = minUpdates
+        self.maxCondition = maxCondition
+        self.maxRelativeChange = maxRelativeChange
+        self.maxRejections = maxRejections
+        self.backlash = np.asarray(backlash, dtype=float)
+
+        # the matrix last set on the calibration, to notice a recalibration
+        self.applied = None
+        self.base = None
+        self.resets = 0
+        self.reset()
+
+    ####################################################################
+    def reset(self):
+        """Restart the estimate from the calibration's current matrix."""
+
+        self.base = np.array(self.calibration.pixelMatrix, dtype=float)
+        self.applied = self.calibration.pixelMatrix
+
+        # parameters: rows are [u_RA, u_DEC, dt] -> pixel (x, y)
+        self.theta = np.vstack((self.base.T, np.zeros((1, 2))))
+        self.P = self.initialCovariance * np.eye(3)
+        self.noise = 1.0            # running innovation variance per pixel axis
+
+        self.prevCOM = None
+        self.prevTime = None
+        self.RARate = 0.0
+        self.DECRate = 0.0
+        self.directions = np.zeros(2)   # sign of the last travel of each motor
+        self.sinceReversal = np.zeros(2)  # travel of each motor since it reversed
+
+        self.updates = 0
+        self.rejections = 0
+
+    ####################################################################
+    def usable(self):
+        """Whether the calibration has a matrix worth refining."""
+        return self.base.any() and np.isfinite(np.linalg.cond(self.base))
+
+    ####################################################################
+    def set_rates(self, RARate, DECRate):
+        """Record the rates commanded after the latest frame."""
+        self.RARate = RARate
+        self.DECRate = DECRate
+
+    ####################################################################
+    def update(self, COM, timestamp, locked=True):
+        """Add the guide star displacement of a frame captured at timestamp,
+        refine the estimate, and apply it to the calibration if it passes
+        the guards. Return True if the calibration was changed."""
+
+        # recalibrated (or loaded from the cache) since the last frame
+        if self.calibration.pixelMatrix is not self.applied:
+            self.reset()
+
+        prevCOM, prevTime = self.prevCOM, self.prevTime
+        (self.prevCOM, self.prevTime) = (np.asarray(COM, dtype=float), timestamp) \
+            if locked and timestamp is not None else (None, None)
+
+        if prevCOM is None or self.prevCOM is None or not self.usable():
+            return False
+
+        dt = timestamp - prevTime
+        travel = np.array([self.RARate, self.DECRate]) * dt
+
+        # some of the travel of a motor that reversed went into backlash
+        directions = np.sign(travel)
+        self.sinceReversal = np.where(directions * self.directions < 0, 0, self.sinceReversal)
+        slack = np.any((self.sinceReversal < self.backlash) & (directions != 0))
+        self.sinceReversal += np.abs(travel)
+        self.directions = np.where(directions != 0, directions, self.directions)
+
+        if dt <= 0:
+            return False
+
+        phi = np.array([travel[0], travel[1], dt])
+        innovation = self.prevCOM - prevCOM - phi @ self.theta
+        Pphi = self.P @ phi
+        expected = 1 + phi @ Pphi
+
+        # innovation gating against the predicted spread
+        if innovation @ innovation > 2 * self.gate ** 2 * self.noise * expected:
+            self.rejections += 1
+            if self.rejections >= self.maxRejections:
+                print("<WARNING: online calibration keeps rejecting frames, reset>")
+                self.resets += 1
+                self.reset()
+            return False
+        self.rejections = 0
+        self.noise += 0.05 * (innovation @ innovation / (2 * expected) - self.noise)
+
+        # the commanded motion must stand out from the noise of the frames,
+        # or the noise that drove the correction biases the estimate
+        excitation = np.linalg.norm(self.base @ travel) / np.sqrt(self.noise)
+        if slack or excitation < self.minExcitation:
+            return False
+
+        # recursive least squares with forgetting
+        gain = Pphi / (self.forgetting + phi @ Pphi)
+        self.theta += np.outer(gain, innovation)
+        self.P = (self.P - np.outer(gain, Pphi)) / self.forgetting
+
+        # cap the covariance so unexcited directions can't wind up
+        trace = np.trace(self.P)
+        if trace > self.maxTrace:
+            self.P *= self.maxTrace / trace
+
+        self.updates += 1
+        return self.apply()
+
+    ####################################################################
+    def apply(self):
+        """Set the estimated matrix on the calibration if it passes the
+        guards, or fall back to the base matrix if it has diverged."""
+
+        if self.updates < self.minUpdates:
+            return False
+
+        estimate = self.theta[:2].T.copy()
+        change = np.linalg.norm(estimate - self.base) / np.linalg.norm(self.base)
+
+        if change > self.maxRelativeChange:
+            print(f"<WARNING: online calibration diverged ({change:.0%} change), reset>")
+            self.calibration.set_matrix(self.base)
+            self.resets += 1
+            self.reset()
+            return True
+
+        if np.linalg.cond(estimate) > self.maxCondition:
+            return False
+
+        self.calibration.set_matrix(estimate)
+        self.applied = self.calibration.pixelMatrix
+        return True
@@ -0,0 +1,163 @@
+##############################################################################
+#                                   pec.py                                   #
+##############################################################################
+
+import math
+import numpy as np
+
+##############################################################################
+class PeriodicErrorCorrector:
+    """Learns the periodic error of the RA worm gear while guiding and
+    predicts a feed-forward rate that cancels it before it shows up in the
+    frame.
+
+    The controller only ever sees the residual error, so each sample is
+    turned back into the open-loop "gear error" by adding the travel that
+    has been commanded so far. A constant, a linear drift, and the first few
+    harmonics of the worm period are then fitted by least squares over a
+    ring buffer of gear error samples. The normal equations are updated
+    incrementally as samples enter and leave the ring, so each update costs
+    the same no matter how large the ring is."""
+
+    ####################################################################
+    def __init__(self, period, harmonics=3, capacity=1024, gain=1.0, lead=0.0, minCoverage=0.5):
+        """Create a corrector for a worm period in seconds.
+
+        gain scales the feed-forward rate, lead is how many seconds ahead
+        of the sample time to predict (e.g. the actuation latency), and the
+        ring must span minCoverage periods before any correction is made."""
+
+        self.period = period
+        self.harmonics = harmonics
+        self.capacity = capacity
+        self.gain = gain
+        self.lead = lead
+        self.minCoverage = minCoverage
+
+        # terms: constant, drift, then a cosine and sine per harmonic
+        self.nTerms = 2 + 2 * harmonics
+        self.omega = 2 * math.pi / period * np.arange(1, harmonics + 1)
+        self.clear()
+
+    ####################################################################
+    def clear(self):
+        """Forget every sample and the fitted model."""
+
+        self.times = np.zeros(self.capacity)
+        self.rows = np.zeros((self.capacity, self.nTerms))
+        self.values = np.zeros(self.capacity)
+        self.count = 0          # number of samples in the ring
+        self.head = 0           # index of the next sample to write
+        self.pushes = 0         # samples since the normal equations were rebuilt
+
+        self.AtA = np.zeros((self.nTerms, self.nTerms))
+        self.Atb = np.zeros(self.nTerms)
+        self.coeffs = None
+
+        self.t0 = None          # time of the first sample, fit time origin
+        self.prevTime = None
+        self.travel = 0.0       # travel commanded since the first sample
+        self.rate = 0.0         # last commanded RA rate
+
+    ####################################################################
+    def basis(self, t):
+        """Row of the design matrix at time t."""
+        tau = t - self.t0
+        phase = self.omega * tau
+        return np.concatenate(([1.0, tau / self.period], np.cos(phase), np.sin(phase)))
+
+    ####################################################################
+    def set_rate(self, rate):
+        """Record the total RA rate commanded after the latest sample."""
+        self.rate = rate
+
+    ####################################################################
+    def advance(self, t):
+        """Add the travel of the commanded rate up to time t, e.g. for a
+        frame without a usable error."""
+        if self.prevTime is not None:
+            self.travel += self.rate * (t - self.prevTime)
+        self.prevTime = t
+
+    ####################################################################
+    def add_sample(self, t, err):
+        """Add the RA error (in controller input units) measured at time t
+        in seconds, and refit the model."""
+
+        if self.t0 is None:
+            self.t0 = t
+        self.advance(t)
+
+        # gear error: the residual error plus the correction applied so far
+        row, value = self.basis(t), err + self.travel
+
+        # evict the oldest sample once the ring is full
+        if self.count == self.capacity:
+            old = self.rows[self.head]
+            self.AtA -= np.outer(old, old)
+            self.Atb -= old * self.values[self.head]
+        else:
+            self.count += 1
+
+        self.times[self.head] = t
+        self.rows[self.head] = row
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+
+        self.AtA += np.outer(row, row)
+        self.Atb += row * value
+
+        # rebuild now and then so round-off from evictions can't accumulate
+        self.pushes += 1
+        if self.pushes >= self.capacity:
+            rows, values = self.rows[:self.count], self.values[:self.count]
+            self.AtA = rows.T @ rows
+            self.Atb = rows.T @ values
+            self.pushes = 0
+
+        self.fit()
+
+    ####################################################################
+    def coverage(self):
+        """Number of worm periods spanned by the samples in the ring."""
+        if self.count < 2:
+            return 0.0
+        oldest = self.times[self.head if self.count == self.capacity else 0]
+        newest = self.times[self.head - 1]
+        return (newest - oldest) / self.period
+
+    ####################################################################
+    def fit(self):
+        """Solve the normal equations, or leave the model unset while the
+        ring doesn't cover enough of the worm period."""
+
+        if self.count <= self.nTerms or self.coverage() < self.minCoverage:
+            self.coeffs = None
+            return
+
+        try:
+            self.coeffs = np.linalg.solve(self.AtA, self.Atb)
+        except np.linalg.LinAlgError:
+            self.coeffs = None
+
+    ####################################################################
+    def periodic_error(self, t):
+        """Fitted periodic component of the gear error at time t."""
+        if self.coeffs is None:
+            return 0.0
+        phase = self.omega * (t - self.t0)
+        (a, b) = self.coeffs[2:2 + self.harmonics], self.coeffs[2 + self.harmonics:]
+        return float(a @ np.cos(phase) + b @ np.sin(phase))
+
+    ####################################################################
+    def feed_forward(self, t):
+        """Rate that cancels the predicted rate of change of the periodic
+        error at time t + lead."""
+
+        if self.coeffs is None:
+            return 0.0
+
+        phase = self.omega * (t + self.lead - self.t0)
+        (a, b) = self.coeffs[2:2 + self.harmonics], self.coeffs[2 + self.harmonics:]
+        slope = self.omega @ (b * np.cos(phase) - a * np.sin(phase))
+        return self.gain * float(slope)
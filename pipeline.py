@@ -0,0 +1,254 @@
+##############################################################################
+#                                pipeline.py                                 #
+##############################################################################
+
+import math
+import time
+import numpy as np
+from imageprocessing import find_centroids, frame_fingerprint, star_snr
+from centroidtracker import CentroidTracker
+from calibration import Calibration
+from controller import Controller
+from dither import Ditherer
+from drift import DriftEstimator
+from onlinecalibration import OnlineCalibration
+from statushistory import StatusHistory
+
+##############################################################################
+class GuidePipeline:
+    """The guiding steps of the MainApp without any of the GUI: find the
+    stars in a frame, track the guide star, calibrate, and send controller
+    rates over a UART. Anything with a transmit(raRate, decRate) method can
+    act as the UART, which lets the loop run headless (e.g. simulator.py)."""
+
+    ####################################################################
+    def __init__(self, uart, tracker=None, calibration=None, controller=None, online=True,
+                 drift=True):
+        """Create a pipeline around a UART, with default tracker,
+        calibration, and controller instances unless given. With online
+        the calibration is refined while guiding, with drift the drift of
+        the star is fed forward into the controller rates."""
+
+        self.tracker = tracker if tracker is not None else CentroidTracker()
+        self.calibration = calibration if calibration is not None else Calibration()
+        self.controller = controller if controller is not None else Controller()
+        self.online = OnlineCalibration(self.calibration) if online else None
+        self.dither = Ditherer(self)
+        self.drift = DriftEstimator(self.calibration) if drift else None
+        self.UART = uart
+        self.threshold = 5
+
+        # clock for capture timestamps (replaced by the simulated clock in
+        # simulator.py), and a running average of the time UART.transmit takes
+        self.clock = time.monotonic
+        self.transmitTime = 0.0
+
+        # per-frame record for the guide log (a guidelog.GuideLog, if any):
+        # wall clock seconds spent in each stage, centroids found, and the
+        # controller inputs
+        self.log = None
+        self.timings = dict.fromkeys(("find", "track", "control", "transmit"), 0.0)
+        self.detections = 0
+        self.errors = (0.0, 0.0)
+
+        # guiding quality statistics over the last frames, and the SNR of
+        # the guide star in the latest one (only known for rendered frames)
+        self.history = StatusHistory()
+        self.snr = math.nan
+
+        # counters for the metrics endpoint, and the timings of the last frame
+        self.frames = 0
+        self.unlockedFrames = 0
+        self.lastTimings = dict(self.timings)
+
+        # fingerprint and binary image of the last frame exposed, to skip
+        # frames the camera (or a replay) delivers twice
+        self.fingerprint = None
+        self.colored_img = None
+        self.unchanged = False
+
+    ####################################################################
+    @property
+    def status(self):
+        return self.tracker.status
+
+    ####################################################################
+    def expose(self, img, timestamp=None):
+        """Find the stars in an image captured at timestamp (now if not
+        given), update the tracker, and autoselect a guide star if
+        searching. Return the binary image recolored to BGR.
+
+        A frame identical to the previous one isn't processed again: the
+        previous detections and tracker result are kept, only the image
+        number advances, and self.unchanged tells the caller not to
+        calibrate or guide on it."""
+
+        fingerprint = frame_fingerprint(img)
+        self.unchanged = fingerprint == self.fingerprint
+        if self.unchanged:
+            self.status.img_num += 1
+            self.status.skipped += 1
+            return self.colored_img
+        self.fingerprint = fingerprint
+
+        if timestamp is None:
+            timestamp = self.clock()
+
+        # locate the centroids as a list of (x, y) tuples and get binary thresholded image
+        start = time.perf_counter()
+        centroids, colored_img = find_centroids(img, lower_thresh=self.threshold)
+        self.timings["find"] = time.perf_counter() - start
+
+        self.track(centroids, timestamp)
+        if self.status.mode == self.tracker.LOCKED:
+            (dX, dY) = self.status.COM
+            (lockX, lockY) = self.tracker.lock_position()
+            self.snr = star_snr(img, (lockX + dX, lockY - dY))
+        self.colored_img = colored_img
+        return colored_img
+
+    ####################################################################
+    def track(self, centroids, timestamp=None):
+        """Update the tracker with a list of centroids found in a frame
+        captured at timestamp, and return the displacement of the guide
+        star from the origin."""
+
+        if timestamp is None:
+            timestamp = self.clock()
+        start = time.perf_counter()
+        self.unchanged = False
+
+        # update the Tracker object for the next list of input centroids
+        dX, dY = self.tracker.update(centroids)
+        self.detections = len(centroids)
+        self.snr = math.nan
+
+        # if the mode is SEARCHING, autoselect a guide star
+        if self.status.mode == self.tracker.SEARCHING:
+            self.tracker.autoselect(None)
+
+            # measure the new guide star now rather than reporting it locked at (0, 0)
+            if self.status.mode == self.tracker.LOCKED:
+                dX, dY = self.tracker.update_trackstar()
+
+        # Update status object incremented image number, mode, and displacement
+        self.status.set(self.status.img_num + 1, self.status.mode, (dX, dY), timestamp=timestamp)
+        self.timings["track"] = time.perf_counter() - start
+        return dX, dY
+
+    ####################################################################
+    def run(self):
+        """Convert the pixel error of the guide star into motor rates with
+        the conversion matrix and controller, and transmit them."""
+
+        # Fetch distance from origin
+        dX, dY = self.status.COM
+        start = time.perf_counter()
+
+        # Watch the star settle after a dither
+        self.dither.update(self.status, self.status.mode == self.tracker.LOCKED)
+
+        # Refine the calibration with how far the last rates moved the star
+        if self.online is not None:
+            self.online.update((dX, dY), self.status.timestamp,
+                               self.status.mode == self.tracker.LOCKED)
+
+        # Estimate the drift from where the star would be without the
+        # corrections, and hand the rates cancelling it to the controller
+        if self.drift is not None:
+            (lockX, lockY) = self.tracker.lockOffset
+            self.controller.feedForward = self.drift.update(
+                (dX + lockX, dY + lockY), self.status.timestamp,
+                self.status.mode == self.tracker.LOCKED, self.tracker.trackID)
+
+        # Plug into conversion matrix
+        calRARate, calDECRate = self.calibration.calculate_rates((dX, dY))
+        self.errors = (calRARate, calDECRate)
+
+        # Latency from capture until the rates reach the MCU: the time spent
+        # so far plus the average time a transmit takes
+        latency = self.clock() - self.status.timestamp + self.transmitTime
+
+        # Get rates from PI Controller
+        raRate, decRate = self.controller.calculate(calRARate, calDECRate,
+                                                    self.status.timestamp, latency,
+                                                    self.status.mode == self.tracker.LOCKED)
+
+        # Transmit calculated motor rates over UART
+        self.timings["control"] = time.perf_counter() - start
+        (start, clockStart) = (time.perf_counter(), self.clock())
+        self.UART.transmit(raRate, decRate)
+        self.timings["transmit"] = time.perf_counter() - start
+        self.transmitTime += 0.2 * (self.clock() - clockStart - self.transmitTime)
+
+        # Update status object motor rates
+        self.status.set_rates(raRate, decRate)
+        if self.online is not None:
+            self.online.set_rates(raRate, decRate)
+        if self.drift is not None:
+            self.drift.set_rates(raRate, decRate)
+        return raRate, decRate
+
+    ####################################################################
+    def calibrate(self):
+        """Step the calibration state machine once. Return True once the
+        calibration has finished and the conversion matrix is computed."""
+
+        # a finished calibration (fitted or loaded) can't be stepped, so
+        # this starts a new one
+        if self.calibration.state == self.calibration.DONE:
+            self.calibration.reset()
+
+        # tell motors what to do and record data samples if necessary
+        self.calibration.execute(self.UART, self.status)
+
+        # next state logic based on calibration state
+        self.calibration.next_state()
+
+        # update status object for current calibration rates
+        self.status.set_rates(self.calibration.RARate, self.calibration.DECRate)
+
+        # run least squares to get conversion matrix after calibration finishes,
+        # and start over if it can't be fitted
+        if self.calibration.state == self.calibration.DONE:
+            if self.calibration.least_squares():
+                return True
+            print("<WARNING: calibration fit failed, calibrate again>")
+            self.calibration.reset()
+        return False
+
+    ####################################################################
+    def record(self):
+        """Add the frame that just finished to the status history and the
+        guide log, if any. Stage timings of steps that didn't run this
+        frame are 0."""
+
+        status = self.status
+        (dX, dY) = status.COM
+        (lockX, lockY) = self.tracker.lock_position()
+        if not self.unchanged:
+            self.history.add(status, *self.axis_errors(), snr=self.snr)
+
+        if self.log is not None:
+            self.log.append((status.timestamp, status.img_num, status.mode, self.calibration.state,
+                             self.detections, lockX + dX, lockY - dY,
+                             dX, dY, self.errors[0], self.errors[1], status.raRate, status.decRate,
+                             self.timings["find"], self.timings["track"],
+                             self.timings["control"], self.timings["transmit"]))
+
+        self.frames += 1
+        if status.mode != self.tracker.LOCKED:
+            self.unlockedFrames += 1
+        self.lastTimings = dict(self.timings)
+        for stage in self.timings:
+            self.timings[stage] = 0.0
+
+    ####################################################################
+    def axis_errors(self):
+        """Error of the guide star in pixels along the RA/DEC axes of the
+        calibration, or along the frame axes before one."""
+
+        scale = np.linalg.norm(self.calibration.pixelMatrix, axis=0)
+        if not scale.all():
+            return self.status.COM
+        return tuple(-self.calibration.calculate_rates(self.status.COM) * scale)
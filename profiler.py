@@ -0,0 +1,218 @@
+##############################################################################
+#                                 profiler.py                                #
+##############################################################################
+
+import collections
+import cProfile
+import functools
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+# Profiling modes
+CPROFILE = "cprofile"   # deterministic, written as .pstats (snakeviz, flameprof, gprof2dot)
+SAMPLE = "sample"       # statistical stack sampling, written as folded stacks (flamegraph.pl, speedscope)
+
+##############################################################################
+class FrameProfiler:
+    """Profiles the guiding loop for a window of frames, switched on at
+    runtime (e.g. a GUI key or a CLI flag).
+
+    start() installs timing wrappers as instance attributes over the
+    guiding methods of a GuidePipeline (and of the MainApp, if given), and
+    over the tracker, controller, and calibration calls they make. stop()
+    puts back what was there before, so while profiling is off nothing
+    runs on the hot path, and other hooks on the same methods (e.g. a
+    SessionRecorder's) stay in place whichever came first. Frames are
+    counted by GuidePipeline.record(), and profiling stops by itself after
+    the requested number of frames.
+
+    Results are written to directory with a common time stamped prefix:
+        + .pstats or .folded - cProfile statistics or sampled stacks
+        + .calls.txt         - calls, total, mean and max time per method
+        + .tracemalloc       - tracemalloc snapshot (and a .memory.txt top list)"""
+
+    ####################################################################
+    def __init__(self, pipeline, app=None, directory="profiles", mode=CPROFILE,
+                 memory=True, sampleInterval=0.005):
+        self.pipeline = pipeline
+        self.app = app
+        self.directory = directory
+        self.mode = mode
+        self.memory = memory
+        self.sampleInterval = sampleInterval
+
+        self.active = False
+        self.installed = []
+        self.generation = 0
+        self.lastPrefix = None
+
+    ####################################################################
+    def targets(self):
+        """(object, method name) pairs to wrap."""
+
+        pipeline = self.pipeline
+        targets = [(pipeline, "expose"), (pipeline, "track"), (pipeline, "run"),
+                   (pipeline, "calibrate"), (pipeline.tracker, "update"),
+                   (pipeline.tracker, "autoselect"), (pipeline.controller, "calculate"),
+                   (pipeline.calibration, "execute"), (pipeline.calibration, "least_squares"),
+                   (pipeline.UART, "transmit")]
+        if self.app is not None:
+            targets += [(self.app, "expose"), (self.app, "run"), (self.app, "calibrate")]
+        return [(obj, name) for (obj, name) in targets if hasattr(obj, name)]
+
+    ####################################################################
+    def start(self, frames=100):
+        """Profile the next frames frames."""
+
+        if self.active:
+            return
+        self.active = True
+        self.generation += 1
+        self.framesLeft = frames
+        self.framesProfiled = 0
+        self.calls = collections.defaultdict(lambda: [0, 0.0, 0.0])   # count, total, max
+        self.depth = 0
+        self.startTime = time.perf_counter()
+
+        if self.memory:
+            tracemalloc.start(25)
+
+        if self.mode == CPROFILE:
+            self.profile = cProfile.Profile()
+        else:
+            self.stacks = collections.Counter()
+            self.samplerThread = threading.get_ident()
+            self.sampler = threading.Thread(target=self.sample_loop, name="profiler", daemon=True)
+            self.sampler.start()
+
+        for (obj, name) in self.targets():
+            self.install(obj, name)
+        self.install(self.pipeline, "record", frame=True)
+
+        print(f"<profiling {frames} frames ({self.mode})>")
+
+    ####################################################################
+    def install(self, obj, name, frame=False):
+        """Shadow a bound method with a timing wrapper on the instance."""
+
+        method = getattr(obj, name)
+        label = f"{type(obj).__name__}.{name}"
+        generation = self.generation
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            # left in place under a later hook once this run has stopped
+            if not self.active or generation != self.generation:
+                return method(*args, **kwargs)
+
+            outermost = self.depth == 0
+            if outermost and self.mode == CPROFILE:
+                self.profile.enable()
+            self.depth += 1
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.depth -= 1
+                if outermost and self.mode == CPROFILE:
+                    self.profile.disable()
+
+                stats = self.calls[label]
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+
+                if frame:
+                    self.frame_done()
+
+        self.installed.append((obj, name, wrapper, obj.__dict__.get(name)))
+        setattr(obj, name, wrapper)
+
+    ####################################################################
+    def frame_done(self):
+        self.framesProfiled += 1
+        self.framesLeft -= 1
+        if self.framesLeft <= 0:
+            self.stop()
+
+    ####################################################################
+    def sample_loop(self):
+        """Sampler thread: record the stack of the profiled thread."""
+
+        while self.active:
+            frame = sys._current_frames().get(self.samplerThread)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.sampleInterval)
+
+    ####################################################################
+    def stop(self):
+        """Remove the wrappers and write the results. Return the common
+        path prefix of the files written."""
+
+        if not self.active:
+            return None
+        self.active = False
+
+        # back to what was there before, unless hooked again since
+        for (obj, name, wrapper, previous) in reversed(self.installed):
+            if obj.__dict__.get(name) is not wrapper:
+                continue
+            if previous is None:
+                obj.__dict__.pop(name, None)
+            else:
+                setattr(obj, name, previous)
+        self.installed = []
+
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = base = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S"))
+        for i in range(1, 100):
+            if not os.path.exists(prefix + ".calls.txt"):
+                break
+            prefix = f"{base}-{i}"
+        elapsed = time.perf_counter() - self.startTime
+
+        if self.mode == CPROFILE:
+            self.profile.dump_stats(prefix + ".pstats")
+        else:
+            self.sampler.join()
+            with open(prefix + ".folded", "w") as f:
+                for (stack, count) in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+
+        with open(prefix + ".calls.txt", "w") as f:
+            f.write(f"{self.framesProfiled} frames in {elapsed:.3f} s\n\n")
+            f.write(f"{'method':<36}{'calls':>8}{'total ms':>12}{'mean ms':>10}{'max ms':>10}\n")
+            for (label, (count, total, longest)) in sorted(self.calls.items(),
+                                                           key=lambda item: -item[1][1]):
+                f.write(f"{label:<36}{count:>8}{1e3 * total:>12.3f}"
+                        f"{1e3 * total / count:>10.3f}{1e3 * longest:>10.3f}\n")
+
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            snapshot.dump(prefix + ".tracemalloc")
+            with open(prefix + ".memory.txt", "w") as f:
+                for stat in snapshot.statistics("lineno")[:30]:
+                    f.write(f"{stat}\n")
+
+        self.lastPrefix = prefix
+        print(f"<profile written to {prefix}.*>")
+        return prefix
+
+    ####################################################################
+    def toggle(self, frames=100):
+        """Start profiling, or stop early if already profiling."""
+        if self.active:
+            self.stop()
+        else:
+            self.start(frames)
@@ -0,0 +1,143 @@
+##############################################################################
+#                                protocol.py                                 #
+##############################################################################
+
+import struct
+
+# Protocols spoken over the UART
+ASCII = "ascii"     # legacy: f" {raRate:.3f} {decRate:.3f}  ", echoed by the MCU
+BINARY = "binary"   # framed binary rates, acknowledged by the MCU
+
+# Binary rate frame (8 bytes):
+#   sync (0xA5) | sequence (u8) | RA rate (i16) | DEC rate (i16) | CRC-16 (u16)
+# Rates are fixed point in thousandths (the 3 decimals of the ASCII format),
+# little endian, and the CRC-16/CCITT-FALSE covers the sequence and rates.
+SYNC = 0xA5
+RATE_SCALE = 1000
+FRAME = struct.Struct("<BBhhH")
+FRAME_SIZE = FRAME.size
+RATE_LIMIT = 32767 / RATE_SCALE
+
+# Acknowledgement frame from the MCU (3 bytes):
+#   sync (0x5A) | sequence (u8) | CRC-8 of the sequence
+ACK_SYNC = 0x5A
+ACK_SIZE = 3
+
+# Negotiation: the host asks in ASCII to switch to binary (optionally at a new
+# baud rate) and the MCU answers "OK" before both sides switch
+NEGOTIATE = "\nBIN {baud}\n"
+NEGOTIATE_OK = "OK"
+
+##############################################################################
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+def _crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x07) if crc & 0x80 else (crc << 1)
+        table.append(crc & 0xFF)
+    return table
+
+CRC16_TABLE = _crc16_table()
+CRC8_TABLE = _crc8_table()
+
+##############################################################################
+def crc16(data):
+    """CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF) of a bytes object."""
+    crc = 0xFFFF
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+##############################################################################
+def crc8(data):
+    """CRC-8 (poly 0x07, init 0x00) of a bytes object."""
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+##############################################################################
+def to_fixed(rate):
+    """Rate as a clamped fixed point integer in thousandths."""
+    return int(round(max(-RATE_LIMIT, min(RATE_LIMIT, rate)) * RATE_SCALE))
+
+##############################################################################
+def encode_ascii(raRate, decRate):
+    """Legacy ASCII rate command, with extra spaces to ensure the MCU
+    program catches all characters."""
+    return f" {raRate:.3f} {decRate:.3f}  ".encode('ascii')
+
+##############################################################################
+def encode_rates(seq, raRate, decRate):
+    """Binary rate frame for a sequence number and RA/DEC rates."""
+    body = struct.pack("<Bhh", seq & 0xFF, to_fixed(raRate), to_fixed(decRate))
+    return bytes([SYNC]) + body + struct.pack("<H", crc16(body))
+
+##############################################################################
+def decode_rates(frame):
+    """Decode a binary rate frame into (seq, raRate, decRate), or return
+    None if the sync byte or CRC is wrong."""
+    sync, seq, ra, dec, crc = FRAME.unpack(frame)
+    if sync != SYNC or crc != crc16(frame[1:-2]):
+        return None
+    return seq, ra / RATE_SCALE, dec / RATE_SCALE
+
+##############################################################################
+def encode_ack(seq):
+    """Acknowledgement frame for a sequence number."""
+    return bytes([ACK_SYNC, seq & 0xFF, crc8(bytes([seq & 0xFF]))])
+
+##############################################################################
+class FrameParser:
+    """Incrementally splits a byte stream into frames of a fixed size that
+    start with a sync byte, resynchronising on corrupt data. Works for both
+    rate frames (MCU side) and acknowledgements (host side)."""
+
+    ####################################################################
+    def __init__(self, sync=SYNC, size=FRAME_SIZE):
+        self.sync = sync
+        self.size = size
+        self.buffer = bytearray()
+        self.crcErrors = 0
+
+    ####################################################################
+    def valid(self, frame):
+        if self.sync == ACK_SYNC:
+            return crc8(frame[1:2]) == frame[2]
+        return crc16(frame[1:-2]) == struct.unpack("<H", frame[-2:])[0]
+
+    ####################################################################
+    def feed(self, data):
+        """Add received bytes and return the list of complete valid frames.
+        Bytes before a sync byte (e.g. ASCII text) are skipped."""
+
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(self.sync)
+            if start < 0:
+                self.buffer.clear()
+                break
+            if len(self.buffer) - start < self.size:
+                del self.buffer[:start]
+                break
+
+            frame = bytes(self.buffer[start:start + self.size])
+            if self.valid(frame):
+                frames.append(frame)
+                del self.buffer[:start + self.size]
+            else:
+                # not a frame after all, look for the next sync byte
+                self.crcErrors += 1
+                del self.buffer[:start + 1]
+        return frames
@@ -0,0 +1,458 @@
+##############################################################################
+#                                 session.py                                 #
+##############################################################################
+
+import argparse
+import copyreg
+import glob
+import json
+import os
+import pickle
+import queue
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# What the pipeline did with a frame after exposing it
+(NONE, CAL, RUN) = range(3)
+
+INITIAL = "initial.pkl"
+EVENTS = "events.jsonl"
+CHUNK = "chunk-{:05d}.npz"
+
+##############################################################################
+class SessionRecorder:
+    """Records everything a GuidePipeline consumes, so a session from the
+    field can be replayed exactly with replay():
+        + the pipeline state when recording starts (tracker, calibration,
+          controller, online calibration)
+        + every raw frame with its timestamp and threshold (a frame that
+          repeats the previous one is only marked as such)
+        + whether the frame was calibrated on or guided on
+        + dithers of the lock position before the frame
+        + every reading of the pipeline clock
+        + every UART.transmit payload
+        + the tracker state and rates that came out, to diff against
+    GUI state transitions and transmits made outside the pipeline's steps
+    (e.g. the stop button) go to an event log.
+
+    Like the FrameProfiler, attach() wraps the pipeline's methods with
+    instance attributes and detach() puts back what was there before, so
+    the two can hook the same methods in either order. Frames are gathered into chunks of
+    chunkFrames, which a background thread writes as compressed .npz
+    files."""
+
+    ####################################################################
+    def __init__(self, directory, chunkFrames=64):
+        self.directory = directory
+        self.chunkFrames = chunkFrames
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, "chunk-*.npz")):
+            os.remove(path)
+
+        self.pipeline = None
+        self.chunk = []
+        self.chunks = 0
+        self.frames = 0
+        self.current = None
+        self.hooks = []
+        self.stepping = False
+        self.lastState = None
+
+        self.events = open(os.path.join(directory, EVENTS), "w")
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, name="session", daemon=True)
+        self.writer.start()
+
+    ####################################################################
+    def attach(self, pipeline):
+        """Snapshot the pipeline state and start recording its frames."""
+
+        self.pipeline = pipeline
+        with open(os.path.join(self.directory, INITIAL), "wb") as f:
+            SnapshotPickler(f).dump({"tracker": pipeline.tracker,
+                                     "calibration": pipeline.calibration,
+                                     "controller": pipeline.controller, "online": pipeline.online,
+                                     "drift": pipeline.drift,
+                                     "threshold": pipeline.threshold,
+                                     "transmitTime": pipeline.transmitTime})
+
+        (expose, calibrate, run, record) = (pipeline.expose, pipeline.calibrate,
+                                            pipeline.run, pipeline.record)
+        (clock, uart) = (pipeline.clock, pipeline.UART)
+        dither = pipeline.dither.dither
+
+        def recorded_expose(img, timestamp=None):
+            entry = self.entry()
+            entry["timestamp"] = np.nan if timestamp is None else timestamp
+            entry["threshold"] = pipeline.threshold
+            colored_img = expose(img, timestamp)
+            entry["repeat"] = pipeline.unchanged
+            entry["img"] = None if pipeline.unchanged else np.array(img)
+            return colored_img
+
+        def step(method, action):
+            def recorded_step():
+                self.entry()["action"] = action
+                self.stepping = True
+                try:
+                    return method()
+                finally:
+                    self.stepping = False
+            return recorded_step
+
+        def recorded_record():
+            record()
+            self.end_frame()
+
+        def recorded_dither(offset=None, timestamp=None):
+            offset = dither(offset, timestamp)
+            self.entry()["dither"] = offset
+            return offset
+
+        def recorded_clock():
+            now = clock()
+            self.entry()["clock"].append(now)
+            return now
+
+        self.hook(pipeline, "expose", recorded_expose)
+        self.hook(pipeline, "calibrate", step(calibrate, CAL))
+        self.hook(pipeline, "run", step(run, RUN))
+        self.hook(pipeline, "record", recorded_record)
+        self.hook(pipeline, "clock", recorded_clock)
+        self.hook(pipeline.dither, "dither", recorded_dither)
+        self.attach_uart(uart)
+        self.event("start")
+
+    ####################################################################
+    def hook(self, obj, name, wrapper):
+        """Shadow an attribute of obj with wrapper, remembering what was
+        there for detach()."""
+
+        method = getattr(obj, name)
+        def hooked(*args, **kwargs):
+            # left in place under a later hook once detached
+            if self.pipeline is None:
+                return method(*args, **kwargs)
+            return wrapper(*args, **kwargs)
+
+        self.hooks.append((obj, name, hooked, obj.__dict__.get(name)))
+        setattr(obj, name, hooked)
+
+    ####################################################################
+    def attach_uart(self, uart):
+        """Record the payloads sent to uart, e.g. once it's open."""
+        self.uart = uart
+        self.pipeline.UART = RecordingUART(uart, self)
+
+    ####################################################################
+    def detach(self):
+        """Stop recording and put the pipeline back as it was."""
+
+        pipeline = self.pipeline
+        if pipeline is None:
+            return
+        for (obj, name, hooked, previous) in reversed(self.hooks):
+            if obj.__dict__.get(name) is not hooked:
+                continue
+            if previous is None:
+                obj.__dict__.pop(name, None)
+            else:
+                setattr(obj, name, previous)
+        self.hooks = []
+        pipeline.UART = self.uart
+        self.pipeline = None
+
+    ####################################################################
+    def entry(self):
+        """Record of the frame being processed."""
+        if self.current is None:
+            self.current = {"timestamp": np.nan, "threshold": 0, "repeat": False, "img": None,
+                            "action": NONE, "dither": (np.nan, np.nan), "clock": [],
+                            "transmits": []}
+        return self.current
+
+    ####################################################################
+    def transmit(self, raRate, decRate):
+        """Record a UART payload, with the frame if the pipeline sent it."""
+        if self.stepping:
+            self.entry()["transmits"].append((raRate, decRate))
+        else:
+            self.event("transmit", raRate=raRate, decRate=decRate)
+
+    ####################################################################
+    def state(self, **flags):
+        """Record the GUI state flags when they change."""
+        if flags != self.lastState:
+            self.lastState = dict(flags)
+            self.event("state", **flags)
+
+    ####################################################################
+    def event(self, kind, **data):
+        self.events.write(json.dumps({"event": kind, "frame": self.frames,
+                                      "time": time.time(), **data}) + "\n")
+
+    ####################################################################
+    def end_frame(self):
+        """Add the results of the frame to the chunk."""
+
+        entry, pipeline = self.entry(), self.pipeline
+        status = pipeline.status
+        entry.update(mode=status.mode, trackID=pipeline.tracker.trackID,
+                     dX=status.COM[0], dY=status.COM[1], calState=pipeline.calibration.state,
+                     raRate=status.raRate, decRate=status.decRate)
+        self.current = None
+        self.frames += 1
+
+        # a chunk holds frames of one shape
+        if entry["img"] is not None and self.chunk and any(
+                other["img"] is not None and other["img"].shape != entry["img"].shape
+                for other in self.chunk):
+            self.flush()
+        self.chunk.append(entry)
+        if len(self.chunk) >= self.chunkFrames:
+            self.flush()
+
+    ####################################################################
+    def flush(self):
+        """Hand the chunk to the writer thread."""
+        if self.chunk:
+            self.queue.put((self.chunks, self.chunk))
+            self.chunks += 1
+            self.chunk = []
+        self.events.flush()
+
+    ####################################################################
+    def write_loop(self):
+        """Writer thread: save chunks as compressed arrays."""
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            (number, chunk) = item
+            images = [entry["img"] for entry in chunk if entry["img"] is not None]
+            arrays = {key: np.array([entry[key] for entry in chunk])
+                      for key in ("timestamp", "threshold", "repeat", "action", "dither", "mode",
+                                  "trackID", "dX", "dY", "calState", "raRate", "decRate")}
+
+            # variable length lists as flat arrays with a count per frame
+            arrays["clock"] = np.array([t for entry in chunk for t in entry["clock"]], dtype="f8")
+            arrays["clockCount"] = np.array([len(entry["clock"]) for entry in chunk])
+            arrays["transmits"] = np.array([payload for entry in chunk
+                                            for payload in entry["transmits"]],
+                                           dtype="f8").reshape(-1, 2)
+            arrays["transmitCount"] = np.array([len(entry["transmits"]) for entry in chunk])
+            if images:
+                arrays["images"] = np.stack(images)
+
+            path = os.path.join(self.directory, CHUNK.format(number))
+            np.savez_compressed(path + ".tmp.npz", **arrays)
+            os.replace(path + ".tmp.npz", path)
+
+    ####################################################################
+    def close(self):
+        """Detach, write what's left, and wait for the writer."""
+
+        self.detach()
+        self.event("stop")
+        self.flush()
+        self.queue.put(None)
+        self.writer.join()
+        self.events.close()
+        print(f"<session of {self.frames} frames recorded in {self.directory}>")
+
+
+##############################################################################
+class SnapshotPickler(pickle.Pickler):
+    """Pickles objects without the wrappers hooked onto their instances
+    (e.g. by a running FrameProfiler), so they load with the plain class
+    methods."""
+
+    ####################################################################
+    def reducer_override(self, obj):
+        state = getattr(obj, "__dict__", None)
+        if isinstance(obj, type) or not isinstance(state, dict) \
+                or not any(isinstance(value, types.FunctionType) for value in state.values()):
+            return NotImplemented
+        plain = {key: value for (key, value) in state.items()
+                 if not isinstance(value, types.FunctionType)}
+        return (copyreg.__newobj__, (type(obj),), plain)
+
+
+##############################################################################
+class RecordingUART:
+    """Passes everything on to a UART, recording transmit() payloads."""
+
+    ####################################################################
+    def __init__(self, uart, recorder):
+        self.uart = uart
+        self.recorder = recorder
+
+    ####################################################################
+    def transmit(self, raRate, decRate):
+        self.recorder.transmit(raRate, decRate)
+        return self.uart.transmit(raRate, decRate)
+
+    ####################################################################
+    def __getattr__(self, name):
+        return getattr(self.uart, name)
+
+
+##############################################################################
+class ReplayUART:
+    """Collects the payloads the replayed pipeline transmits."""
+
+    def __init__(self):
+        self.transmits = []
+
+    def transmit(self, raRate, decRate):
+        self.transmits.append((raRate, decRate))
+
+
+##############################################################################
+def load_chunks(directory):
+    """Chunks of a recorded session in order, each loaded (and decompressed)
+    in a background thread while the previous one is replayed."""
+
+    paths = sorted(glob.glob(os.path.join(directory, "chunk-*.npz")))
+    with ThreadPoolExecutor(max_workers=1) as loader:
+        load = lambda path: dict(np.load(path))
+        pending = loader.submit(load, paths[0]) if paths else None
+        for i in range(len(paths)):
+            chunk = pending.result()
+            if i + 1 < len(paths):
+                pending = loader.submit(load, paths[i + 1])
+            yield chunk
+
+##############################################################################
+def replay(directory, tolerance=1e-9):
+    """Feed a recorded session through a fresh GuidePipeline, headless and
+    as fast as it goes, and compare what comes out with the recording.
+    Return a dict of frame counts, timing, and the mismatches per field
+    (with the first frame each happened in)."""
+
+    from pipeline import GuidePipeline
+
+    with open(os.path.join(directory, INITIAL), "rb") as f:
+        initial = pickle.load(f)
+
+    uart = ReplayUART()
+    pipeline = GuidePipeline(uart, tracker=initial["tracker"],
+                             calibration=initial["calibration"],
+                             controller=initial["controller"], online=False)
+    pipeline.online = initial["online"]
+    pipeline.drift = initial.get("drift")
+    pipeline.transmitTime = initial["transmitTime"]
+
+    # the clock plays back the recorded readings of each frame
+    readings = []
+    def clock():
+        return readings.pop(0) if len(readings) > 1 else readings[0]
+    pipeline.clock = clock
+
+    fields = ("mode", "trackID", "dX", "dY", "calState", "raRate", "decRate", "transmits")
+    mismatches = {field: 0 for field in fields}
+    first = {}
+    frames, processing, image = 0, 0.0, None
+
+    for chunk in load_chunks(directory):
+        images = iter(chunk.get("images", ()))
+        clockEnds = np.cumsum(chunk["clockCount"])
+        transmitEnds = np.cumsum(chunk["transmitCount"])
+
+        for i in range(len(chunk["timestamp"])):
+            if not chunk["repeat"][i]:
+                image = next(images)
+            readings[:] = chunk["clock"][clockEnds[i] - chunk["clockCount"][i]:clockEnds[i]]
+            if not readings:
+                readings.append(np.nan)
+            uart.transmits.clear()
+            timestamp = chunk["timestamp"][i]
+
+            start = time.perf_counter()
+            if not np.isnan(chunk["dither"][i]).any():
+                pipeline.dither.dither(tuple(chunk["dither"][i]))
+            pipeline.threshold = chunk["threshold"][i]
+            pipeline.expose(image, None if np.isnan(timestamp) else timestamp)
+            if chunk["action"][i] == CAL:
+                pipeline.calibrate()
+            elif chunk["action"][i] == RUN:
+                pipeline.run()
+            pipeline.record()
+            processing += time.perf_counter() - start
+
+            # compare with the recording
+            status = pipeline.status
+            produced = {"mode": status.mode, "trackID": pipeline.tracker.trackID,
+                        "dX": status.COM[0], "dY": status.COM[1],
+                        "calState": pipeline.calibration.state,
+                        "raRate": status.raRate, "decRate": status.decRate}
+            for (field, value) in produced.items():
+                if abs(value - chunk[field][i]) > tolerance:
+                    mismatches[field] += 1
+                    first.setdefault(field, frames)
+            recorded = chunk["transmits"][transmitEnds[i] - chunk["transmitCount"][i]:transmitEnds[i]]
+            if len(recorded) != len(uart.transmits) or (len(recorded) and np.abs(
+                    recorded - np.array(uart.transmits)).max() > tolerance):
+                mismatches["transmits"] += 1
+                first.setdefault("transmits", frames)
+            frames += 1
+
+    return {"frames": frames, "seconds": processing,
+            "framesPerSecond": frames / processing if processing else float("nan"),
+            "mismatches": mismatches, "firstMismatch": first}
+
+##############################################################################
+def record_simulation(directory, frames=200, seed=None, chunkFrames=64,
+                      propGain=600, intGain=100):
+    """Record a simulated session (acquire, calibrate, then guide with the
+    given controller gains) to have an archive to replay without the
+    hardware."""
+
+    from controller import Controller
+    from simulator import GuideSimulation
+
+    controller = Controller()
+    controller.RAPropGain = controller.DECPropGain = propGain
+    controller.RAIntGain = controller.DECIntGain = intGain
+    sim = GuideSimulation(controller=controller, seed=seed)
+    recorder = SessionRecorder(directory, chunkFrames)
+    recorder.attach(sim.pipeline)
+
+    mode = None
+    for i in range(frames):
+        if mode is None and sim.pipeline.status.mode == sim.pipeline.tracker.LOCKED:
+            mode = "cal"
+        recorder.state(exposing=True, calibrating=mode == "cal", running=mode == "run")
+        if sim.step(mode):
+            mode = "run"
+    recorder.close()
+
+
+##############################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Replay a recorded guiding session.")
+    parser.add_argument("directory", help="session directory")
+    parser.add_argument("--simulate", type=int, default=None, metavar="FRAMES",
+                        help="record a simulated session of FRAMES frames first")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--tolerance", type=float, default=1e-9)
+    args = parser.parse_args()
+
+    if args.simulate is not None:
+        record_simulation(args.directory, args.simulate, args.seed)
+
+    result = replay(args.directory, args.tolerance)
+    print(f"\treplayed {result['frames']} frames in {result['seconds']:.3f} s "
+          f"({result['framesPerSecond']:.1f} frames/s)")
+    for (field, count) in result["mismatches"].items():
+        if count:
+            print(f"<ERROR: {field} differs in {count} frames, "
+                  f"first in frame {result['firstMismatch'][field]}>")
+    if any(result["mismatches"].values()):
+        exit(1)
+    print("\tno differences from the recording")
@@ -0,0 +1,393 @@
+##############################################################################
+#                                simulator.py                                #
+##############################################################################
+
+import argparse
+import math
+import os
+import time
+import numpy as np
+from centroidtracker import CentroidTracker
+from controller import Controller, PROFILE_PATH
+from pipeline import GuidePipeline
+
+# Sidereal angular rate in radians per second
+SIDEREAL_RATE = 2 * math.pi / 86164.1
+
+# (propGain, intGain) per axis from autotune.py --simulate 3600 on the default
+# mount, used when no controller is given and there's no tuned profile on disk
+SIM_GAINS = {"RA": (62, 6.6), "DEC": (57, 1.0)}
+
+##############################################################################
+class MountModel:
+    """Model of the mount and sky as seen by the guide camera.
+
+    Motor rates (in the units transmitted to the MCU) move each axis by
+    rate * seconds of travel, and one unit of travel moves the guide star
+    pixelScale pixels on the sky (RA scaled by cos(declination)). On top of
+    the commanded motion the star is pushed around by:
+        + periodic error of the RA worm gear
+        + backlash in the DEC gear train
+        + a constant drift from tracking rate error
+        + DEC drift from polar misalignment, varying with hour angle
+        + atmospheric seeing (jitter on every measured position: rendered
+          frames, centroids, and recorded traces, but not sky_offset)
+
+    Disturbances are given in pixels along the RA/DEC sky axes, which are
+    rotated by the camera rotation to get the (dX, dY) tracker frame."""
+
+    ####################################################################
+    def __init__(self, declination=45, rotation=30, pixelScale=10,
+                 peAmplitude=3, pePeriod=480, driftRate=(0.02, 0.005),
+                 backlash=0.2, polarError=0.01, hourAngle=-2, seeing=0.3, seed=None):
+
+        self.declination = declination
+        self.rotation = rotation
+        self.pixelScale = pixelScale
+        self.peAmplitude = peAmplitude
+        self.pePeriod = pePeriod
+        self.driftRate = np.array(driftRate, dtype=float)
+        self.backlash = backlash
+        self.polarError = polarError
+        self.hourAngle = math.radians(15 * hourAngle)
+        self.seeing = seeing
+        self.rng = np.random.default_rng(seed)
+
+        # camera rotation from the RA/DEC sky axes to the (dX, dY) frame
+        rot = math.radians(rotation)
+        self.rotationMatrix = np.array(([math.cos(rot), -math.sin(rot)],
+                                        [math.sin(rot), math.cos(rot)]))
+
+        # pixels on the sky per unit of travel for each motor
+        self.skyScale = np.array([pixelScale * math.cos(math.radians(declination)), pixelScale])
+
+        self.pePhase = self.rng.uniform(0, 2 * math.pi)
+        self.reset()
+
+    ####################################################################
+    def reset(self):
+        """Return the mount to time 0 with the guide star on the origin."""
+        self.t = 0.0
+        self.raTravel = 0.0
+        self.decGear = 0.0      # position of the DEC motor side of the gear train
+        self.decTravel = 0.0    # position of the DEC axis after the backlash
+        self.raRate = 0.0
+        self.decRate = 0.0
+
+    ####################################################################
+    def pixel_matrix(self):
+        """Matrix mapping RA/DEC travel to (dX, dY) pixel displacement."""
+        return self.rotationMatrix * self.skyScale
+
+    ####################################################################
+    def set_rates(self, raRate, decRate):
+        self.raRate = raRate
+        self.decRate = decRate
+
+    ####################################################################
+    def advance(self, dt):
+        """Move both axes at the current rates for dt seconds."""
+
+        self.t += dt
+        self.raTravel += self.raRate * dt
+
+        # the DEC axis only follows the gear once the slack has been taken up
+        self.decGear += self.decRate * dt
+        halfPlay = self.backlash / 2
+        self.decTravel = min(max(self.decTravel, self.decGear - halfPlay), self.decGear + halfPlay)
+
+    ####################################################################
+    def sky_offset(self):
+        """Offset of the guide star along the RA/DEC sky axes in pixels,
+        without seeing."""
+
+        t = self.t
+        ra = self.skyScale[0] * self.raTravel + self.driftRate[0] * t \
+            + self.peAmplitude * math.sin(2 * math.pi * t / self.pePeriod + self.pePhase)
+
+        # integral of polarError * cos(hour angle) as the hour angle advances
+        polar = self.polarError / SIDEREAL_RATE \
+            * (math.sin(self.hourAngle + SIDEREAL_RATE * t) - math.sin(self.hourAngle))
+        dec = self.skyScale[1] * self.decTravel + self.driftRate[1] * t + polar
+
+        return np.array([ra, dec])
+
+    ####################################################################
+    def offset(self):
+        """True (dX, dY) displacement of the guide star from the origin."""
+        return self.rotationMatrix @ self.sky_offset()
+
+    ####################################################################
+    def seeing_offset(self):
+        """Displacement of the guide star in a single frame, with seeing."""
+        return self.offset() + self.rng.normal(0, self.seeing, 2)
+
+
+##############################################################################
+class SimUART:
+    """Stand-in for uart.UART that feeds transmitted rates to a MountModel."""
+
+    ####################################################################
+    def __init__(self, mount):
+        self.mount = mount
+        self.transmits = 0
+        self.lastPayload = (0, 0)
+
+    ####################################################################
+    def connect(self):
+        pass
+
+    ####################################################################
+    def transmit(self, raRate, decRate):
+        """Set the mount rates as the MCU would."""
+        self.mount.set_rates(raRate, decRate)
+        self.lastPayload = (raRate, decRate)
+        self.transmits += 1
+
+    ####################################################################
+    def disconnect(self):
+        pass
+
+
+##############################################################################
+class SimCamera:
+    """Stand-in for camera.Camera rendering the star field of a MountModel
+    into frames shaped like the cropped and resized images of load_image()."""
+
+    ####################################################################
+    def __init__(self, mount, shape=(533, 533), nStars=8, peak=200, fwhm=3,
+                 noise=1.0, seed=None):
+
+        self.mount = mount
+        self.shape = shape
+        self.peak = peak
+        self.sigma = fwhm / 2.355
+        self.rng = np.random.default_rng(seed)
+
+        # fixed positions of the field stars relative to the guide star
+        # (the guide star is the first, at the origin)
+        spread = 0.8 * min(CentroidTracker.orgX, CentroidTracker.orgY)
+        self.field = np.vstack(([0, 0], self.rng.uniform(-spread, spread, (nStars - 1, 2))))
+
+        # pool of background noise frames, reused instead of drawn per frame
+        self.noisePool = np.clip(self.rng.normal(0, noise, (4,) + shape), 0, 255).astype(np.float32)
+
+        # half width of the stamp each star is drawn into
+        self.radius = int(math.ceil(3 * self.sigma))
+
+    ####################################################################
+    def star_positions(self):
+        """(x, y) image positions of every star in the current frame."""
+        dX, dY = self.mount.seeing_offset()
+        x = CentroidTracker.orgX + dX + self.field[:, 0]
+        y = CentroidTracker.orgY - dY - self.field[:, 1]
+        return np.column_stack((x, y))
+
+    ####################################################################
+    def centroids(self):
+        """Integer centroids of the stars in frame, as find_centroids()
+        would measure them without rendering an image."""
+        pos = np.round(self.star_positions()).astype("int")
+        inFrame = (pos[:, 0] >= 0) & (pos[:, 0] < self.shape[1]) \
+                  & (pos[:, 1] >= 0) & (pos[:, 1] < self.shape[0])
+        return pos[inFrame]
+
+    ####################################################################
+    def capture(self, image=None):
+        """Render a BGR frame of the current star field, into image if
+        given (e.g. a FrameRing slot)."""
+
+        img = self.noisePool[self.rng.integers(len(self.noisePool))].copy()
+        offsets = np.arange(-self.radius, self.radius + 1)
+        (height, width) = self.shape
+
+        for (x, y) in self.star_positions():
+            (cx, cy) = (int(round(x)), int(round(y)))
+            if not (0 <= cx < width and 0 <= cy < height):
+                continue
+
+            # separable gaussian stamp at the sub-pixel star position
+            gx = np.exp(-0.5 * ((cx + offsets - x) / self.sigma) ** 2)
+            gy = np.exp(-0.5 * ((cy + offsets - y) / self.sigma) ** 2)
+            stamp = self.peak * np.outer(gy, gx)
+
+            # clip the stamp to the frame edges
+            x0, y0 = max(cx - self.radius, 0), max(cy - self.radius, 0)
+            x1, y1 = min(cx + self.radius + 1, width), min(cy + self.radius + 1, height)
+            img[y0:y1, x0:x1] += stamp[y0 - cy + self.radius:y1 - cy + self.radius,
+                                       x0 - cx + self.radius:x1 - cx + self.radius]
+
+        gray = np.clip(img, 0, 255).astype(np.uint8)
+        if image is not None:
+            np.copyto(image, gray[:, :, np.newaxis])
+            return image
+        return np.repeat(gray[:, :, np.newaxis], 3, axis=2)
+
+
+##############################################################################
+class GuideSimulation:
+    """Closed-loop guiding run of a GuidePipeline against a MountModel.
+
+    Time is simulated, so a run goes as fast as the pipeline can process
+    frames. With render=False the frames aren't drawn and the centroids are
+    handed straight to the tracker, which skips OpenCV entirely.
+
+    Without a controller the gains come from the tuned controller profile,
+    or SIM_GAINS if there isn't one (the Controller defaults never settle)."""
+
+    ####################################################################
+    def __init__(self, mount=None, frameInterval=1.0, render=True, controller=None, seed=None):
+
+        self.mount = mount if mount is not None else MountModel(seed=seed)
+        self.frameInterval = frameInterval
+        self.render = render
+        self.camera = SimCamera(self.mount, seed=seed)
+        self.UART = SimUART(self.mount)
+        if controller is None:
+            controller = Controller()
+            if not os.path.exists(PROFILE_PATH):
+                (controller.RAPropGain, controller.RAIntGain) = SIM_GAINS["RA"]
+                (controller.DECPropGain, controller.DECIntGain) = SIM_GAINS["DEC"]
+        self.pipeline = GuidePipeline(self.UART, controller=controller)
+        self.pipeline.clock = lambda: self.mount.t
+        self.pipeline.online.backlash = np.array([0, self.mount.backlash])
+
+    ####################################################################
+    def step(self, mode=None):
+        """Expose one frame, then either calibrate ('cal'), guide ('run'),
+        or do nothing (None), and move the mount to the next frame."""
+
+        if self.render:
+            self.pipeline.expose(self.camera.capture())
+        else:
+            self.pipeline.track(self.camera.centroids())
+
+        done = False
+        if not self.pipeline.unchanged:
+            if mode == "cal":
+                done = self.pipeline.calibrate()
+            elif mode == "run":
+                self.pipeline.run()
+        self.pipeline.record()
+
+        self.mount.advance(self.frameInterval)
+        return done
+
+    ####################################################################
+    def acquire(self, maxFrames=10):
+        """Expose until the tracker locks onto a guide star."""
+        for i in range(maxFrames):
+            self.step()
+            if self.pipeline.status.mode == CentroidTracker.LOCKED:
+                return True
+        return False
+
+    ####################################################################
+    def calibrate(self, ideal=False, maxFrames=500):
+        """Run the real Calibration state machine against the mount, or with
+        ideal=True set the conversion matrix from the mount model directly."""
+
+        if ideal:
+            return self.pipeline.calibration.load(self.mount.pixel_matrix())
+
+        for i in range(maxFrames):
+            if self.step("cal"):
+                self.UART.transmit(0, 0)
+                return True
+        return False
+
+    ####################################################################
+    def plant_gains(self):
+        """Change of the RA/DEC controller inputs per unit of rate over one
+        frame, given the current conversion matrix (1 for an ideal one)."""
+        coupling = self.pipeline.calibration.conversion @ self.mount.pixel_matrix()
+        return -np.diag(coupling) * self.frameInterval
+
+    ####################################################################
+    def record_trace(self, duration):
+        """Record the controller inputs of an unguided run of the mount, as
+        a (T, 2) trace for autotune.py. Uses the model directly instead of
+        rendering, so the star can't drift out of the frame."""
+
+        self.mount.set_rates(0, 0)
+        trace = np.zeros((int(duration / self.frameInterval), 2))
+        for i in range(len(trace)):
+            trace[i] = self.pipeline.calibration.calculate_rates(self.mount.seeing_offset())
+            self.mount.advance(self.frameInterval)
+        return trace
+
+    ####################################################################
+    def guide(self, duration, tolerance=1.0):
+        """Guide for duration simulated seconds. Return a report of the
+        true guiding error of the star (without seeing):
+            + rmsRA, rmsDEC, rmsTotal - RMS error in pixels
+            + peak                    - peak total error in pixels
+            + convergenceTime         - seconds until the error stays
+                                        within tolerance pixels (None if never)
+            + frames, simTime, wallTime, speedup
+        """
+
+        nFrames = int(duration / self.frameInterval)
+        skyErr = np.zeros((nFrames, 2))
+        start = time.perf_counter()
+
+        for i in range(nFrames):
+            skyErr[i] = self.mount.sky_offset()
+            self.step("run")
+
+        wallTime = time.perf_counter() - start
+        totalErr = np.hypot(skyErr[:, 0], skyErr[:, 1])
+
+        # first frame after which the error never leaves the tolerance
+        outside = np.flatnonzero(totalErr > tolerance)
+        if len(outside) == 0:
+            convergenceTime = 0.0
+        elif outside[-1] == nFrames - 1:
+            convergenceTime = None
+        else:
+            convergenceTime = float(outside[-1] + 1) * self.frameInterval
+
+        return {"rmsRA": float(np.sqrt(np.mean(skyErr[:, 0] ** 2))),
+                "rmsDEC": float(np.sqrt(np.mean(skyErr[:, 1] ** 2))),
+                "rmsTotal": float(np.sqrt(np.mean(totalErr ** 2))),
+                "peak": float(totalErr.max()),
+                "convergenceTime": convergenceTime,
+                "frames": nFrames,
+                "simTime": nFrames * self.frameInterval,
+                "wallTime": wallTime,
+                "speedup": nFrames * self.frameInterval / wallTime}
+
+
+##############################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Simulate a closed-loop guiding run.")
+    parser.add_argument("--hours", type=float, default=1, help="simulated guiding time")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between frames")
+    parser.add_argument("--dec", type=float, default=45, help="declination in degrees")
+    parser.add_argument("--rot", type=float, default=30, help="camera rotation in degrees")
+    parser.add_argument("--no-render", action="store_true", help="skip drawing frames")
+    parser.add_argument("--ideal-cal", action="store_true", help="skip the calibration run")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--log", default=None, metavar="DIR", help="record a guide log in DIR")
+    args = parser.parse_args()
+
+    mount = MountModel(declination=args.dec, rotation=args.rot, seed=args.seed)
+    sim = GuideSimulation(mount, frameInterval=args.interval,
+                          render=not args.no_render, seed=args.seed)
+    if args.log is not None:
+        from guidelog import GuideLog
+        sim.pipeline.log = GuideLog(args.log)
+
+    if not sim.acquire():
+        exit("<ERROR: no guide star found>")
+    if not sim.calibrate(ideal=args.ideal_cal):
+        exit("<ERROR: calibration did not finish>")
+    print(sim.pipeline.calibration)
+
+    report = sim.guide(args.hours * 3600)
+    for key, value in report.items():
+        print(f"\t{key}:\t{value}")
+
+    if sim.pipeline.log is not None:
+        sim.pipeline.log.close()
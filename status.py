@@ -11,6 +11,8 @@ class Status:
         + center of mass
         + rotator angle motor rate
         + declination motor rate
+        + capture timestamp of the frame
+        + frames skipped as repeats of the previous one
     """
 
     # Statuses from centroidtracker.py
@@ -25,6 +27,8 @@ class Status:
         self.COM = (0, 0)
         self.raRate = 0
         self.decRate = 0
+        self.timestamp = None
+        self.skipped = 0
 
     ####################################################################
     def __str__(self):
@@ -43,16 +47,18 @@ class Status:
         return state_str + \
             f"\n\tTrack Star COM:\t{self.COM}" \
             f"\n\tRA Rate:\t\t{self.raRate}" \
-            f"\n\tDec Rate:\t{self.decRate}"
+            f"\n\tDec Rate:\t{self.decRate}" \
+            f"\n\tSkipped:\t{self.skipped}"
 
     ####################################################################
-    def set(self, img_num, mode=0, COM=(0, 0), raRate=0, decRate=0):
+    def set(self, img_num, mode=0, COM=(0, 0), raRate=0, decRate=0, timestamp=None):
         """Set the fields of a State object with defaults of 0."""
         self.img_num = img_num
         self.mode = mode
         self.COM = COM
         self.raRate = raRate
         self.decRate = decRate
+        self.timestamp = timestamp
 
     ####################################################################
     def set_rates(self, raRate, decRate):
@@ -0,0 +1,232 @@
+##############################################################################
+#                              statushistory.py                              #
+##############################################################################
+
+import collections
+import math
+import threading
+import numpy as np
+
+# One sample per frame. raErr/decErr are the guide star error in pixels
+# along the mount's RA/DEC axes (the frame axes before a calibration).
+SAMPLE = np.dtype([("timestamp", "f8"),
+                   ("img_num", "i4"),
+                   ("mode", "i1"),
+                   ("dX", "f4"),
+                   ("dY", "f4"),
+                   ("raErr", "f4"),
+                   ("decErr", "f4"),
+                   ("raRate", "f4"),
+                   ("decRate", "f4"),
+                   ("snr", "f4")])
+
+##############################################################################
+class StatusHistory:
+    """Fixed capacity ring of the last Status samples with guiding quality
+    statistics over them, kept up to date in O(1) per frame:
+        + RA, DEC, and total RMS error (Welford mean and variance, with
+          samples removed again as they leave the ring)
+        + peak total error (monotonic deque)
+        + drift in pixels per minute (running linear regression sums)
+        + mean signal to noise ratio of the guide star
+
+    Only frames where the guide star was locked count towards the
+    statistics. The accumulators are rebuilt from the ring once per
+    capacity samples, so round-off from the removals can't build up.
+
+    add() and clear() hold lock, so another thread (e.g. the metrics
+    server) reads consistent statistics while holding it too."""
+
+    ####################################################################
+    def __init__(self, capacity=300):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.clear()
+
+    ####################################################################
+    def clear(self):
+        """Forget every sample."""
+
+        with self.lock:
+            self.samples = np.zeros(self.capacity, dtype=SAMPLE)
+            self.valid = np.zeros(self.capacity, dtype=bool)
+            self.count = 0          # samples in the ring
+            self.head = 0           # index of the next sample to write
+            self.seq = 0            # samples ever added
+            self.pushes = 0         # samples since the last rebuild
+            self.reset_stats()
+
+    ####################################################################
+    def reset_stats(self, t0=None):
+        """Zero the accumulators, with t0 as the time origin of the drift fit."""
+
+        self.n = 0
+        self.mean = np.zeros(2)     # RA, DEC error
+        self.M2 = np.zeros(2)
+        self.t0 = t0
+        self.St = 0.0               # sums for the drift regression
+        self.Stt = 0.0
+        self.Sty = np.zeros(2)
+        self.nSNR = 0
+        self.meanSNR = 0.0
+        self.peaks = collections.deque()    # (seq, total error), decreasing
+
+    ####################################################################
+    def __len__(self):
+        return self.count
+
+    ####################################################################
+    def __str__(self):
+        return f"\n\tRMS RA/DEC:\t{self.rms_ra():.2f} / {self.rms_dec():.2f} px" \
+               f"\n\tRMS Total:\t{self.rms_total():.2f} px" \
+               f"\n\tPeak:\t\t{self.peak():.2f} px" \
+               f"\n\tDrift:\t\t{self.drift()[0]:.2f}, {self.drift()[1]:.2f} px/min" \
+               f"\n\tSNR:\t\t{self.snr():.1f}"
+
+    ####################################################################
+    def add(self, status, raErr=None, decErr=None, snr=math.nan):
+        """Add the Status of a frame, with its error along the RA/DEC axes
+        in pixels (dX/dY if not given) and the guide star SNR if known."""
+
+        with self.lock:
+            (dX, dY) = status.COM
+            raErr = dX if raErr is None else raErr
+            decErr = dY if decErr is None else decErr
+            timestamp = status.timestamp if status.timestamp is not None else status.img_num
+
+            # drop the oldest sample once the ring is full
+            if self.count == self.capacity:
+                if self.valid[self.head]:
+                    self.remove(self.samples[self.head])
+            else:
+                self.count += 1
+
+            self.samples[self.head] = (timestamp, status.img_num, status.mode, dX, dY,
+                                       raErr, decErr, status.raRate, status.decRate, snr)
+            self.valid[self.head] = status.mode == status.LOCKED
+            if self.valid[self.head]:
+                self.insert(self.samples[self.head], self.seq)
+
+            self.head = (self.head + 1) % self.capacity
+            self.seq += 1
+
+            # rebuild now and then from the ring
+            self.pushes += 1
+            if self.pushes >= self.capacity:
+                self.rebuild()
+
+    ####################################################################
+    def insert(self, sample, seq):
+        """Add a locked sample to the accumulators."""
+
+        if self.t0 is None:
+            self.t0 = sample["timestamp"]
+        x = np.array((sample["raErr"], sample["decErr"]), dtype=float)
+        t = sample["timestamp"] - self.t0
+
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.M2 += delta * (x - self.mean)
+
+        self.St += t
+        self.Stt += t * t
+        self.Sty += t * x
+
+        if math.isfinite(sample["snr"]):
+            self.nSNR += 1
+            self.meanSNR += (sample["snr"] - self.meanSNR) / self.nSNR
+
+        total = math.hypot(x[0], x[1])
+        while self.peaks and self.peaks[-1][1] <= total:
+            self.peaks.pop()
+        self.peaks.append((seq, total))
+
+    ####################################################################
+    def remove(self, sample):
+        """Take a locked sample leaving the ring out of the accumulators."""
+
+        x = np.array((sample["raErr"], sample["decErr"]), dtype=float)
+        t = sample["timestamp"] - self.t0
+
+        self.n -= 1
+        if self.n == 0:
+            self.mean[:] = 0
+            self.M2[:] = 0
+        else:
+            delta = x - self.mean
+            self.mean -= delta / self.n
+            self.M2 = np.maximum(self.M2 - delta * (x - self.mean), 0)
+
+        self.St -= t
+        self.Stt -= t * t
+        self.Sty -= t * x
+
+        if math.isfinite(sample["snr"]):
+            self.nSNR -= 1
+            self.meanSNR = 0.0 if self.nSNR == 0 else \
+                self.meanSNR - (sample["snr"] - self.meanSNR) / self.nSNR
+
+        # the peak of the ring can only be the oldest sample here
+        oldest = self.seq - self.capacity
+        while self.peaks and self.peaks[0][0] <= oldest:
+            self.peaks.popleft()
+
+    ####################################################################
+    def ordered(self):
+        """Samples in the ring, oldest first, and whether each is locked."""
+        order = np.roll(np.arange(self.capacity), -self.head)[self.capacity - self.count:]
+        return self.samples[order], self.valid[order]
+
+    ####################################################################
+    def rebuild(self):
+        """Recompute every accumulator from the samples in the ring."""
+
+        samples, valid = self.ordered()
+        firstSeq = self.seq - self.count
+        locked = np.flatnonzero(valid)
+
+        self.reset_stats(samples["timestamp"][locked[0]] if len(locked) else None)
+        for i in locked:
+            self.insert(samples[i], firstSeq + i)
+        self.pushes = 0
+
+    ####################################################################
+    def rms_ra(self):
+        return math.sqrt(self.M2[0] / self.n + self.mean[0] ** 2) if self.n else 0.0
+
+    ####################################################################
+    def rms_dec(self):
+        return math.sqrt(self.M2[1] / self.n + self.mean[1] ** 2) if self.n else 0.0
+
+    ####################################################################
+    def rms_total(self):
+        return math.hypot(self.rms_ra(), self.rms_dec())
+
+    ####################################################################
+    def peak(self):
+        """Largest total error in the ring."""
+        return self.peaks[0][1] if self.peaks else 0.0
+
+    ####################################################################
+    def drift(self):
+        """Slope of the RA/DEC error in pixels per minute, by least squares."""
+        denominator = self.n * self.Stt - self.St ** 2
+        if self.n < 2 or denominator <= 0:
+            return (0.0, 0.0)
+        slope = (self.n * self.Sty - self.St * self.n * self.mean) / denominator
+        return tuple(60 * slope)
+
+    ####################################################################
+    def frame_rate(self):
+        """Frames per second over the samples in the ring."""
+        if self.count < 2:
+            return 0.0
+        newest = self.samples["timestamp"][self.head - 1]
+        oldest = self.samples["timestamp"][self.head if self.count == self.capacity else 0]
+        return (self.count - 1) / (newest - oldest) if newest > oldest else 0.0
+
+    ####################################################################
+    def snr(self):
+        """Mean SNR of the guide star (nan if it was never measured)."""
+        return self.meanSNR if self.nSNR else math.nan
@@ -0,0 +1,313 @@
+##############################################################################
+#                                supervisor.py                               #
+##############################################################################
+
+import argparse
+import multiprocessing
+import queue
+import time
+
+# Fields of each rig's slot in the shared status array. "seq" is a sequence
+# lock: odd while the worker writes the slot, so readers retry.
+STATUS_FIELDS = ("seq", "img_num", "mode", "dX", "dY", "raRate", "decRate", "timestamp",
+                 "calState", "detections", "rmsRA", "rmsDEC", "rmsTotal", "frames", "skipped",
+                 "settling", "exposing", "calibrating", "calibrated", "running", "heartbeat", "exited")
+FIELD = {name: i for (i, name) in enumerate(STATUS_FIELDS)}
+
+# Commands understood by a rig worker
+EXPOSE = "expose"
+CALIBRATE = "calibrate"
+RUN = "run"
+STOP = "stop"
+QUIT = "quit"
+DITHER = "dither"
+
+##############################################################################
+class Supervisor:
+    """Runs several independent guide pipelines (rigs), each in its own
+    worker process with its own frame source, tracker, calibration,
+    controller, and serial link, so they use separate cores instead of
+    sharing one Tk thread.
+
+    A rig is described by a dict:
+        + source   - "camera" for a USB camera and UART, or "sim" for a
+                     simulated mount (default)
+        + camera   - camera index (source "camera")
+        + port, baud, protocol - serial link (source "camera")
+        + capture  - read the camera in a separate capture process that
+                     hands frames over through a shared memory FrameRing
+                     (source "camera"), with width and height the frame size
+        + dec, rot, seed, render, speed - mount simulation (source "sim"),
+                     speed is simulated seconds per wall clock second
+        + log      - directory for a guide log
+    Workers publish their status to a shared array after every frame and
+    take commands (EXPOSE, CALIBRATE, RUN, STOP, DITHER, QUIT) from a queue, so an
+    observer such as gui.SupervisorApp only reads memory."""
+
+    ####################################################################
+    def __init__(self, rigs):
+        self.rigs = [dict(rig) for rig in rigs]
+        self.context = multiprocessing.get_context("spawn")
+        self.shared = self.context.RawArray("d", len(self.rigs) * len(STATUS_FIELDS))
+        self.commands = [self.context.Queue() for rig in self.rigs]
+        self.processes = []
+        self.captures = []      # (ring, process, stop event) of capture processes
+
+    ####################################################################
+    def __len__(self):
+        return len(self.rigs)
+
+    ####################################################################
+    def start(self):
+        """Start a worker process per rig."""
+        for (index, rig) in enumerate(self.rigs):
+
+            # capture processes are started from here, as the daemonic rig
+            # workers may not have children
+            ring = None
+            if rig.get("source", "sim") == "camera" and rig.get("capture"):
+                from framering import FrameRing, start_capture
+                ring = FrameRing((rig.get("height", 480), rig.get("width", 640), 3),
+                                 context=self.context)
+                (process, stop) = start_capture(ring, rig.get("camera", 0),
+                                                rig.get("captureRate", 1000), self.context)
+                self.captures.append((ring, process, stop))
+
+            process = self.context.Process(target=run_rig, name=f"rig-{index}", daemon=True,
+                                           args=(index, rig, self.shared, self.commands[index],
+                                                 ring))
+            process.start()
+            self.processes.append(process)
+
+    ####################################################################
+    def command(self, index, command):
+        """Send a command to a rig, or to every rig with index None."""
+        for i in (range(len(self)) if index is None else (index,)):
+            self.commands[i].put(command)
+
+    ####################################################################
+    def status(self, index):
+        """Consistent snapshot of a rig's status as a dict."""
+        return read_slot(self.shared, index)
+
+    ####################################################################
+    def alive(self, index):
+        return index < len(self.processes) and self.processes[index].is_alive()
+
+    ####################################################################
+    def stop(self, timeout=5.0):
+        """Ask every worker to quit, and terminate any that don't."""
+
+        self.command(None, QUIT)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+        for (ring, process, stop) in self.captures:
+            stop.set()
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+            ring.close()
+        self.captures = []
+
+
+##############################################################################
+def write_slot(shared, index, values):
+    """Write a rig's status fields (a dict) under the sequence lock."""
+
+    base = index * len(STATUS_FIELDS)
+    shared[base] += 1       # odd: writing
+    for (name, value) in values.items():
+        shared[base + FIELD[name]] = value
+    shared[base] += 1       # even: consistent
+
+##############################################################################
+def read_slot(shared, index):
+    """Read a rig's status fields, retrying while the worker writes them."""
+
+    base = index * len(STATUS_FIELDS)
+    while True:
+        seq = shared[base]
+        values = shared[base:base + len(STATUS_FIELDS)]
+        if seq % 2 == 0 and shared[base] == seq:
+            return dict(zip(STATUS_FIELDS, values))
+        time.sleep(0)
+
+##############################################################################
+def open_rig(rig, ring=None):
+    """Build the pipeline of a rig. Return (pipeline, step, interval), where
+    step(mode) processes one frame ("cal", "run", or None) and returns True
+    when a calibration finishes. Camera frames come from ring if given."""
+
+    if rig.get("source", "sim") == "sim":
+        from simulator import GuideSimulation, MountModel
+        mount = MountModel(declination=rig.get("dec", 45), rotation=rig.get("rot", 30),
+                           seed=rig.get("seed"))
+        sim = GuideSimulation(mount, frameInterval=rig.get("interval", 1.0),
+                              render=rig.get("render", True), seed=rig.get("seed"))
+        interval = sim.frameInterval / rig.get("speed", 1.0)
+        return sim.pipeline, sim.step, interval
+
+    from camera import Camera
+    from uart import UART
+    from pipeline import GuidePipeline
+
+    if ring is not None:
+        from framering import RingCamera
+        camera = RingCamera(ring)
+    else:
+        camera = Camera(index=rig.get("camera", 0))
+    uart = UART(rig.get("port", "COM3"), rig.get("baud", 9600), rig.get("protocol", "ascii"))
+    pipeline = GuidePipeline(uart)
+
+    def step(mode):
+        pipeline.expose(camera.capture())
+        done = False
+        if not pipeline.unchanged:
+            if mode == "cal":
+                done = pipeline.calibrate()
+            elif mode == "run":
+                pipeline.run()
+        pipeline.record()
+        return done
+
+    # Camera.capture() already waits between frames (RingCamera for the next one)
+    return pipeline, step, 0.0
+
+##############################################################################
+def run_rig(index, rig, shared, commands, ring=None):
+    """Worker process: the MainApp update loop of one rig without the GUI."""
+
+    (pipeline, step, interval) = open_rig(rig, ring)
+    if rig.get("log"):
+        from guidelog import GuideLog
+        pipeline.log = GuideLog(rig["log"])
+
+    flags = dict(exposing=False, calibrating=False, calibrated=False, running=False)
+    try:
+        while True:
+            start = time.perf_counter()
+
+            # apply every waiting command, as the MainApp buttons would
+            try:
+                while True:
+                    command = commands.get_nowait()
+                    if command == QUIT:
+                        return
+                    apply_command(command, flags, pipeline)
+            except queue.Empty:
+                pass
+
+            if flags["exposing"]:
+                mode = "cal" if flags["calibrating"] else "run" if flags["running"] else None
+                if step(mode):
+                    flags.update(calibrating=False, calibrated=True, exposing=False)
+                    pipeline.UART.transmit(0, 0)
+
+            status, history = pipeline.status, pipeline.history
+            write_slot(shared, index, {
+                "img_num": status.img_num, "mode": status.mode,
+                "dX": status.COM[0], "dY": status.COM[1],
+                "raRate": status.raRate, "decRate": status.decRate,
+                "timestamp": status.timestamp or 0.0,
+                "calState": pipeline.calibration.state, "detections": pipeline.detections,
+                "rmsRA": history.rms_ra(), "rmsDEC": history.rms_dec(),
+                "rmsTotal": history.rms_total(), "frames": pipeline.frames,
+                "skipped": status.skipped, "settling": pipeline.dither.settling(),
+                "heartbeat": time.time(), **flags})
+
+            time.sleep(max(interval - (time.perf_counter() - start), 0.01))
+    finally:
+        write_slot(shared, index, {"exited": 1, "exposing": 0, "running": 0})
+        if pipeline.log is not None:
+            pipeline.log.close()
+        if hasattr(pipeline.UART, "disconnect"):
+            pipeline.UART.disconnect()
+
+##############################################################################
+def apply_command(command, flags, pipeline):
+    """Update a rig's state flags for a command, with the MainApp rules."""
+
+    if command == EXPOSE:
+        flags["exposing"] = True
+    elif command == STOP:
+        flags.update(exposing=False, running=False)
+        if flags["calibrating"]:
+            flags.update(calibrating=False, calibrated=False)
+        pipeline.UART.transmit(0, 0)
+    elif command == CALIBRATE:
+        if flags["exposing"] and not flags["calibrated"] \
+                and pipeline.status.mode == pipeline.tracker.LOCKED:
+            flags["calibrating"] = True
+    elif command == RUN:
+        if flags["exposing"] and flags["calibrated"]:
+            flags["running"] = True
+    elif command == DITHER:
+        if flags["running"]:
+            pipeline.dither.dither()
+
+##############################################################################
+def parse_rig(text):
+    """Rig dict from "key=value,key=value" (numbers converted)."""
+
+    rig = {}
+    for item in text.split(","):
+        (key, value) = item.split("=", 1)
+        try:
+            rig[key] = int(value)
+        except ValueError:
+            try:
+                rig[key] = float(value)
+            except ValueError:
+                rig[key] = {"true": True, "false": False}.get(value.lower(), value)
+    return rig
+
+
+##############################################################################
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Guide several rigs in separate processes.")
+    parser.add_argument("--rig", action="append", type=parse_rig, default=[],
+                        help='rig description, e.g. "source=camera,camera=1,port=COM4"')
+    parser.add_argument("--sim", type=int, default=0, help="add simulated rigs")
+    parser.add_argument("--speed", type=float, default=10, help="speed of simulated rigs")
+    parser.add_argument("--gui", action="store_true", help="observe the rigs in a Tk window")
+    parser.add_argument("--seconds", type=float, default=60, help="headless run time")
+    args = parser.parse_args()
+
+    rigs = args.rig + [{"source": "sim", "seed": i, "dec": 20 + 30 * i, "speed": args.speed}
+                       for i in range(args.sim)]
+    if not rigs:
+        parser.error("no rigs given")
+
+    supervisor = Supervisor(rigs)
+    supervisor.start()
+
+    if args.gui:
+        import tkinter as tk
+        import gui
+        root = tk.Tk()
+        root.title("Autoguiding Supervisor")
+        gui.SupervisorApp(root, supervisor).update()
+        root.mainloop()
+
+    # headless: expose, calibrate, and guide every rig, printing their status
+    else:
+        supervisor.command(None, EXPOSE)
+        end = time.monotonic() + args.seconds
+        while time.monotonic() < end:
+            time.sleep(1)
+            for i in range(len(supervisor)):
+                status = supervisor.status(i)
+                if status["mode"] == 1 and not (status["calibrating"] or status["calibrated"]):
+                    supervisor.command(i, CALIBRATE)
+                elif status["calibrated"] and not status["exposing"]:
+                    supervisor.command(i, EXPOSE)
+                    supervisor.command(i, RUN)
+                print(f"\trig {i}: frame {int(status['frames'])}\tmode {int(status['mode'])}"
+                      f"\tcal {int(status['calState'])}\tRMS {status['rmsTotal']:.2f} px")
+
+    supervisor.stop()
@@ -0,0 +1,9 @@
+##############################################################################
+#                                conftest.py                                 #
+##############################################################################
+
+import os
+import sys
+
+# the modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,37 @@
+##############################################################################
+#                          test_batchcontroller.py                           #
+##############################################################################
+
+import numpy as np
+
+from batchcontroller import BatchController
+from controller import Controller
+
+
+####################################################################
+def test_matches_controller():
+    propGains, intGains = [0, 150, 600, 900], [0, 20, 100, 400]
+    batch = BatchController(propGains, intGains)
+    controllers = []
+    for (propGain, intGain) in zip(propGains, intGains):
+        controller = Controller(profile=None)
+        controller.RAPropGain, controller.RAIntGain = propGain, intGain
+        controllers.append(controller)
+
+    # errors large enough to saturate and hit the integral clamp
+    errors = np.random.default_rng(0).normal(0, 2, 200).cumsum()
+    for (t, err) in enumerate(errors):
+        expected = [controller.calculate(err, 0, timestamp=float(t))[0] for controller in controllers]
+        assert np.array_equal(batch.calculate(err), expected)
+
+
+####################################################################
+def test_simulate():
+    t = np.arange(600)
+    trace = 0.05 * t + 2 * np.sin(2 * np.pi * t / 120)
+    results = BatchController.grid([0, 300], [0, 50]).simulate(trace)
+
+    # no gains leaves the trace uncorrected
+    assert np.isclose(results["rms"][0], np.sqrt(np.mean(trace ** 2)))
+    assert results["effort"][0] == 0
+    assert results["rms"][-1] < 0.1 * results["rms"][0]
@@ -0,0 +1,90 @@
+##############################################################################
+#                             test_calibration.py                            #
+##############################################################################
+
+import numpy as np
+
+from calibration import Calibration
+from simulator import GuideSimulation, MountModel
+
+
+####################################################################
+def calibrate_with_dropout(gap):
+    """Calibrate an ideal mount while the guide star is missing from the
+    frames numbered in gap, and return the simulation and the calibration
+    rates sent while the tracker wasn't locked."""
+
+    mount = MountModel(seed=1, peAmplitude=0, driftRate=(0, 0), backlash=0, polarError=0, seeing=0)
+    sim = GuideSimulation(mount, seed=1, render=False)
+    calibration = sim.pipeline.calibration
+    centroids, frame, held = sim.camera.centroids, [0], []
+
+    def dropped():
+        frame[0] += 1
+        if frame[0] in gap:
+            return np.zeros((0, 2), int)
+        return centroids()
+
+    sim.camera.centroids = dropped
+    sim.acquire()
+    for i in range(200):
+        done = sim.step('cal')
+        if sim.pipeline.status.mode != sim.pipeline.tracker.LOCKED:
+            held.append((calibration.RARate, calibration.DECRate))
+        if done:
+            break
+    return sim, held
+
+
+####################################################################
+def scale_error(sim):
+    measured = np.linalg.norm(sim.pipeline.calibration.pixelMatrix, axis=0)
+    return np.abs(measured / np.linalg.norm(sim.mount.pixel_matrix(), axis=0) - 1)
+
+
+####################################################################
+def test_motors_held_while_star_lost_stepping_out():
+    sim, held = calibrate_with_dropout(range(8, 11))
+    assert held and all(rates == (0, 0) for rates in held)
+    assert scale_error(sim)[0] < 0.05
+    assert np.all(np.abs(sim.mount.sky_offset()) < 3)
+
+
+####################################################################
+def test_return_not_finished_while_star_lost():
+    sim, held = calibrate_with_dropout(range(26, 28))
+    assert held and all(rates == (0, 0) for rates in held)
+    assert np.all(np.abs(sim.mount.sky_offset()) < 3)
+
+
+####################################################################
+def fit_samples(pixelMatrix, raTravel, decTravel, offset=(3, -2)):
+    """Calibration holding exact samples of pixelMatrix for the given
+    travel sent after each RA and DEC sample."""
+
+    calibration = Calibration()
+    for motor, travel, column in (("RAmotor", raTravel, 0), ("DECmotor", decTravel, 1)):
+        travel = np.asarray(travel, dtype=float)
+        before = np.cumsum(travel) - travel
+        pixels = np.outer(before, pixelMatrix[:, column]) + offset
+        setattr(calibration, motor, np.column_stack((pixels, travel)))
+    return calibration
+
+
+####################################################################
+def test_least_squares_clips_outlier():
+    pixelMatrix = np.array([[7.0, -5.0], [3.5, 8.5]])
+    calibration = fit_samples(pixelMatrix, np.full(8, 0.5), np.full(8, 0.5))
+    calibration.RAmotor[4, :2] += (6, -9)   # cosmic ray on one sample
+
+    assert calibration.least_squares()
+    assert not calibration.inliers[4] and calibration.inliers.sum() == 15
+    assert np.allclose(calibration.pixelMatrix, pixelMatrix)
+    assert np.allclose(calibration.conversion @ pixelMatrix, -np.eye(2))
+
+
+####################################################################
+def test_least_squares_singular():
+    calibration = fit_samples(np.array([[7.0, -5.0], [3.5, 8.5]]), np.full(8, 0.5), np.zeros(8))
+    assert not calibration.least_squares()
+    assert not calibration.conversion.any()
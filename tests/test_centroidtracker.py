@@ -0,0 +1,79 @@
+##############################################################################
+#                          test_centroidtracker.py                           #
+##############################################################################
+
+import numpy as np
+from centroidtracker import CentroidTracker
+from controller import Controller
+from simulator import GuideSimulation, MountModel
+
+####################################################################
+def field(seed=1, nStars=8):
+    return np.random.default_rng(seed).uniform(50, 450, (nStars, 2))
+
+####################################################################
+def test_hot_pixel_rejected_while_field_moves():
+    tracker = CentroidTracker()
+    stars, hot = field(), np.array([[120, 300]])
+    for i in range(40):
+        shift = np.array([0.7, 0.3]) * i
+        tracker.update(np.vstack((np.round(stars + shift), hot)).astype(int))
+        if i == 1:
+            tracker.autoselect(None)
+
+    assert tracker.rejected > 0
+    assert not any(np.array_equal(centroid, hot[0]) for centroid in tracker.objects.values())
+    assert np.allclose(tracker.fieldOffset, [0.7 * 39, 0.3 * 39], atol=1.5)
+
+####################################################################
+def test_field_held_still_keeps_every_star():
+    """Guiding holds the field still: stars jittering by a pixel for a long
+    time must not add up to field motion."""
+
+    tracker = CentroidTracker()
+    rng = np.random.default_rng(2)
+    stars = field()
+    for i in range(2000):
+        tracker.update(np.round(stars + rng.normal(0, 0.5, stars.shape)).astype(int))
+        if i == 1:
+            tracker.autoselect(None)
+            trackID = tracker.trackID
+
+    assert tracker.rejected == 0
+    assert np.abs(tracker.fieldOffset).max() <= 1
+    assert tracker.trackID == trackID and tracker.status.mode == tracker.LOCKED
+
+####################################################################
+def test_guide_star_never_rejected():
+    """The guide star held still while the rest of the field moves (as
+    after a dither) is not a hot pixel."""
+
+    tracker = CentroidTracker()
+    stars = field()
+    guide = np.array([[CentroidTracker.orgX, CentroidTracker.orgY]])
+    for i in range(30):
+        tracker.update(np.vstack((guide, np.round(stars + [0.8 * i, 0]))).astype(int))
+        if i == 1:
+            tracker.autoselect(None)
+            trackID = tracker.trackID
+
+    assert tracker.trackID == trackID and tracker.status.mode == tracker.LOCKED
+
+####################################################################
+def test_closed_loop_hour_keeps_guide_star():
+    """An hour of simulated closed-loop guiding never changes guide star."""
+
+    controller = Controller()
+    controller.RAPropGain = controller.DECPropGain = 600
+    controller.RAIntGain = controller.DECIntGain = 100
+    sim = GuideSimulation(MountModel(seed=2), controller=controller, render=False, seed=2)
+    assert sim.acquire() and sim.calibrate()
+
+    trackID = sim.pipeline.tracker.trackID
+    errors = np.zeros((3600, 2))
+    for i in range(len(errors)):
+        errors[i] = sim.mount.sky_offset()
+        sim.step("run")
+        assert sim.pipeline.tracker.trackID == trackID
+
+    assert np.sqrt(np.mean(np.sum(errors ** 2, axis=1))) < 1.0
@@ -0,0 +1,44 @@
+##############################################################################
+#                             test_controller.py                             #
+##############################################################################
+
+from controller import Controller
+from pec import PeriodicErrorCorrector
+
+####################################################################
+def controller():
+    controller = Controller(profile=None)
+    controller.RAPropGain = controller.DECPropGain = 600
+    controller.RAIntGain = controller.DECIntGain = 100
+    return controller
+
+####################################################################
+def test_rates_clamped_with_pec_feed_forward():
+    """The PEC feed-forward can't push the RA rate past RAMaxRate, and the
+    corrector is told the rate actually sent."""
+
+    c = controller()
+    c.pec = PeriodicErrorCorrector(period=100)
+    c.pec.feed_forward = lambda t: 0.5
+    (raRate, decRate) = c.calculate(10.0, 0.0, timestamp=0.0)
+    assert raRate == c.RAMaxRate
+    assert c.pec.rate == raRate
+
+####################################################################
+def test_feed_forward_rates_clamped():
+    c = controller()
+    c.feedForward = (-0.5, 0.5)
+    (raRate, decRate) = c.calculate(-10.0, 10.0, timestamp=0.0)
+    assert (raRate, decRate) == (-c.RAMaxRate, c.DECMaxRate)
+
+####################################################################
+def test_pec_learns_only_from_locked_frames():
+    c = controller()
+    c.pec = PeriodicErrorCorrector(period=100)
+    rates = [c.calculate(1.0, 0.0, timestamp=0.0)[0],
+             c.calculate(0.0, 0.0, timestamp=1.0, locked=False)[0]]
+    c.calculate(1.0, 0.0, timestamp=2.0)
+    assert c.pec.count == 2
+
+    # the travel commanded around the unlocked frame still counts
+    assert abs(c.pec.travel - sum(rates)) < 1e-12
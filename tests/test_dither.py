@@ -0,0 +1,39 @@
+##############################################################################
+#                               test_dither.py                               #
+##############################################################################
+
+import numpy as np
+from controller import Controller
+from dither import spiral_offset
+from simulator import GuideSimulation, MountModel
+
+####################################################################
+def test_spiral_offset():
+    points = [spiral_offset(i) for i in range(9)]
+    assert points == [(0, 0), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1),
+                      (0, -1), (1, -1)]
+
+####################################################################
+def test_closed_loop_hour_of_dithers():
+    """Dithering every two minutes for an hour settles every time, on the
+    same guide star, with the lock position moved each time."""
+
+    controller = Controller()
+    controller.RAPropGain = controller.DECPropGain = 600
+    controller.RAIntGain = controller.DECIntGain = 100
+    sim = GuideSimulation(MountModel(seed=3), controller=controller, render=False, seed=3)
+    assert sim.acquire() and sim.calibrate()
+
+    pipeline = sim.pipeline
+    events = []
+    pipeline.dither.listeners.append(events.append)
+    trackID = pipeline.tracker.trackID
+    for i in range(3600):
+        if i % 120 == 60:
+            pipeline.dither.dither(timestamp=sim.mount.t)
+        sim.step("run")
+        assert pipeline.tracker.trackID == trackID
+
+    assert [event["event"] for event in events] == ["settled"] * 30
+    assert max(event["seconds"] for event in events) < 60
+    assert np.hypot(*pipeline.status.COM) <= 3
@@ -0,0 +1,59 @@
+##############################################################################
+#                             test_framering.py                              #
+##############################################################################
+
+import numpy as np
+
+from framering import FrameRing
+
+
+####################################################################
+def fill(ring, values):
+    """Producer side: commit a frame of each value, dropping it if the
+    ring is full. Return the values committed."""
+    committed = []
+    for value in values:
+        slot = ring.acquire_write(timeout=0)
+        if slot is not None:
+            slot[:] = value
+            ring.commit(timestamp=float(value))
+            committed.append(value)
+    return committed
+
+
+####################################################################
+def test_sequence_and_missed():
+    ring = FrameRing(shape=(4, 4), slots=3)
+    try:
+        # the fourth and fifth frames are dropped while the ring is full
+        assert fill(ring, range(5)) == [0, 1, 2]
+        assert ring.dropped == 2
+
+        for expected in range(3):
+            (frame, seq, timestamp) = ring.acquire_read(timeout=0)
+            assert seq == expected and timestamp == expected and np.all(frame == expected)
+            ring.release()
+        assert ring.missed == 0 and ring.acquire_read(timeout=0) is None
+
+        # the consumer sees the gap left by the dropped frames
+        assert fill(ring, [5]) == [5]
+        (frame, seq, timestamp) = ring.acquire_read(timeout=0)
+        assert seq == 5 and np.all(frame == 5) and ring.missed == 2
+        ring.release()
+    finally:
+        ring.close()
+
+
+####################################################################
+def test_acquire_latest():
+    ring = FrameRing(shape=(4, 4), slots=3)
+    try:
+        fill(ring, range(3))
+        (frame, seq, timestamp) = ring.acquire_latest(timeout=0)
+        assert seq == 2 and np.all(frame == 2) and ring.missed == 0
+        ring.release()
+
+        # every slot is free again
+        assert fill(ring, range(3, 6)) == [3, 4, 5]
+    finally:
+        ring.close()
@@ -0,0 +1,20 @@
+##############################################################################
+#                              test_pipeline.py                              #
+##############################################################################
+
+from simulator import GuideSimulation, MountModel
+
+####################################################################
+def test_repeated_frame_skipped():
+    sim = GuideSimulation(MountModel(seed=1), seed=1)
+    pipeline = sim.pipeline
+    frame = sim.camera.capture()
+
+    pipeline.expose(frame)
+    assert not pipeline.unchanged
+    pipeline.expose(frame.copy())
+    assert pipeline.unchanged and pipeline.status.skipped == 1
+
+    sim.mount.advance(1.0)
+    pipeline.expose(sim.camera.capture())
+    assert not pipeline.unchanged and pipeline.status.img_num == 3
@@ -0,0 +1,46 @@
+##############################################################################
+#                              test_protocol.py                              #
+##############################################################################
+
+import protocol
+from protocol import FrameParser, crc16, crc8, decode_rates, encode_ack, encode_rates
+
+
+####################################################################
+def test_crc_check_values():
+    assert crc16(b"123456789") == 0x29B1
+    assert crc8(b"123456789") == 0xF4
+
+
+####################################################################
+def test_rates_round_trip():
+    frame = encode_rates(261, 0.25, -1.5)
+    assert len(frame) == protocol.FRAME_SIZE
+    assert decode_rates(frame) == (5, 0.25, -1.5)
+    assert decode_rates(encode_rates(0, 100, -100))[1:] == (protocol.RATE_LIMIT, -protocol.RATE_LIMIT)
+
+    corrupt = bytearray(frame)
+    corrupt[3] ^= 0x01
+    assert decode_rates(bytes(corrupt)) is None
+
+
+####################################################################
+def test_parser_resyncs():
+    frames = [encode_rates(seq, seq / 10, -seq / 10) for seq in range(4)]
+    corrupt = bytearray(frames[1])
+    corrupt[-1] ^= 0xFF
+    stream = b"OK\n" + frames[0] + bytes(corrupt) + b"\xa5\x00" + frames[2] + frames[3]
+
+    # split the stream mid-frame to check partial frames are kept
+    parser = FrameParser()
+    received = parser.feed(stream[:13]) + parser.feed(stream[13:])
+    assert received == [frames[0], frames[2], frames[3]]
+    assert parser.crcErrors >= 2 and not parser.buffer
+
+
+####################################################################
+def test_ack_parser():
+    parser = FrameParser(protocol.ACK_SYNC, protocol.ACK_SIZE)
+    acks = parser.feed(b"\x5a\x07\x00" + encode_ack(7) + encode_ack(300)[:2])
+    assert acks == [encode_ack(7)] and parser.crcErrors == 1
+    assert parser.feed(encode_ack(300)[2:]) == [encode_ack(300)]
@@ -0,0 +1,29 @@
+##############################################################################
+#                              test_session.py                               #
+##############################################################################
+
+import glob
+import os
+import numpy as np
+
+from session import record_simulation, replay
+
+
+####################################################################
+def test_replay_matches_recording(tmp_path):
+    directory = str(tmp_path)
+    record_simulation(directory, frames=120, seed=1, chunkFrames=32)
+    assert len(glob.glob(os.path.join(directory, "chunk-*.npz"))) == 4
+
+    result = replay(directory)
+    assert result["frames"] == 120
+    assert not any(result["mismatches"].values())
+
+    # a recording that disagrees with the pipeline is caught in the right frame
+    path = os.path.join(directory, "chunk-00001.npz")
+    chunk = dict(np.load(path))
+    chunk["dX"][5] += 1
+    np.savez_compressed(path, **chunk)
+
+    result = replay(directory)
+    assert result["mismatches"]["dX"] == 1 and result["firstMismatch"] == {"dX": 37}
@@ -0,0 +1,15 @@
+##############################################################################
+#                              test_simulator.py                             #
+##############################################################################
+
+from simulator import GuideSimulation, MountModel
+
+
+####################################################################
+def test_default_rig_settles(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)     # no controller profile on disk
+    sim = GuideSimulation(MountModel(seed=1), render=False, seed=1)
+    assert sim.acquire() and sim.calibrate()
+
+    report = sim.guide(3600)
+    assert report["rmsTotal"] < 1 and report["convergenceTime"] is not None
@@ -0,0 +1,38 @@
+##############################################################################
+#                           test_statushistory.py                            #
+##############################################################################
+
+import numpy as np
+
+from status import Status
+from statushistory import StatusHistory
+
+
+####################################################################
+def test_statistics_match_numpy():
+    rng = np.random.default_rng(0)
+    history, status = StatusHistory(capacity=50), Status()
+    frames = []
+
+    for i in range(173):
+        # drifting error, with every 7th frame lost at a bogus position
+        locked = i % 7 != 3
+        err = (0.01 * i, -0.02 * i) + rng.normal(0, 1, 2) if locked else (99.0, 99.0)
+        status.set(i, status.LOCKED if locked else status.SEARCHING, tuple(err), timestamp=2.0 * i)
+        snr = rng.uniform(5, 20)
+        history.add(status, snr=snr)
+        frames.append((2.0 * i, err[0], err[1], snr, locked))
+
+        window = np.array(frames[-50:])
+        t, x, y, snrs = window[window[:, 4] == 1, :4].T
+        assert len(history) == len(window)
+        assert np.isclose(history.rms_ra(), np.sqrt(np.mean(x ** 2)), atol=1e-5)
+        assert np.isclose(history.rms_dec(), np.sqrt(np.mean(y ** 2)), atol=1e-5)
+        assert np.isclose(history.peak(), np.max(np.hypot(x, y)), atol=1e-5)
+        assert np.isclose(history.snr(), np.mean(snrs), atol=1e-4)
+        if len(t) > 1:
+            slopes = (np.polyfit(t, x, 1)[0], np.polyfit(t, y, 1)[0])
+            assert np.allclose(history.drift(), 60 * np.array(slopes), atol=1e-4)
+
+    history.clear()
+    assert len(history) == 0 and history.rms_total() == 0 and history.peak() == 0
@@ -0,0 +1,51 @@
+##############################################################################
+#                                test_uart.py                                #
+##############################################################################
+
+import threading
+from collections import deque, OrderedDict
+from uart import UART
+
+####################################################################
+def bare_uart():
+    """UART bookkeeping without a serial port."""
+    uart = UART.__new__(UART)
+    uart.lock = threading.Condition()
+    uart.ackTimes = OrderedDict()
+    uart.inflight = deque(maxlen=64)
+    uart.latencies = deque(maxlen=1000)
+    return uart
+
+####################################################################
+def test_lost_ack_doesnt_leave_a_stale_send_time():
+    uart = bare_uart()
+    for seq in range(4):
+        uart.ackTimes[seq] = 10.0 + seq
+
+    # the ack of frame 1 was lost: frame 2's ack drops it
+    uart.match_ack(0, 10.5)
+    uart.match_ack(2, 12.5)
+    assert list(uart.ackTimes) == [3]
+    assert list(uart.latencies) == [0.5, 0.5]
+
+    # so a later frame reusing sequence number 1 isn't matched to it
+    uart.ackTimes[1] = 20.0
+    uart.match_ack(1, 20.25)
+    assert uart.latencies[-1] == 0.25
+    assert list(uart.ackTimes) == []
+
+####################################################################
+def test_unknown_ack_ignored():
+    uart = bare_uart()
+    uart.ackTimes[7] = 1.0
+    uart.match_ack(9, 2.0)
+    assert list(uart.ackTimes) == [7] and not uart.latencies
+
+####################################################################
+def test_echo_matching():
+    uart = bare_uart()
+    uart.inflight.extend([[1.0, 4], [2.0, 4]])
+    uart.match_echo(6)
+    assert len(uart.inflight) == 1 and uart.inflight[0][1] == 2
+    uart.match_echo(2)
+    assert not uart.inflight and len(uart.latencies) == 2
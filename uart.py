@@ -3,58 +3,257 @@
 ##############################################################################
 
 from serial import Serial
-from time import sleep
+from time import sleep, monotonic
+from collections import deque, OrderedDict
+import threading
+import protocol
 
 ##############################################################################
 class UART:
+    """Serial link to the mount MCU. Rates are handed to a background writer
+    thread through a single-slot mailbox, so transmit() never waits on the
+    serial port: if the writer hasn't sent the previous rates yet, the newer
+    pair replaces them. A reader thread consumes the MCU echo (or binary
+    acknowledgements) and keeps counters instead of printing on the guiding
+    loop.
+
+    Rates are sent in the legacy ASCII format unless the binary protocol of
+    protocol.py is requested and the MCU agrees to it when the port opens."""
 
     ####################################################################
-    def __init__(self):
-        """Open the serial port of the UART-TTL Converter as 'COM3' in Windows.
-        Exit if any errors occur."""
+    def __init__(self, port='COM3', baud=9600, linkProtocol=protocol.ASCII, fastBaud=None):
+        """Open the serial port of the UART-TTL Converter, 'COM3' in Windows
+        by default (or e.g. the pty of mcuemulator.py). Exit if any errors
+        occur. With protocol.BINARY, try to switch the link to binary frames
+        (and to fastBaud, if given)."""
 
-        self.port = 'COM3'
-        self.baud = 9600
+        self.port = port
+        self.baud = baud
 
         try:
-            self.ser = Serial(self.port, self.baud)
+            # read timeout lets the reader thread notice a disconnect
+            self.ser = Serial(self.port, self.baud, timeout=0.1)
         except:
             exit("<ERROR: check serial connection>")
 
         if not self.ser.is_open:
             exit(f"<ERROR: can't open serial port: {self.port}>")
 
+        # single-slot mailbox of rates waiting for the writer
+        self.lock = threading.Condition()
+        self.pending = None
+        self.running = True
+
+        # the ASCII firmware needs time to parse a command before the next
+        # one (binary frames are delimited, so they aren't spaced out)
+        self.minInterval = 0.1
+        self.lastWrite = 0.0
+
+        # counters
+        self.queued = 0         # calls to transmit()
+        self.sent = 0           # rate pairs written to the port
+        self.coalesced = 0      # rate pairs replaced before they were sent
+        self.errors = 0         # failed writes or reads
+        self.echoBytes = 0      # bytes echoed back by the MCU
+        self.acks = 0           # binary frames acknowledged by the MCU
+        self.lastEcho = ""
+        self.connected = False
+
+        # round trip latency: send times of commands waiting for their echo
+        # (bytes still to come back) or acknowledgement (by sequence number);
+        # against firmware that doesn't echo, the oldest fall off the end
+        self.inflight = deque(maxlen=64)
+        self.ackTimes = OrderedDict()   # in send order
+        self.latencies = deque(maxlen=1000)
+
+        # binary protocol state, only used once negotiated
+        self.protocol = protocol.ASCII
+        self.seq = 0
+        self.ackParser = protocol.FrameParser(protocol.ACK_SYNC, protocol.ACK_SIZE)
+
+        # negotiate before the reader thread starts so it can't eat the reply
+        if linkProtocol == protocol.BINARY:
+            self.negotiate(fastBaud)
+
+        self.writer = threading.Thread(target=self.write_loop, name="uart-writer", daemon=True)
+        self.reader = threading.Thread(target=self.read_loop, name="uart-reader", daemon=True)
+        self.writer.start()
+        self.reader.start()
+
         self.connect()
 
     ####################################################################
     def connect(self):
-        """Connect the autoguiding program to MCU by echoing a message;
-        (Not currently implemented, because stable connection is assumed
-        after opening the port)."""
+        """Connect the autoguiding program to MCU by echoing a message.
+        The echo is checked by the reader thread, so this doesn't wait;
+        a stable connection is assumed after opening the port. The binary
+        protocol's negotiation already served as the handshake."""
+
+        if self.protocol == protocol.BINARY:
+            return
+
+        with self.lock:
+            message = str('UART Enabled').encode('ascii')
+            self.inflight.append([None, len(message)])
+            self.ser.write(message)
 
-        wBytes = self.ser.write(str('UART Enabled').encode('ascii'))
-        sleep(0.05)
-        echoStr = self.ser.read(self.ser.in_waiting)
-        if echoStr is 'UART Enabled':
-            print(f'\t<Connection Succesful: {echoStr}>\n')
+    ####################################################################
+    def negotiate(self, fastBaud=None, timeout=0.5):
+        """Ask the MCU to switch to binary frames, optionally at fastBaud.
+        Stay on the legacy ASCII protocol if it doesn't answer in time."""
+
+        baud = fastBaud if fastBaud is not None else self.baud
+        self.ser.reset_input_buffer()
+        self.ser.write(protocol.NEGOTIATE.format(baud=baud).encode('ascii'))
+
+        reply = ""
+        deadline = monotonic() + timeout
+        while monotonic() < deadline and protocol.NEGOTIATE_OK not in reply:
+            reply += self.ser.read(self.ser.in_waiting or 1).decode('ascii', errors='replace')
+
+        if protocol.NEGOTIATE_OK not in reply:
+            print("<WARNING: MCU didn't accept binary protocol, using ASCII>")
+            return False
+
+        self.ser.flush()
+        if baud != self.baud:
+            self.ser.baudrate = baud
+            self.baud = baud
+        self.protocol = protocol.BINARY
+        self.connected = True
+        print(f"<binary protocol at {self.baud} baud>")
+        return True
 
     ####################################################################
     def transmit(self, raRate, decRate):
-        """Send motor rates to the MCU."""
+        """Queue motor rates for the MCU and return immediately. Rates that
+        are still waiting to be sent are replaced by the newer ones."""
 
-        # send raRate and decRate with 3 digits beyond decimal, add in extra
-        # spaces to ensure MCU program catches all characters.
-        data = f" {raRate:.3f} {decRate:.3f}  "
-        try:
-            self.ser.write(data.encode('ascii'))
-            sleep(0.1)
-            echoStr = self.ser.read(self.ser.in_waiting)
-        except:
-            exit("<ERROR: check serial connection>")
+        with self.lock:
+            if self.pending is not None:
+                self.coalesced += 1
+            self.pending = (raRate, decRate)
+            self.queued += 1
+            self.lock.notify()
 
-        print(echoStr.decode('utf-8'))
+    ####################################################################
+    def queue_depth(self):
+        """Number of rate pairs waiting to be written (0 or 1)."""
+        return 0 if self.pending is None else 1
+
+    ####################################################################
+    def write_loop(self):
+        """Writer thread: send the latest rates whenever the mailbox fills,
+        at most one ASCII command per minInterval."""
+
+        while True:
+            with self.lock:
+                while self.pending is None and self.running:
+                    self.lock.wait()
+                if not self.running:
+                    return
+
+            # rates queued while waiting replace the pending ones
+            if self.protocol == protocol.ASCII:
+                sleep(max(self.lastWrite + self.minInterval - monotonic(), 0))
+
+            with self.lock:
+                raRate, decRate = self.pending
+                self.pending = None
+
+            # either a binary frame, or raRate and decRate in ASCII with 3
+            # digits beyond decimal
+            if self.protocol == protocol.BINARY:
+                data = protocol.encode_rates(self.seq, raRate, decRate)
+                with self.lock:
+                    # a reused sequence number replaces any stale entry
+                    self.ackTimes.pop(self.seq, None)
+                    self.ackTimes[self.seq] = monotonic()
+                self.seq = (self.seq + 1) & 0xFF
+            else:
+                data = protocol.encode_ascii(raRate, decRate)
+                self.inflight.append([monotonic(), len(data)])
+
+            try:
+                self.ser.write(data)
+                self.sent += 1
+                self.lastWrite = monotonic()
+            except Exception as e:
+                with self.lock:
+                    self.errors += 1
+                print(f"<ERROR: check serial connection: {e}>")
+
+    ####################################################################
+    def read_loop(self):
+        """Reader thread: consume the MCU echo and count it."""
+
+        handshake = ""
+        while self.running:
+            try:
+                echo = self.ser.read(self.ser.in_waiting or 1)
+            except Exception:
+                if self.running:
+                    with self.lock:
+                        self.errors += 1
+                    sleep(0.1)
+                continue
+
+            if echo and self.protocol == protocol.BINARY:
+                now = monotonic()
+                for frame in self.ackParser.feed(echo):
+                    self.acks += 1
+                    self.match_ack(frame[1], now)
+
+            elif echo:
+                self.echoBytes += len(echo)
+                self.match_echo(len(echo))
+                self.lastEcho = echo.decode('ascii', errors='replace')
+
+                # the handshake echo may arrive split across reads
+                if not self.connected:
+                    handshake = (handshake + self.lastEcho)[-64:]
+                    if 'UART Enabled' in handshake:
+                        self.connected = True
+                        print(f'\t<Connection Succesful: {handshake.strip()}>\n')
+
+    ####################################################################
+    def match_echo(self, nBytes):
+        """Pop the commands whose echo has fully come back and record their
+        round trip latency."""
+
+        now = monotonic()
+        while nBytes > 0 and self.inflight:
+            command = self.inflight[0]
+            taken = min(nBytes, command[1])
+            command[1] -= taken
+            nBytes -= taken
+            if command[1] == 0:
+                self.inflight.popleft()
+                if command[0] is not None:
+                    self.latencies.append(now - command[0])
+
+    ####################################################################
+    def match_ack(self, seq, now):
+        """Record the round trip latency of the acknowledged frame. Acks
+        come back in send order, so the frames sent before it that are
+        still waiting lost theirs and are dropped."""
+
+        with self.lock:
+            if seq not in self.ackTimes:
+                return
+            while True:
+                (sentSeq, sentTime) = self.ackTimes.popitem(last=False)
+                if sentSeq == seq:
+                    break
+        self.latencies.append(now - sentTime)
 
     ####################################################################
     def disconnect(self):
-        """Disconnect UART serial port."""
-        self.ser.close()
\ No newline at end of file
+        """Stop the writer and reader threads and close the serial port."""
+
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        self.writer.join(timeout=1)
+        self.reader.join(timeout=1)
+        self.ser.close()